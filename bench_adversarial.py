@@ -0,0 +1,60 @@
+# python3.3
+# bench_adversarial.py
+
+# Benchmark for markdown to Ulysses XML conversion of single long lines, made to be slow:
+# Start tags without end tags, HTML tags with many spaces, nested HTML end tags.
+# Compares the tokenizer engine (use_md_tokenizer) with the earlier regex engine.
+# Regex engine is skipped for larger sizes, once it takes more than "max_regex_time" seconds.
+# Time per KB of the tokenizer engine should stay about the same for all sizes.
+
+# Usage: python3 bench_adversarial.py [max_size_kb]
+
+import sys
+import time
+import ulysses_sync_lib_1_0_2 as Ulib
+
+sizes_kb = [1, 4, 16, 64, 256, 1024]
+max_regex_time = 1
+
+if len(sys.argv) > 1:
+    if sys.argv[1] != "":
+        sizes_kb = [size for size in sizes_kb if size <= int(sys.argv[1])]
+
+# Markdown before escaping of "<" and "&" (done by markdown_to_ulysses_xml).
+# (Name, repeated text, end of line):
+patterns = [
+    ("Unclosed HTML comments", "<!-- x ", ""),
+    ("Unclosed Critic comments", "{>> x ", ""),
+    ("Unclosed annotations", "{==x==}{>> ", ""),
+    ("Unclosed delete and mark", "{--x {++y ", ""),
+    ("HTML tag with many spaces", "<a b c d ", ">"),
+    ("HTML tags, near end tags", "<a b c>x </a b ", ">"),
+    ("Nested HTML end tags", "</a </b ", ">"),
+    ("Unclosed emph and code", "*x `y _z ", ""),
+]
+
+
+def bench(md_text):
+    start = time.time()
+    Ulib.markdown_to_ulysses_xml(md_text, "", "", False)
+    return time.time() - start
+
+
+print("%-28s %-8s %-11s %-9s %-11s %-9s" % ("Pattern", "Size KB", "tokenizer s", "us/KB",
+                                            "regex s", "us/KB"))
+for (name, pattern, line_end) in patterns:
+    regex_time = 0
+    for size_kb in sizes_kb:
+        md_text = "Title\n" + pattern * int(size_kb * 1024 / len(pattern)) + line_end
+        kb = len(md_text) / 1024
+
+        Ulib.use_md_tokenizer = True
+        tokenizer_time = bench(md_text)
+        if regex_time < max_regex_time:
+            Ulib.use_md_tokenizer = False
+            regex_time = bench(md_text)
+            regex_result = "%-11.3f %-9.0f" % (regex_time, regex_time / kb * 1e6)
+        else:
+            regex_result = "skipped"
+        print("%-28s %-8d %-11.3f %-9.0f %s" % (name, size_kb, tokenizer_time,
+                                                tokenizer_time / kb * 1e6, regex_result))
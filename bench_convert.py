@@ -0,0 +1,92 @@
+# python3.3
+# bench_convert.py
+
+# Benchmark for the converters in "ulysses_sync_lib_1_0_2.py",
+# using generated sheets from 1 KB to 10 MB:
+# - Markdown to Ulysses XML (sync/import): markdown_to_ulysses_xml()
+# - Ulysses XML to Markdown (export): UlyssesToMarkdown.xml2markdown()
+# Prints time per size, and time per KB, which should stay about the same if conversion is linear.
+
+# Usage: python3 bench_convert.py [max_size_kb]
+
+import sys
+import time
+import random
+import tempfile
+import shutil
+import ulysses_sync_lib_1_0_2 as Ulib
+
+sizes_kb = [1, 10, 100, 1000, 10000]
+
+if len(sys.argv) > 1:
+    if sys.argv[1] != "":
+        sizes_kb = [size for size in sizes_kb if size <= int(sys.argv[1])]
+
+
+def make_markdown(size):
+    # Generates markdown of about "size" bytes, with the markup used in exported sheets:
+    rnd = random.Random(size)
+    words = ["lorem", "ipsum", "dolor", "sit", "amet", "consectetur", "adipiscing", "elit",
+             "sed", "do", "eiusmod", "tempor", "incididunt", "ut", "labore", "et", "dolore"]
+    lines = ["# Benchmark sheet " + str(size)]
+    refs = []
+    length = 0
+    fn_num, link_num = 1, 1
+    while length < size:
+        text = " ".join(rnd.choice(words) for i in range(rnd.randint(8, 40)))
+        kind = rnd.randint(0, 11)
+        if kind == 0:
+            line = "## " + text[:40]
+        elif kind == 1:
+            line = "* " + text
+        elif kind == 2:
+            line = "1. " + text
+        elif kind == 3:
+            line = "> " + text
+        elif kind == 4:
+            line = "\t" + text
+        elif kind == 5:
+            line = text + " [^" + str(fn_num) + "] **" + rnd.choice(words) + "**"
+            refs.append("[^" + str(fn_num) + "]:\t" + text[:60])
+            fn_num += 1
+        elif kind == 6:
+            line = "[" + rnd.choice(words) + "][" + str(link_num) + "] " + text
+            refs.append("[" + str(link_num) + "]:\thttp://example.com/" + str(link_num) + ' "Title"')
+            link_num += 1
+        elif kind == 7:
+            line = text + " {==" + rnd.choice(words) + "==}{>>note<<} *" + rnd.choice(words) + "*"
+        elif kind == 8:
+            line = "{>>" + text + "<<}"
+        elif kind == 9:
+            line = text + " `code` {--del--} {++mark++} <b>html</b>"
+        else:
+            line = text
+        lines.append(line)
+        lines.append("")
+        length += len(line) + 1
+    return "\n".join(lines) + "\n\n" + "\n".join(refs)
+
+
+def bench(md_text, temp_path):
+    start = time.time()
+    xml_text = Ulib.markdown_to_ulysses_xml(md_text, "", "", False)
+    md2xml_time = time.time() - start
+
+    Ulib.write_file(temp_path + "/Content.xml", xml_text)
+    start = time.time()
+    Ulib.UlyssesToMarkdown().xml2markdown(temp_path)
+    xml2md_time = time.time() - start
+    return (md2xml_time, xml2md_time)
+
+
+temp_path = tempfile.mkdtemp()
+try:
+    print("Size KB    md->xml s  us/KB     xml->md s  us/KB")
+    for size_kb in sizes_kb:
+        md_text = make_markdown(size_kb * 1024)
+        (md2xml_time, xml2md_time) = bench(md_text, temp_path)
+        kb = len(md_text) / 1024
+        print("%-10d %-10.3f %-9.0f %-10.3f %-9.0f" % (size_kb, md2xml_time, md2xml_time / kb * 1e6,
+                                                      xml2md_time, xml2md_time / kb * 1e6))
+finally:
+    shutil.rmtree(temp_path)
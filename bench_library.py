@@ -0,0 +1,187 @@
+# python3.3
+# bench_library.py
+
+# Generates a synthetic Ulysses III library, for benchmarks and testing without Ulysses (e.g. on Linux):
+# - "Groups-ulgroup" with nested groups (3 levels), and "Unfiled-ulgroup" (Inbox),
+#   each group with an "Info.ulgroup" plist.
+# - Sheets as ".ulysses" packages: "Content.xml" (converted by markdown_to_ulysses_xml) with headings,
+#   footnotes, links, images, annotations, comments, lists and code,
+#   and attachments: notes, keywords and images. Some sheets have media-files in "Media" folder.
+# Same "seed" gives the same library.
+
+# Usage: python3 bench_library.py library_path [sheets] [seed]
+# Example: python3 bench_library.py "/tmp/Bench Library/" 1000
+
+import os
+import sys
+import random
+import ulysses_sync_lib_1_0_2 as Ulib
+
+sheets_per_group = 20  # Sheets in each group, before adding sub groups.
+sub_groups = 4  # Sub groups in each group, up to "max_depth" levels.
+max_depth = 3
+inbox_sheets = 10
+media_ratio = 0.2  # Part of sheets with a media-file.
+media_size = 20000  # Bytes per media-file.
+
+plist_template = """<?xml version="1.0" encoding="UTF-8"?>
+<!DOCTYPE plist PUBLIC "-//Apple//DTD PLIST 1.0//EN" "http://www.apple.com/DTDs/PropertyList-1.0.dtd">
+<plist version="1.0">
+<dict>
+%s</dict>
+</plist>
+"""
+
+words = ["lorem", "ipsum", "dolor", "sit", "amet", "consectetur", "adipiscing", "elit", "sed",
+         "do", "eiusmod", "tempor", "incididunt", "ut", "labore", "et", "dolore", "magna"]
+
+
+def make_plist(display_name, groups, sheets):
+    plist = "\t<key>childOrder</key>\n\t<array>\n"
+    plist += "".join("\t\t<string>%s</string>\n" % group for group in groups)
+    plist += "\t</array>\n"
+    if display_name is not None:
+        plist += "\t<key>displayName</key>\n\t<string>%s</string>\n" % display_name
+    plist += "\t<key>sheetClusters</key>\n\t<array>\n"
+    plist += "".join("\t\t<array>\n\t\t\t<string>%s</string>\n\t\t</array>\n" % sheet for sheet in sheets)
+    plist += "\t</array>\n"
+    return plist_template % plist
+
+
+def make_uuid(rnd):
+    return "%032x" % rnd.getrandbits(128)
+
+
+def make_sheet_markdown(rnd, num, media_id):
+    def text(min_words, max_words):
+        return " ".join(rnd.choice(words) for i in range(rnd.randint(min_words, max_words)))
+
+    lines = ["# " + text(2, 5).capitalize() + " " + str(num), ""]
+    refs = []
+    fn_num, link_num = 1, 1
+    for i in range(rnd.randint(4, 12)):
+        kind = rnd.randint(0, 9)
+        if kind == 0:
+            lines.append("## " + text(2, 6))
+        elif kind == 1:
+            lines += ["* " + text(4, 12), "\t* " + text(4, 12), "1. " + text(4, 12)]
+        elif kind == 2:
+            lines.append("> " + text(8, 30))
+        elif kind == 3:
+            lines.append(text(8, 30) + "[^" + str(fn_num) + "] **" + rnd.choice(words) + "**")
+            refs.append("[^" + str(fn_num) + "]:\t" + text(4, 12))
+            fn_num += 1
+        elif kind == 4:
+            lines.append("[" + text(1, 3) + "][" + str(link_num) + "] " + text(8, 30))
+            refs.append("[" + str(link_num) + "]:\thttp://example.com/" + str(link_num)
+                        + ' "' + text(1, 3) + '"')
+            link_num += 1
+        elif kind == 5:
+            lines.append(text(4, 20) + " {==" + text(1, 3) + "==}{>>" + text(2, 6) + "<<} *"
+                         + rnd.choice(words) + "*")
+        elif kind == 6:
+            lines.append("{>>" + text(4, 12) + "<<}")
+        elif kind == 7:
+            lines.append(text(4, 20) + " `code` {--" + rnd.choice(words) + "--} {++"
+                         + rnd.choice(words) + "++}")
+        elif kind == 8:
+            lines.append("\t" + text(3, 8))
+        else:
+            lines.append(text(20, 60))
+        lines.append("")
+    if media_id:
+        lines += ["![" + text(1, 3) + "][image-1]", ""]
+        refs.append("[image-1]:\tMedia/image." + media_id + '.png "' + text(1, 3) + '"')
+    return "\n".join(lines) + "\n" + "\n".join(refs) + "\n"
+
+
+def make_attachments(rnd, media_id):
+    attachments = '<attachment type="note"><string xml:space="preserve"><p>Note: '\
+        + " ".join(rnd.choice(words) for i in range(8)) + "</p></string></attachment>"
+    attachments += '<attachment type="keywords">' + ",".join(rnd.sample(words, 3)) + "</attachment>"
+    if media_id:
+        attachments += '<attachment type="file">' + media_id + "</attachment>"
+    return attachments
+
+
+def make_sheets(rnd, group_path, count, sheet_num):
+    # Makes "count" sheet packages in group, returns package names:
+    packages = []
+    for i in range(count):
+        package = make_uuid(rnd) + ".ulysses"
+        package_path = group_path + package + "/"
+        os.makedirs(package_path)
+
+        media_id = make_uuid(rnd) if rnd.random() < media_ratio else ""
+        md_text = make_sheet_markdown(rnd, sheet_num + i, media_id)
+        xml_text = Ulib.markdown_to_ulysses_xml(md_text, package_path, "", False)
+        xml_text = xml_text[:-len("</sheet>")] + make_attachments(rnd, media_id) + "</sheet>"
+        Ulib.write_file(package_path + "Content.xml", xml_text)
+        Ulib.write_file(package_path + "Text.txt", md_text)
+
+        if media_id:
+            os.makedirs(package_path + "Media")
+            f = open(package_path + "Media/image." + media_id + ".png", "wb")
+            f.write(bytes(rnd.getrandbits(8) for i in range(media_size)))
+            f.close()
+        packages.append(package)
+    return packages
+
+
+def make_group(rnd, group_path, name, count, sheet_num, depth):
+    # Makes group with "count" sheets, in this group and sub groups. Returns number of sheets made:
+    os.makedirs(group_path)
+    # Groups at "max_depth" get all sheets left:
+    group_sheets = count if depth >= max_depth else min(count, sheets_per_group)
+    sheets = make_sheets(rnd, group_path, group_sheets, sheet_num)
+    made = len(sheets)
+
+    groups = []
+    if depth < max_depth:
+        for i in range(sub_groups):
+            sub_count = (count - made) // (sub_groups - i)
+            if sub_count <= 0:
+                continue
+            group = make_uuid(rnd) + "-ulgroup"
+            made += make_group(rnd, group_path + group + "/", name + "." + str(i + 1), sub_count,
+                               sheet_num + made, depth + 1)
+            groups.append(group)
+    Ulib.write_file(group_path + "Info.ulgroup", make_plist("Group " + name, groups, sheets))
+    return made
+
+
+def make_library(library_path, sheets=1000, seed=1):
+    # Makes library with about "sheets" sheets, in top level groups of max. 1000 sheets:
+    rnd = random.Random(seed)
+    os.makedirs(library_path)
+    Ulib.write_file(library_path + "Info.ulgroup",
+                    make_plist(None, ["Groups-ulgroup", "Unfiled-ulgroup"], []))
+
+    groups_path = library_path + "Groups-ulgroup/"
+    os.makedirs(groups_path)
+    top_groups = max(1, (sheets + 999) // 1000)
+    groups = []
+    made = 0
+    for i in range(top_groups):
+        group = make_uuid(rnd) + "-ulgroup"
+        group_count = (sheets - made) // (top_groups - i)
+        made += make_group(rnd, groups_path + group + "/", str(i + 1), group_count, made, 1)
+        groups.append(group)
+    Ulib.write_file(groups_path + "Info.ulgroup", make_plist("Groups", groups, []))
+
+    inbox_path = library_path + "Unfiled-ulgroup/"
+    os.makedirs(inbox_path)
+    inbox = make_sheets(rnd, inbox_path, inbox_sheets, made)
+    Ulib.write_file(inbox_path + "Info.ulgroup", make_plist("Inbox", [], inbox))
+    return made + len(inbox)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: python3 bench_library.py library_path [sheets] [seed]")
+        sys.exit(1)
+    library_path = sys.argv[1].rstrip("/") + "/"
+    sheets = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    seed = int(sys.argv[3]) if len(sys.argv) > 3 else 1
+    count = make_library(library_path, sheets, seed)
+    print("Library with", count, "sheets:", library_path)
@@ -0,0 +1,184 @@
+# python3.3
+# bench_sync.py
+
+# End to end benchmark of "ulysses2md_export_sync_1_0_2.py", using a synthetic library (bench_library.py).
+# Runs main() of the export script, in a separate process for each step:
+# 1. Initial export of all sheets, to an empty export folder.
+# 2. Sync without changes.
+# 3. Sync after editing "changed_percent" of exported md-files (synced back to Ulysses).
+# 4. Sync after editing "changed_percent" of sheets in library (Content.xml).
+# Prints time of main() and of the phases: list_all_files, export_files and sync_files,
+# peak memory of the process, and files written (new or changed) in library, export and joined folders.
+# HOME is set to the benchmark folder, so temp files and lock are kept there.
+
+# Usage: python3 bench_sync.py [sheets] [changed_percent] [work_path]
+# Example: python3 bench_sync.py 5000 1
+
+import os
+import sys
+import time
+import json
+import random
+import shutil
+import tempfile
+import subprocess
+import resource
+
+sheets = 1000
+changed_percent = 1.0
+
+steps = [("Initial export", None), ("No changes", None),
+         ("Edited md-files", "md"), ("Edited sheets", "sheets")]
+
+
+def get_paths(work_path):
+    # (ulysses_path, sync_path, md_joined_path) in work_path:
+    return (work_path + "Library/", work_path + "Export/", work_path + "Joined/")
+
+
+def run_step(work_path):
+    # Runs in child process: Times main() and its phases, prints result as JSON on last line.
+    os.environ["HOME"] = work_path
+    import ulysses2md_export_sync_1_0_2 as Sync
+    Ulib = Sync.Ulib
+    Sync.metrics_json_file = ""  # Not counted as written by sync
+
+    times = {}
+
+    def timed(module, name):
+        # Wraps function, timing only outermost calls (list_all_files is recursive):
+        func = getattr(module, name)
+        depth = [0]
+
+        def timed_func(*args, **kwargs):
+            depth[0] += 1
+            start = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                depth[0] -= 1
+                if depth[0] == 0:
+                    times[name] = times.get(name, 0) + time.time() - start
+        setattr(module, name, timed_func)
+
+    timed(Ulib, "list_all_files")
+    timed(Sync, "export_files")
+    timed(Ulib, "sync_files")
+
+    (ulysses_path, sync_path, md_joined_path) = get_paths(work_path)
+    start = time.time()
+    Sync.main(ulysses_path, sync_path, md_joined_path)
+    times["main"] = time.time() - start
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform != "darwin":
+        peak *= 1024  # Linux: KB, macOS: bytes
+    print(json.dumps({"times": times, "peak": peak}))
+
+
+def scan_files(path):
+    # Returns {filename: (mtime_ns, size, inode)} of all files in path:
+    files = {}
+    for (dirpath, dirnames, filenames) in os.walk(path):
+        for filename in filenames:
+            filename = os.path.join(dirpath, filename)
+            try:
+                st = os.lstat(filename)
+            except OSError:
+                continue
+            files[filename] = (st.st_mtime_ns, st.st_size, st.st_ino)
+    return files
+
+
+def edit_files(rnd, files, percent, edit):
+    # Edits "percent" of files (at least one), written to temp file and replaced:
+    count = max(1, int(len(files) * percent / 100))
+    for filename in rnd.sample(sorted(files), min(count, len(files))):
+        f = open(filename, "r", encoding="utf-8", newline="")
+        text = f.read()
+        f.close()
+        f = open(filename + ".edit", "w", encoding="utf-8", newline="")
+        f.write(edit(text))
+        f.close()
+        os.replace(filename + ".edit", filename)
+    return count
+
+
+def edit_md(text):
+    return text.rstrip("\n") + "\n\nEdited paragraph, by bench_sync.\n"
+
+
+def edit_sheet(text):
+    return text.replace("</string>", "<p>Edited paragraph, by bench_sync.</p></string>", 1)
+
+
+def make_changes(rnd, work_path, kind):
+    (ulysses_path, sync_path, md_joined_path) = get_paths(work_path)
+    # Dates of files have to be later than last sync:
+    time.sleep(1.1)
+    if kind == "md":
+        files = [name for name in scan_files(sync_path) if name.endswith(".md")
+                 and "/Media/" not in name and "_Inbox" not in name]
+        return edit_files(rnd, files, changed_percent, edit_md)
+    else:
+        files = [name for name in scan_files(ulysses_path) if name.endswith("/Content.xml")]
+        return edit_files(rnd, files, changed_percent, edit_sheet)
+
+
+def bench(work_path):
+    (ulysses_path, sync_path, md_joined_path) = get_paths(work_path)
+    rnd = random.Random(1)
+
+    import bench_library
+    start = time.time()
+    count = bench_library.make_library(ulysses_path, sheets)
+    print("Library with %d sheets made in %.1f s: %s" % (count, time.time() - start, ulysses_path))
+    print()
+
+    env = dict(os.environ)
+    env["HOME"] = work_path
+    results = []
+    for (name, kind) in steps:
+        edited = make_changes(rnd, work_path, kind) if kind else 0
+        before = scan_files(work_path)
+        start = time.time()
+        output = subprocess.check_output([sys.executable, os.path.abspath(__file__), "--step", work_path],
+                                         env=env, cwd=os.path.dirname(os.path.abspath(__file__)))
+        wall = time.time() - start
+        after = scan_files(work_path)
+
+        written = [filename for (filename, stat) in after.items() if before.get(filename) != stat]
+        written_bytes = sum(after[filename][1] for filename in written)
+        result = json.loads(output.decode("utf-8").strip().splitlines()[-1])
+        results.append((name, edited, wall, result, len(written), written_bytes))
+
+    print("%-16s %-7s %-7s %-7s %-9s %-9s %-9s %-8s %-8s %-8s" % (
+        "Step", "Edited", "Wall s", "main s", "list s", "export s", "sync s", "Peak MB", "Written", "MB"))
+    for (name, edited, wall, result, written, written_bytes) in results:
+        times = result["times"]
+        print("%-16s %-7d %-7.2f %-7.2f %-9.2f %-9.2f %-9.2f %-8.1f %-8d %-8.1f" % (
+            name, edited, wall, times.get("main", 0), times.get("list_all_files", 0),
+            times.get("export_files", 0), times.get("sync_files", 0),
+            result["peak"] / 1e6, written, written_bytes / 1e6))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 2 and sys.argv[1] == "--step":
+        run_step(sys.argv[2])
+        sys.exit(0)
+
+    if len(sys.argv) > 1:
+        sheets = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        changed_percent = float(sys.argv[2])
+    if len(sys.argv) > 3:
+        work_path = sys.argv[3].rstrip("/") + "/"
+        keep_files = True
+    else:
+        work_path = tempfile.mkdtemp(prefix="bench_sync_") + "/"
+        keep_files = False
+    try:
+        bench(work_path)
+    finally:
+        if not keep_files:
+            shutil.rmtree(work_path)
@@ -6,6 +6,9 @@
 # Script for Splitting Markdown files into smaller files and folders
 # based on header levels: # Header 1 becomes numbered sub folders (groups),
 # and ## Header 2 becomes numbered markdown files (sheets).
+# (Levels can be changed below: "group_levels" and "sheet_levels")
+# Markdown file is read line by line, and each file is written as it is read,
+# so even very large files are split with little memory.
 # Main folder can then be draged into Ulysses archive, either "iCloud" or "On My Mac")
 # Handy when importing big projects from other Markdown sources.
 # Also generates combined .marked file to be opened in Marked 2.1
@@ -18,6 +21,8 @@ import os
 import sys
 
 num_files = True
+group_levels = [1]  # Header levels making sub folders (groups), nested in this order, e.g. [1, 2]
+sheet_levels = [2]  # Header levels starting markdown files (sheets). Other headers stay in same file.
 path = ""
 md_file_name = "test.md"
 
@@ -47,20 +52,56 @@ def clean_file_name(fname):
     return fname
 
 
-def print_file(subpath, fname, text):
+def get_prefix(num):
+    if num_files:
+        return str(num).zfill(2) + " - "
+    return ""
 
-    fname = clean_file_name(fname)
-    subpath = clean_file_name(subpath)
-    make_dir(path + subpath)
-    subpath += "/"
 
-    text_file = open(path + subpath + fname, "w", encoding='utf-8')
-    text_file.write(text)
-    text_file.close()
-    print(str(subpath.encode("utf-8"))[2:-1], str(fname.encode("utf-8"))[2:-1])
+def get_header_level(line):
+    # Number of "#" at start of (stripped) line, 0 if not a header:
+    stripped = line.strip()
+    return len(stripped) - len(stripped.lstrip("#"))
 
-    return "<<[" + subpath + fname + "]\n"
-#end_def print_file
+
+class SectionFile:
+    # Markdown file "fname" in sub folder "subpath", opened when first line is written:
+    def __init__(self, subpath, fname):
+        self.subpath = subpath + "/"
+        self.fname = clean_file_name(fname)
+        self.text_file = None
+
+    def write_line(self, line):
+        if self.text_file is None:
+            make_dir(path + self.subpath)
+            self.text_file = open(path + self.subpath + self.fname, "w", encoding='utf-8')
+        self.text_file.write(line + "\n")
+
+    def close(self):
+        # Returns line for combined .marked file, or "" if no lines were written:
+        if self.text_file is None:
+            return ""
+        self.text_file.close()
+        print(str(self.subpath.encode("utf-8"))[2:-1], str(self.fname.encode("utf-8"))[2:-1])
+        return "<<[" + self.subpath + self.fname + "]\n"
+#end_class SectionFile
+
+
+RE_HEADER_TITLE = re.compile(r"^(#+) ?(.+?) ?#*$")
+
+
+def read_lines(file_name):
+    # Lines of file without line endings, read one by one. Same lines as text.split("\n"):
+    md_file = open(file_name, "r", encoding='utf-8')
+    line = ""
+    for line in md_file:
+        if line.endswith("\n"):
+            yield line[:-1]
+        else:
+            yield line
+    md_file.close()
+    if line == "" or line.endswith("\n"):
+        yield ""
 
 
 # Main program:
@@ -77,61 +118,45 @@ if os.path.exists(path):
 if not os.path.exists(path):
     make_dir(path)
 
-md_text = ""
-md_file = open(md_file_name, "r", encoding='utf-8')
-md_text = md_file.read()
-md_file.close()
-
 md_combined = ""
 
-lines = md_text.split("\n")
+group_levels = sorted(group_levels)
+split_levels = set(group_levels) | set(sheet_levels)
 
 file_num = 1
-path_num = 1
-file_prefix = ""
-path_prefix = ""
-if num_files:
-    file_prefix = str(file_num).zfill(2) + " - "
-    path_prefix = str(path_num).zfill(2) + " - "
-
-subpath = path_prefix + "Front matter"
-fname = subpath + ".md"
-
-sect_text = ""
-for line in lines:
-    if line.strip().startswith("###"):  # - h3 - h6
-        # Any header of h3, h4 etc. will be included in same file
-        # (File split is done on h2, and sub folders made on h1)
-        # (change to #### to split on lower level h3)
-        sect_text += line + "\n"
-    elif line.strip().startswith("#"):  # - h1 and h2
+# Number and sub folder of current group, for each group level (front matter before first header):
+group_nums = [1] + [0] * (len(group_levels) - 1)
+group_names = [clean_file_name(get_prefix(1) + "Front matter")]
+
+section = SectionFile("/".join(group_names), group_names[0] + ".md")
+first_line = True
+for line in read_lines(md_file_name):
+    level = get_header_level(line)
+    if level in split_levels:
+        # Headers of other levels are included in same file
+        # (By default, file split is done on h2, and sub folders made on h1)
         file_num += 1
-        if num_files:
-            file_prefix = str(file_num).zfill(2) + " - "
-        if sect_text != "":
-            md_combined += print_file(subpath, fname, sect_text)
-        elif path_num == 1:
-            path_num = 0
-        if line.startswith("# "):  # h1
-            path_num += 1
+        md_combined += section.close()
+        if first_line:
+            # Nothing before first header:
+            group_nums[0] = 0
+        if level in group_levels and line.startswith("#" * level + " "):
+            depth = group_levels.index(level)
+            group_nums[depth] += 1
+            for sub_depth in range(depth + 1, len(group_nums)):
+                group_nums[sub_depth] = 0
             file_num = 1
-            if num_files:
-                path_prefix = str(path_num).zfill(2) + " - "
-                file_prefix = str(file_num).zfill(2) + " - "
-
-            subpath = path_prefix + re.sub(r"^(#+) ?(.+?) ?#*$", r"\2",
-                                           line.strip())
+            group_names = group_names[:depth] + [clean_file_name(
+                get_prefix(group_nums[depth]) + RE_HEADER_TITLE.sub(r"\2", line.strip()))]
 
-        fname = file_prefix + re.sub(r"^(#+) ?(.+?) ?#*$", r"\2_\1",
-                                     line.strip()) + ".md"
-        sect_text = ""
-        sect_text += line + "\n"
+        fname = get_prefix(file_num) + RE_HEADER_TITLE.sub(r"\2_\1", line.strip()) + ".md"
+        section = SectionFile("/".join(group_names), fname)
 
-    else:
-        sect_text += line + "\n"
-#end_for line in lines
+    section.write_line(line)
+    first_line = False
+#end_for line in read_lines(md_file_name)
 
-md_combined += print_file(subpath, fname, sect_text)
+md_combined += section.close()
 
 text_file = open(path + "split-combined.marked", "w")
 text_file.write(md_combined)
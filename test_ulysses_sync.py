@@ -0,0 +1,307 @@
+# python3.3
+# test_ulysses_sync.py
+
+# Checks that the faster engines give the same output as the ones they replace, and that exports
+# reusing files from last export are the same as a full export:
+# - Ulysses XML to Markdown: use_etree_converter, against the earlier minidom converter.
+# - Markdown to Ulysses XML: use_md_tokenizer and use_ref_table, against the earlier regex engine.
+# - Incremental export (incremental_export) and watch mode export of changed groups only,
+#   against a full export of the same library, with sheets edited between syncs.
+# - Snapshot backups: Unchanged files linked, and retention (prune_snapshots).
+# Libraries are generated by "bench_library.py" in temp folders.
+
+# Usage: python3 -m unittest test_ulysses_sync  (or: python3 -m pytest)
+
+import os
+import re
+import time
+import random
+import shutil
+import tempfile
+import unittest
+import ulysses_sync_lib_1_0_2 as Ulib
+import ulysses2md_export_sync_1_0_2 as Sync
+import bench_library
+
+# Markdown with markup the engines handle differently, e.g. unclosed and nested markup:
+sample_markdown = [
+    "# Heading\n\nText with **bold**, *emph*, `code` and ~~native~~ markup.[^1]\n\n"
+    "[^1]:\tFootnote with **bold**\n",
+    "A [link][1] and [another link][2], and ![image][image-1] after.\n\n"
+    "[1]:\thttp://example.com/a_b \"Title\"\n[2]:\thttp://example.com/?q=1&r=2\n"
+    "[image-1]:\tMedia/image.png \"Image\"\n",
+    "{==Annotated==}{>>Note<<} and {--deleted--}, {++inserted++} and {>>comment<<}\n\n"
+    "> Quote\n> > Nested quote\n\n* Item\n\t* Sub item\n1. Numbered\n\n\tCode block\n",
+    "<!-- HTML comment --> <b>tag</b> &amp; 5 < 6 > 4 & co\n\n%% Comment line\n\n----\n",
+    "Unclosed <!-- x {>> y {==z *a `b _c </a </b <a b c d [x][ [y](\n",
+    "[a][b] [c][1] [^x] [^1][^2] **[^1]** [nested [link][1]][1]\n\n"
+    "[1]:\thttp://example.com/1\n[^1]:\tOne\n[^2]:\tTwo\n",
+]
+
+new_footnote = '<element kind="footnote"><attribute identifier="text">'\
+    '<string xml:space="preserve"><p>New footnote</p></string></attribute></element>'
+
+
+def read_tree(path):
+    # Files in folder: {relative path: content}, without sync state and log sheets (named by time):
+    files = {}
+    for (dir_path, dir_names, file_names) in os.walk(path):
+        for name in file_names:
+            file_name = os.path.join(dir_path, name)
+            rel_name = os.path.relpath(file_name, path)
+            if name.startswith(".ulysses_sync.db") or "Sync Logs" in rel_name:
+                continue
+            f = open(file_name, "rb")
+            files[rel_name] = f.read()
+            f.close()
+    return files
+
+
+def edit_sheet(package_path, old, new):
+    # Edits sheet in Ulysses library, with a new date as Ulysses would:
+    xml_file = package_path + "/Content.xml"
+    f = open(xml_file, encoding="utf-8")
+    xml_text = f.read()
+    f.close()
+    Ulib.write_file(xml_file, xml_text.replace(old, new, 1))
+    modified = os.path.getmtime(xml_file) + 10
+    os.utime(xml_file, (modified, modified))
+
+
+class ConverterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.flags = (Ulib.use_etree_converter, Ulib.use_md_tokenizer, Ulib.use_ref_table)
+        self.temp_path = tempfile.mkdtemp() + "/"
+
+    def tearDown(self):
+        (Ulib.use_etree_converter, Ulib.use_md_tokenizer, Ulib.use_ref_table) = self.flags
+        shutil.rmtree(self.temp_path)
+
+    def markdown_samples(self):
+        rnd = random.Random(1)
+        samples = list(sample_markdown)
+        for num in range(40):
+            media_id = "%032x" % num if num % 4 == 0 else ""
+            samples.append(bench_library.make_sheet_markdown(rnd, num, media_id))
+        return samples
+
+    def test_md_tokenizer_and_ref_table(self):
+        for md_text in self.markdown_samples():
+            results = []
+            for (use_md_tokenizer, use_ref_table) in [(False, False), (True, False),
+                                                      (False, True), (True, True)]:
+                Ulib.use_md_tokenizer = use_md_tokenizer
+                Ulib.use_ref_table = use_ref_table
+                results.append(Ulib.markdown_to_ulysses_xml(md_text, "", "", False))
+            self.assertEqual(results, [results[0]] * 4, md_text)
+
+    def test_etree_converter(self):
+        library_path = self.temp_path + "Library/"
+        bench_library.make_library(library_path, 60, 2)
+        (file_list, pc) = Ulib.list_all_files(library_path + "Groups-ulgroup/", "", 1, True)
+        packages = [line.split("\t")[0] for line in file_list.split("\n") if line]
+        # Numbering of footnotes, links and images goes on from sheet to sheet:
+        results = []
+        for (use_etree_converter, parsed) in [(False, False), (True, False), (True, True)]:
+            Ulib.use_etree_converter = use_etree_converter
+            ul2md = Ulib.UlyssesToMarkdown()
+            md_texts = []
+            for package_path in packages:
+                xml_doc = Ulib.ET.parse(package_path + "/Content.xml").getroot() if parsed else None
+                md_texts.append(ul2md.xml2markdown(package_path, xml_doc))
+            results.append(md_texts)
+        self.assertEqual(len(results[0]), len(packages))
+        self.assertEqual(results[1], results[0])
+        self.assertEqual(results[2], results[0])
+
+    def test_etree_converter_samples(self):
+        # Sample markdown, converted to Ulysses XML and back:
+        for md_text in self.markdown_samples():
+            package_path = self.temp_path + "%032x.ulysses" % len(md_text)
+            os.makedirs(package_path)
+            xml_text = Ulib.markdown_to_ulysses_xml(md_text, "", "", False)
+            Ulib.write_file(package_path + "/Content.xml", xml_text)
+            results = []
+            for use_etree_converter in (False, True):
+                Ulib.use_etree_converter = use_etree_converter
+                results.append(Ulib.UlyssesToMarkdown().xml2markdown(package_path))
+            self.assertEqual(results[1], results[0], md_text)
+            shutil.rmtree(package_path)
+#end_class ConverterTest
+
+
+class ExportTest(unittest.TestCase):
+    # Each sync writes a log sheet to the library, exported at the next sync (not compared).
+
+    def setUp(self):
+        self.flags = (Sync.incremental_export, Sync.export_workers)
+        Sync.export_workers = 1
+        self.temp_path = tempfile.mkdtemp() + "/"
+        self.library_path = self.temp_path + "Library/"
+        bench_library.make_library(self.library_path, 80, 3)
+        # Last sub group of first group moved to top level, for numbering across top level groups:
+        groups_path = self.library_path + "Groups-ulgroup/"
+        groups_plist = Ulib.read_plist(groups_path + "Info.ulgroup")
+        group_path = groups_path + groups_plist["childOrder"][0] + "/"
+        plist = Ulib.read_plist(group_path + "Info.ulgroup")
+        sub_group = plist["childOrder"].pop()
+        Ulib.write_plist(plist, group_path + "Info.ulgroup")
+        os.rename(group_path + sub_group, groups_path + sub_group)
+        groups_plist["childOrder"].append(sub_group)
+        Ulib.write_plist(groups_plist, groups_path + "Info.ulgroup")
+        self.top_group = groups_path + sub_group + "/"
+        # Synced until no more log sheets are written:
+        self.sync()
+        self.sync()
+
+    def tearDown(self):
+        (Sync.incremental_export, Sync.export_workers) = self.flags
+        shutil.rmtree(self.temp_path)
+
+    def sync(self, changed_library=None, name="Export"):
+        # Returns counts of sync metrics:
+        Sync.main(self.library_path, self.temp_path + name + "/", self.temp_path + name + "Joined/",
+                  None, False, changed_library)
+        return Ulib.metrics.reports[self.library_path]["totals"]
+
+    def full_export(self):
+        # Export of all sheets to new folders, as files and joined files of last sync should be:
+        Sync.incremental_export = False
+        name = "Full" + str(time.time()).replace(".", "")
+        self.sync(None, name)
+        Sync.incremental_export = self.flags[0]
+        self.assertEqual(read_tree(self.temp_path + "Export/"), read_tree(self.temp_path + name + "/"))
+        self.assertEqual(read_tree(self.temp_path + "ExportJoined/"),
+                         read_tree(self.temp_path + name + "Joined/"))
+
+    def sheets(self, group="Groups-ulgroup/", log_sheets=False):
+        (file_list, pc) = Ulib.list_all_files(self.library_path + group, "", 1, True)
+        return [line.split("\t")[0] for line in file_list.split("\n")
+                if line and (log_sheets or "Log - " not in line)]
+
+    def test_unchanged_sheets_reused(self):
+        counts = self.sync()
+        self.assertEqual(counts["sheets_converted"], 0)
+        self.assertEqual(counts["sheets_skipped"],
+                         len(self.sheets(log_sheets=True)) + len(self.sheets("Unfiled-ulgroup/")))
+        self.full_export()
+
+    def test_changed_sheet_converted(self):
+        edit_sheet(self.sheets()[5], "</p>", " Edited</p>")
+        counts = self.sync()
+        self.assertEqual(counts["sheets_converted"], 1)
+        self.full_export()
+
+    def test_numbering_shift(self):
+        # New footnote in a sheet: Following sheets with footnotes are numbered from one more.
+        sheets = self.sheets()
+        edit_sheet(sheets[len(sheets) // 2], "</p>", new_footnote + "</p>")
+        counts = self.sync()
+        self.assertGreater(counts["sheets_converted"], 1)
+        self.assertLess(counts["sheets_converted"], len(sheets))
+        self.full_export()
+
+    def test_export_file_deleted(self):
+        # File missing in export folder (deleted, e.g. by other sync) is exported again, not reused:
+        export_path = self.temp_path + "Export/"
+        md_file = [name for name in sorted(read_tree(export_path)) if name.endswith(".md")][3]
+        os.remove(export_path + md_file)
+        self.sync()
+        self.full_export()
+
+    def test_changed_groups_only(self):
+        # Watch mode: Only groups with changed files are listed and exported:
+        sheets = self.sheets()
+        edit_sheet(sheets[-1], "</p>", " Edited</p>")
+        counts = self.sync({sheets[-1] + "/Content.xml"})
+        # Only top level group with sheet is exported:
+        self.assertEqual(counts["sheets_converted"], 1)
+        self.assertEqual(counts["sheets_skipped"], len([sheet for sheet in sheets
+                                                         if sheet.startswith(self.top_group)]) - 1)
+        self.full_export()
+
+    def test_changed_groups_numbering_shift(self):
+        # New footnote in last sheet before last top level group, which is then exported too:
+        sheets = self.sheets()
+        last_sheet = [sheet for sheet in sheets if not sheet.startswith(self.top_group)][-1]
+        edit_sheet(last_sheet, "</p>", new_footnote + "</p>")
+        counts = self.sync({last_sheet + "/Content.xml"})
+        self.assertGreater(counts["sheets_converted"], 1)
+        self.full_export()
+
+    def test_changed_groups_sheet_deleted(self):
+        sheets = self.sheets()
+        (info_file, package) = Ulib.get_info_plist(sheets[1] + "/")
+        plist = Ulib.read_plist(info_file)
+        plist["sheetClusters"] = [cluster for cluster in plist["sheetClusters"]
+                                  if package not in cluster]
+        Ulib.write_plist(plist, info_file)
+        shutil.rmtree(sheets[1])
+        self.sync({info_file, sheets[1] + "/Content.xml"})
+        self.full_export()
+        self.assertFalse([name for name in read_tree(self.temp_path + "Export/")
+                          if re.search(os.path.basename(sheets[1])[:-8] + r"\.md$", name)])
+#end_class ExportTest
+
+
+class SnapshotTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_path = tempfile.mkdtemp() + "/"
+        self.backup = Ulib.SnapshotBackup(self.temp_path + "Backup/", "Library_")
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_path)
+
+    def make_snapshots(self, dates):
+        for date in dates:
+            os.makedirs(self.temp_path + "Backup/Library_" + date.replace(" ", "_").replace(":", "-"))
+
+    def kept_snapshots(self):
+        return [name[len("Library_"):] for name in sorted(os.listdir(self.temp_path + "Backup/"))]
+
+    def test_prune_snapshots(self):
+        self.make_snapshots(["2026-01-01 10:00:00", "2026-01-01 10:30:00", "2026-01-01 11:00:00",
+                             "2026-01-02 09:00:00", "2026-01-03 08:00:00", "2026-01-03 08:10:00"])
+        # Not snapshots, never deleted:
+        os.makedirs(self.temp_path + "Backup/Library_2026-01-01")
+        os.makedirs(self.temp_path + "Backup/Library_2026-01-01_09-00-00.partial")
+        deleted = self.backup.prune_snapshots({"hourly": 2, "daily": 3})
+        self.assertEqual(len(deleted), 3)
+        self.assertEqual(self.kept_snapshots(), ["2026-01-01", "2026-01-01_09-00-00.partial",
+                                                 "2026-01-01_11-00-00", "2026-01-02_09-00-00",
+                                                 "2026-01-03_08-10-00"])
+        self.backup.prune_snapshots({"daily": 1})
+        self.assertEqual(self.kept_snapshots(), ["2026-01-01", "2026-01-01_09-00-00.partial",
+                                                 "2026-01-03_08-10-00"])
+        # Newest snapshot is always kept:
+        self.backup.prune_snapshots({})
+        self.assertEqual(self.kept_snapshots()[-1], "2026-01-03_08-10-00")
+
+    def test_unchanged_files_linked(self):
+        from_path = self.temp_path + "Library/"
+        os.makedirs(from_path + "Group")
+        modified = 1767261600 * 10**9 + 100
+        for name in ("Group/same.txt", "Group/edited.txt"):
+            Ulib.write_file(from_path + name, "Text 1")
+            os.utime(from_path + name, ns=(modified, modified))
+        first = self.backup.make_snapshot(from_path)
+        # Older snapshot, as if made before "min_interval":
+        os.rename(first, self.temp_path + "Backup/Library_2026-01-01_10-00-00/")
+        first = self.temp_path + "Backup/Library_2026-01-01_10-00-00/"
+        # Same size, and same date in seconds:
+        Ulib.write_file(from_path + "Group/edited.txt", "Text 2")
+        os.utime(from_path + "Group/edited.txt", ns=(modified + 1000, modified + 1000))
+        second = self.backup.make_snapshot(from_path)
+        self.assertTrue(os.path.samefile(first + "Group/same.txt", second + "Group/same.txt"))
+        self.assertFalse(os.path.samefile(first + "Group/edited.txt", second + "Group/edited.txt"))
+        f = open(second + "Group/edited.txt")
+        self.assertEqual(f.read(), "Text 2")
+        f.close()
+        self.assertEqual((self.backup.linked, self.backup.copied), (1, 3))
+#end_class SnapshotTest
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -27,9 +27,8 @@
 # 2) New MD files, or sync-conflicts will be added as new sheets in Ulysses Inboxes.
 #    Markdown/ CriticMarkup is converted back to Ulysses Markdown XL-syntax and XML-format.
 
-# 3) Exports all sheets to temp folder, and then uses "rsync" to
-#    copy only files changed since last sync, to export folders.
-#    "rsync" also deletes md-files whose sheets have been deleted in Ulysses since last sync.
+# 3) Exports all sheets directly to export folders, writing only files changed since last sync.
+#    Then deletes md-files whose sheets have been deleted in Ulysses since last sync.
 #    If they have been changed in export folder, they will appear as new sheets in inbox.
 
 # 4) Any files deleted in export folders, will reappear at next sync.
@@ -53,24 +52,42 @@
 # Get "growlnotify" at:
 #    http://growl.cachefly.net/GrowlNotify-2.1.zip (relies on Growl v.2.1)
 
-import shutil
 import os
 import subprocess
 import datetime
+import time
 import re
+import sys
+import traceback
 import ulysses_sync_lib_1_0_2 as Ulib  # Main library for syncing, xml2md- and md2xml-conversions.
 
 make_marked_files = True  # If True: Make Marked-files on top and bottom group level.
 add_ul_uuid_to_export_filenames = True  # Have to be True to sync changes back to same Sheet
+incremental_export = True  # If True: Skip converting sheets not changed since last export.
+export_workers = 1  # Number of processes converting sheets on export. 0: One per CPU core.
+media_link_mode = "hardlink"  # Media-files in top level Media-folders: "hardlink", "symlink" or "copy".
+watch_mode = False  # If True: Keeps running, syncing when files change. (Or run script with: --watch)
+watch_debounce = 1.0  # Watch mode: Seconds without more changes, before syncing a burst of changes.
+watch_poll_interval = 2.0  # Watch mode: Seconds between scans, if inotify is not available.
+sync_in_parallel = True  # If True: Libraries are backed up and synced at the same time, one process each.
 
 # Users home folder:
 HOME = os.getenv("HOME", "") + "/"
 
-# Full rsync backup of Ulysses library (except Daedalus Touch):
-# (Max two backups kept for each day: AM and PM)
-# (Use Hazel or similar apps, for cleanup of old backups)
+# Snapshot backup of Ulysses library (except Daedalus Touch):
+# Files unchanged since last snapshot are hard links, so each snapshot only costs what changed.
+# Old snapshots are deleted by "backup_keep".
 backup_path = HOME + "Ulysses Backup/"
 # Backup is run before each sync.
+backup_snapshots = True  # If False: Full rsync backup, max. two kept each day: AM and PM (no cleanup)
+backup_link_mode = "hardlink"  # "reflink": Clone files (APFS, Btrfs, XFS), falls back to hard links.
+backup_keep = {"hourly": 24, "daily": 7, "weekly": 8, "monthly": 12}  # Snapshots kept per period.
+backup_min_interval = 300  # Min. seconds between snapshots, e.g. in watch mode. (0: Before each sync)
+
+# Metrics of each sync run, per library and phase: Time, sheets converted, skipped, imported,
+# conflicts, files and bytes read and written. E.g. to alert when sync runs slow down.
+metrics_json_file = ""  # One JSON line per library and run, e.g. HOME + "Ulysses Sync Metrics.jsonl". "": Off
+metrics_prometheus_file = ""  # Prometheus text format, e.g. for node_exporter textfile collector. "": Off
 
 # Here, all Ulysses sheets are exported as Markdown files,
 # in a folder structure same as original Ulysses groups:
@@ -81,32 +98,79 @@ sync_path_icloud = HOME + "Dropbox/Notebooks/My Writings/Ulysses iCloud Export/"
 # Here, all sheets under each top level group, are joined as single Markdown files:
 md_joined_path = HOME + "Ulysses MMD Joined_temp/"
 # Note "md_joined_path" is a "temporary" folder, and md-files here will be deleted
-# and regenerated each time this script is run.
+# or regenerated when sheets in their top level group have changed.
 # So, if you edit any of these files, please save them in a diferent folder!
 
 
-def copy_media(from_path, media_path, to_root):
-    # Copy media-files:
-    if not os.path.exists(media_path):
-        os.makedirs(media_path)
-    for media_file in os.listdir(from_path):
-        shutil.copy2(from_path + "/" + media_file, media_path)
+def export_media_file(from_file, to_file, export_folder, state):
+    # Copies media-file, unless unchanged since last export: Same size and date as in media index
+    # (in sync state), or same content hash if only file date has changed.
+    from_stat = os.stat(from_file)
+    source_mtime = int(from_stat.st_mtime)
+    media_hash = None
+    media = state.get_media(to_file)
+    if media is not None and os.path.exists(to_file):
+        if media["source_size"] == from_stat.st_size and media["source_mtime"] == source_mtime:
+            export_folder.keep(to_file)
+            state.keep_media(to_file)
+            return
+        media_hash = Ulib.get_file_hash(from_file)
+        if media["media_hash"] == media_hash:
+            export_folder.keep(to_file)
+            state.set_media(to_file, source_mtime, from_stat.st_size, media_hash)
+            return
+
+    export_folder.copy_file(from_file, to_file)
+    if media_hash is None:
+        media_hash = Ulib.get_file_hash(from_file)
+    state.set_media(to_file, source_mtime, from_stat.st_size, media_hash)
+
+
+def copy_media(from_path, media_path, to_root, export_folder, state):
+    # Copy media-files (Only new or changed files are copied), returns names of media-files:
+    media_files = os.listdir(from_path)
+    for media_file in media_files:
+        export_media_file(from_path + "/" + media_file, media_path + "/" + media_file,
+                          export_folder, state)
 
     if "/_Inbox/" in media_path:
         # Inbox has ony one level:
-        return
+        return media_files
 
     # Also Copy all media-files to common folder,
     # to get Marked to link media when using toplevel .marked-file.
     media_top_path = media_path.replace(to_root, "")
     media_top_path = to_root + media_top_path.split("/")[0] + "/Media"
-    if not os.path.exists(media_top_path):
-        os.makedirs(media_top_path)
-    for media_file in os.listdir(from_path):
-        shutil.copy2(from_path + "/" + media_file, media_top_path)
+    for media_file in media_files:
+        if media_link_mode == "copy":
+            export_media_file(from_path + "/" + media_file, media_top_path + "/" + media_file,
+                              export_folder, state)
+        else:
+            # Same file as copied above, linked instead of copied again:
+            export_folder.link_file(media_path + "/" + media_file, media_top_path + "/" + media_file,
+                                    media_link_mode == "symlink")
+    return media_files
 
 
 def backup_ulysses(from_path, backup_path, branch):
+    # Timed as phase "backup" of library "from_path" (reported at end of main):
+    Ulib.metrics.start(from_path, "backup")
+    if backup_snapshots:
+        snapshot = Ulib.SnapshotBackup(backup_path, branch + "_Library_", backup_link_mode == "reflink")
+        snapshot_path = snapshot.make_snapshot(from_path, backup_min_interval)
+        if snapshot_path is not None:
+            print("=================================================================================")
+            print("*** SNAPSHOT BACKUP TO:", snapshot_path)
+            print("*** Files linked: %d, cloned: %d, copied: %d (%.1f MB)" % (
+                snapshot.linked, snapshot.cloned, snapshot.copied, snapshot.copied_bytes / 1e6))
+            Ulib.metrics.count("files_written", snapshot.cloned + snapshot.copied)
+            Ulib.metrics.count("bytes_written", snapshot.copied_bytes)
+            for deleted_path in snapshot.prune_snapshots(backup_keep):
+                print("*** Deleted old snapshot:", deleted_path)
+            print()
+        Ulib.metrics.stop()
+        return
+
     # date_time = datetime.datetime.now().strftime("%Y-%m-%d_%H")  # Hourly cycle
     date_time = datetime.datetime.now().strftime("%Y-%m-%d_%p")  # Twice a day cycle (AM / PM)
     # date_time = datetime.datetime.now().strftime("%Y-%m-%d")  # Daily cycle
@@ -121,102 +185,193 @@ def backup_ulysses(from_path, backup_path, branch):
     subprocess.call(['rsync', '-t', '-r', from_path, backup_path])
     print("*** End Backup")
     print()
+    Ulib.metrics.stop()
 
 
-def export_files(file_list, sync_temp, md_joined_path, last_synced, log, sync_path):
+def export_files(file_list, export_folder, joined_files, log, sync_path, state, pool=None,
+                 sheet_cache=None, only_groups=None):
+    # Files are written to "sync_path" by "export_folder" (Ulib.ExportFolder), only if changed.
+    # Joined markdown files for top level groups are written by "joined_files" (Ulib.JoinedFiles).
+    # Exported sheets are saved to sync state "state" (Ulib.SyncState), one row per sheet.
+    # pool: Worker processes to convert sheets in parallel, or None to convert one by one.
+    # sheet_cache: Sheets already parsed by "list_all_files" (Ulib.SheetCache), or None.
+    # only_groups: Top level groups to export (e.g. "01 - Group/"), or None for all groups.
+    # Returns top level groups exported.
 
     marked_text_top = ""
     marked_text_bottom = ""
     marked_top_modified = 0
     marked_bottom_modified = 0
+    # Marked-files are written at end, once each. (Top and bottom marked-file
+    # of a top level group have the same name, then the last one made is written)
+    marked_files = {}
 
     last_group_path = ""
     last_path = ""
-    md_main_text = ""
+    export_group = True
+    last_exported = True
+    exported_groups = set()
+    synced_ts = time.time()
+    last_synced = state.get_last_synced()
     ul2md = Ulib.UlyssesToMarkdown()
 
-    for line in file_list.split("\n"):
-        if line == "":
-            continue
+    sheet_lines = [line for line in file_list.split("\n") if line != ""]
+
+    converter = None
+    if pool is not None:
+        # Sheets changed since last export, to be converted ahead in worker processes:
+        sheet_paths = []
+        convert_paths = set()
+        for line in sheet_lines:
+            columns = line.split("\t")
+            sheet_paths.append(columns[0])
+            sheet = state.get_sheet(os.path.basename(columns[0])[:-8])
+            if not incremental_export or sheet is None or sheet["package_mtime"] != columns[1]:
+                convert_paths.add(columns[0])
+        converter = Ulib.ParallelConverter(pool, export_workers or os.cpu_count(),
+                                           sheet_paths, convert_paths)
+
+    for (pos, line) in enumerate(sheet_lines):
+        if converter is not None:
+            converter.submit_ahead(pos)
         columns = line.split("\t")
         from_path = columns[0]
         modified = columns[1]
         to_path = columns[2]
         to_file = columns[3]
 
-        to_full_path = sync_temp + to_path
-
-        if not os.path.exists(to_full_path):
-            os.makedirs(to_full_path)
-
-        md_text = ul2md.xml2markdown(from_path)
-
-        if os.path.exists(from_path + "/Media"):
-            media_path = to_full_path + "Media"
-            copy_media(from_path + "/Media", media_path, sync_temp)
-
-            for media_file in os.listdir(media_path):
-                # print(from_path, media_file)
-                try:
-                    media_ref = media_file.split(".")[-2]
-                    media_file = media_file.replace(" ", "%20")
-                    # print(media_ref, media_file)
-                    md_text = md_text.replace(media_ref + ".#fileref", media_file)
-                except:
-                    pass
-
+        to_full_path = sync_path + to_path
         to_file_full = to_path + to_file + ".md"
 
-        ts_modified = Ulib.write_file_modified(sync_temp + to_file_full, md_text, modified)
+        # Parsed sheet is released here, whether converted or reused:
+        xml_doc = sheet_cache.pop(from_path) if sheet_cache is not None else None
+
+        sub_paths = to_path.split("/")
+        group_path = sub_paths[0] + "/"
 
-        # Check only to making log entries for exported files:
-        if ts_modified > last_synced:
+        if only_groups is not None and group_path != last_group_path:
+            # Top level group not in "only_groups" is exported only if numbering of its footnotes,
+            # links and images starts from other counts than at last export (previous group changed):
+            first_sheet = state.get_sheet(os.path.basename(from_path)[:-8])
+            last_exported = export_group
+            export_group = group_path in only_groups or (last_exported and (
+                first_sheet is None or state.get_numbering(first_sheet)[0] != ul2md.get_counters()))
+            if export_group and not last_exported and pos > 0:
+                # Numbering continues from last sheet of previous group, as at last export:
+                last_sheet = state.get_sheet(os.path.basename(sheet_lines[pos - 1].split("\t")[0])[:-8])
+                if last_sheet is not None:
+                    ul2md.set_counters(state.get_numbering(last_sheet)[1])
+
+        if export_group:
+            exported_groups.add(group_path)
+            ul_uuid = os.path.basename(from_path)[:-8]
+            sheet = state.get_sheet(ul_uuid)
+            sheet_changed = sheet is None or sheet["package_mtime"] != modified
+
+            # Incremental export: Reuse file from last export, if sheet is unchanged since then,
+            # and footnotes, links and images are numbered from the same count as last time:
+            start_counters = ul2md.get_counters()
+            reuse_export = False
+            if incremental_export and not sheet_changed:
+                numbering = state.get_numbering(sheet)
+                reuse_export = numbering[0] == start_counters \
+                    and int(Ulib.get_file_date(sheet["export_path"])) == sheet["exported_mtime"]
+
+            if reuse_export:
+                # Not read, only by joined file if its group has changed:
+                md_text = None
+                Ulib.metrics.count("sheets_skipped")
+                content_hash = sheet["content_hash"]
+                package_hash = sheet["package_hash"]
+                ul2md.set_counters(numbering[1])
+                if converter is not None:
+                    converter.discard(pos)
+            elif converter is not None:
+                md_text = converter.xml2markdown(ul2md, pos)
+            else:
+                if xml_doc is None:
+                    Ulib.metrics.count("sheets_parsed")
+                md_text = ul2md.xml2markdown(from_path, xml_doc)
+            if not reuse_export:
+                Ulib.metrics.count("sheets_converted")
+                Ulib.metrics.count("bytes_read", Ulib.get_file_size(from_path + "/Content.xml"))
+
+            if os.path.exists(from_path + "/Media"):
+                media_path = to_full_path + "Media"
+                media_files = copy_media(from_path + "/Media", media_path, sync_path, export_folder, state)
+
+                # Media references are already resolved in reused files:
+                if not reuse_export:
+                    md_text = Ulib.resolve_media_refs(md_text, Ulib.get_media_map(media_files))
+
+            # Date of file in export folder before this export, for log entries below:
             dest_file = sync_path + to_file_full
             dest_modified = Ulib.get_file_date(dest_file)
-            if ts_modified > dest_modified:
-                if "_Inbox" in sync_temp:
-                    file_name = "_Inbox/" + to_file
+
+            if reuse_export:
+                # Same file and date as already exported, copied only if sheet moved to other group:
+                if sheet["export_path"] == dest_file:
+                    export_folder.keep(dest_file)
                 else:
-                    file_name = to_path + to_file
-                modified_date = datetime.datetime.\
-                    fromtimestamp(ts_modified).strftime("%Y-%m-%d %H:%M:%S")
-                # file_name = re.sub(r"/\d\d - ", r"/", file_name)
-                file_name = re.sub(r" - [0-9a-f]{32}$", r"", file_name)
-                # Ulib.debug(190, file_name)
-                log.add_line("Sheet edited at: ", modified_date, file_name, " - Exported to:")
+                    export_folder.copy_file(sheet["export_path"], dest_file)
+                ts_modified = sheet["exported_mtime"]
+            else:
+                ts_modified = export_folder.write_file(dest_file, md_text, modified)
+                content_hash = Ulib.get_text_hash(md_text)
+                # To tell sheets edited in Ulysses from sheets only touched, at next sync:
+                package_hash = Ulib.get_file_hash(from_path + "/Content.xml")
+
+            state.set_exported(ul_uuid, from_path, modified, dest_file, ts_modified,
+                               content_hash, (start_counters, ul2md.get_counters()), synced_ts,
+                               package_hash)
+
+            # Check only to making log entries for exported files:
+            if sheet_changed and ts_modified > last_synced:
+                if ts_modified > dest_modified:
+                    if "_Inbox" in sync_path:
+                        file_name = "_Inbox/" + to_file
+                    else:
+                        file_name = to_path + to_file
+                    modified_date = datetime.datetime.\
+                        fromtimestamp(ts_modified).strftime("%Y-%m-%d %H:%M:%S")
+                    # file_name = re.sub(r"/\d\d - ", r"/", file_name)
+                    file_name = re.sub(r" - [0-9a-f]{32}$", r"", file_name)
+                    # Ulib.debug(190, file_name)
+                    log.add_line("Sheet edited at: ", modified_date, file_name, " - Exported to:")
+        elif group_path != last_group_path and last_exported:
+            # Date of first sheet after last group exported, is part of date of its marked-files:
+            ts_modified = first_sheet["exported_mtime"] if first_sheet is not None else 0
+        else:
+            ts_modified = 0
 
         if ts_modified > marked_top_modified:
             marked_top_modified = ts_modified
         if ts_modified > marked_bottom_modified:
             marked_bottom_modified = ts_modified
 
-        sub_paths = to_path.split("/")
-        group_path = sub_paths[0] + "/"
-
         # make marked-file for top groups:
         if group_path != last_group_path and last_group_path != "":
             if make_marked_files:
-                marked_file = sync_temp + last_group_path + "_" + last_group_path[5:-1] + ".marked"
-                Ulib.write_file_modified(marked_file, marked_text_top, marked_top_modified)
+                marked_file = sync_path + last_group_path + "_" + last_group_path[5:-1] + ".marked"
+                marked_files[marked_file] = (marked_text_top, marked_top_modified)
                 marked_text_top = ""
                 marked_top_modified = 0
 
-            # Complete Markdown file for top level group:
-            Ulib.write_file(md_joined_path + last_group_path[:-1] + ".md", md_main_text)
-            md_main_text = ""
-
         # make marked-file for bottom groups:
         if to_path != last_path and last_path != "":
             sub_paths = last_path.split("/")
-            pos = len(sub_paths) - 2
+            group_pos = len(sub_paths) - 2
             if make_marked_files:
-                marked_file = sync_temp + last_path + "_" + sub_paths[pos][5:] + ".marked"
-                Ulib.write_file_modified(marked_file, marked_text_bottom, marked_bottom_modified)
+                marked_file = sync_path + last_path + "_" + sub_paths[group_pos][5:] + ".marked"
+                marked_files[marked_file] = (marked_text_bottom, marked_bottom_modified)
                 marked_bottom_modified = 0
                 marked_text_bottom = ""
 
         comment = ""  # "{>>@: " + to_file_full + "<<}\n"
-        md_main_text += comment + md_text.rstrip() + "\n\n\n"
+        # Complete Markdown file for top level group:
+        if export_group:
+            joined_files.add_sheet(joined_files.path + group_path[:-1] + ".md",
+                                   None if md_text is None else comment + md_text, content_hash, dest_file)
 
         to_file_first = to_file_full.replace(group_path, "")
         marked_text_top += "<<[" + to_file_first + "]\n"
@@ -224,47 +379,48 @@ def export_files(file_list, sync_temp, md_joined_path, last_synced, log, sync_pa
 
         last_group_path = group_path
         last_path = to_path
-    # endfor line in file_list.split("\n")
+    # endfor line in sheet_lines
 
     # Write leftovers after end of for loop:
     if make_marked_files:
         if marked_text_top != "":
-            marked_file = sync_temp + last_group_path + "_" + last_group_path[5:-1] + ".marked"
-            Ulib.write_file_modified(marked_file, marked_text_top, marked_top_modified)
+            marked_file = sync_path + last_group_path + "_" + last_group_path[5:-1] + ".marked"
+            marked_files[marked_file] = (marked_text_top, marked_top_modified)
 
         if marked_text_bottom != "":
             sub_paths = last_path.split("/")
-            pos = len(sub_paths) - 2
-            marked_file = sync_temp + last_path + "_" + sub_paths[pos][5:] + ".marked"
-            Ulib.write_file_modified(marked_file, marked_text_bottom, marked_bottom_modified)
-    if md_main_text != "":
-        Ulib.write_file(md_joined_path + last_group_path[:-1] + ".md", md_main_text)
+            group_pos = len(sub_paths) - 2
+            marked_file = sync_path + last_path + "_" + sub_paths[group_pos][5:] + ".marked"
+            marked_files[marked_file] = (marked_text_bottom, marked_bottom_modified)
+    joined_files.close_file()
+
+    for (marked_file, (marked_text, marked_modified)) in marked_files.items():
+        if marked_file[len(sync_path):].split("/")[0] + "/" in exported_groups:
+            export_folder.write_file(marked_file, marked_text, marked_modified)
 
-    return
+    state.commit()
+    return exported_groups
 #end_def export_files
 
 
-def main(ulysses_path, sync_path, md_joined_path):
+def main(ulysses_path, sync_path, md_joined_path, changed_files=None, in_worker=False,
+         changed_library=None):
+    # changed_files: Only these files in export folder are synced back to Ulysses, if given.
+    # in_worker: Run in worker process of "sync_libraries", which writes Prometheus file after all.
+    # changed_library: Only sheets and groups with these files changed in Ulysses library
+    #                  are listed and exported, if given (watch mode). None: All sheets.
     print()
     print("==============================================================================")
     print("Exporting files ...")
     print("From:", ulysses_path)
     print(" --> ", sync_path)
     print()
-
-    # WARNING! DO NOT CHANGE THIS FOLDER/ PATH:
-    sync_temp = HOME + ".ulysses_temp/"
+    metrics = Ulib.metrics
 
     ulgroup_path = ulysses_path + "Groups-ulgroup/"
     file_list = ""
-    last_synced = 0
-
-    if os.path.exists(md_joined_path):
-        if md_joined_path != HOME and md_joined_path + "/" != HOME \
-                and "." not in md_joined_path:
-            # Make sure md_joined_path is not HOME path!!!
-            # We don't want to delete all users files by mistake!!!
-            shutil.rmtree(md_joined_path)
+
+    # Joined files are only written for changed top level groups:
     if not os.path.exists(md_joined_path):
         os.makedirs(md_joined_path)
 
@@ -273,21 +429,65 @@ def main(ulysses_path, sync_path, md_joined_path):
     # log = Ulib.LogFileSheet(inbox_path, sync_date)
     log = Ulib.LogFileSheet(ulgroup_path, sync_date)
 
+    # Sync state with one row per sheet, kept in export folder:
+    sync_db = sync_path + ".ulysses_sync.db"
+
     if os.path.exists(sync_path):
-        sync_file = sync_path + ".ulysses_sync.log"
-        last_synced = Ulib.get_file_date(sync_file)
+        state = Ulib.SyncState(sync_db)
         # Syncs markdown files changed since last sync,
         # back to corresponding sheets MardownXL and XML in Ulysses library:
         log.add_entry("**Markdown to Ulysses Sync:**")
-        Ulib.sync_files(sync_path, ulysses_path, log)
+        metrics.start(ulysses_path, "import")
+        try:
+            Ulib.sync_files(sync_path, ulysses_path, log, state, changed_files)
+        finally:
+            # New sheets are listed in group plists, even if import failed:
+            Ulib.plist_updates.flush()
     else:
         os.makedirs(sync_path)
-
-    # Generate file list to be used by "export_files" below:
-    (file_list, pc) = Ulib.list_all_files(ulysses_path + "Groups-ulgroup/", "", 1,
-                                          add_ul_uuid_to_export_filenames)
-
-    # Exports all files in Library ulysses_path to temp path: sync_temp
+        state = Ulib.SyncState(sync_db)
+
+    # Watch mode: Only groups with changed plists or sheets are listed again, and their
+    # top level groups exported, if groups are the same as at last sync. Otherwise all files.
+    roots = [("Groups-ulgroup/", sync_path), ("Unfiled-ulgroup/", sync_path + "_Inbox/")]
+    listings = None  # Root: (groups, positions of groups listed again)
+    removed_sheets = set()
+    if changed_library is not None:
+        metrics.start(ulysses_path, "list")
+        listings = {}
+        changed_library = set(changed_library) | Ulib.library_writes
+        for (root, export_path) in roots:
+            groups = state.get_listed_groups(root)
+            update = None
+            if groups is not None:
+                update = Ulib.update_groups(groups, changed_library, add_ul_uuid_to_export_filenames)
+            if update is not None:
+                # Top level groups left without sheets are deleted by a full sync,
+                # and so are sheets in "Groups-ulgroup" itself (exported to top of export folder):
+                top_groups = set(groups[pos]["out_path"].split("/")[0] for pos in update[0])
+                if not top_groups <= set(group["out_path"].split("/")[0] for group in groups
+                                         if group["sheets"]) \
+                        or (export_path == sync_path and "" in top_groups):
+                    update = None
+            if update is None:
+                listings = None
+                break
+            listings[root] = (groups, update[0])
+            removed_sheets |= update[1]
+
+    Ulib.library_writes.clear()
+
+    # Worker processes for converting sheets in parallel (not for only a few changed sheets):
+    pool = None
+    if export_workers != 1 and listings is None:
+        pool = Ulib.ProcessPoolExecutor(export_workers or None)
+
+    # Sheets parsed once, when listing files, and released when exported.
+    # (Worker processes parse sheets themselves)
+    sheet_cache = Ulib.SheetCache() if pool is None else None
+
+    # Exports all files in Library ulysses_path directly to export path: sync_path
+    # (Sync state database is excluded, otherwise it would be deleted as not exported)
     # and also makes complete joined MD files for each Top Level Group to: md_joined_path
     # Ulysses Markdown XL is converted to MultiMarkdown with CriticsMarkup or
     # to plain Markdown combined with HTML comment-tags or span-tags. Set flag in lib-file
@@ -295,46 +495,211 @@ def main(ulysses_path, sync_path, md_joined_path):
     log.add_entry("**Ulysses to Markdown Export:**")
     log.line_count = 0
 
-    export_files(file_list, sync_temp, md_joined_path, last_synced, log, sync_path)
-
-    # To include Default group (Unfiled-ulgroup or Inbox):
-    (file_list, pc) = Ulib.list_all_files(ulysses_path + "Unfiled-ulgroup/", "", 1,
-                                          add_ul_uuid_to_export_filenames)
-    export_files(file_list, sync_temp + "_Inbox/", md_joined_path, last_synced,
-                 log, sync_path + "_Inbox/")
-
-    # Use rsync to copy files changed since last sync to export path: sync_path,
-    # and deletes files if sheet have been deleted in Ulysses.
-    subprocess.call(['rsync', '-t', '-r', '--delete', '--progress', sync_temp, sync_path])
-
-    # sync_file must be written here after rsync, otherwise rsync will delete the file.
-    sync_file = sync_path + ".ulysses_sync.log"
-    Ulib.write_file(sync_file, file_list)
-
+    # Files are written in a thread, while next sheets are converted
+    # (Not with worker processes, which converts ahead already):
+    export_folder = Ulib.ExportFolder(sync_path, [".ulysses_sync.db*"],
+                                      Ulib.io_queue_size if pool is None else 0)
+    joined_files = Ulib.JoinedFiles(md_joined_path, state, export_folder)
+    exported_folders = []
+
+    # Default group (Unfiled-ulgroup or Inbox) is exported to "_Inbox/":
+    for (root, export_path) in roots:
+        # Generate file list to be used by "export_files" below:
+        metrics.start(ulysses_path, "list")
+        only_groups = None
+        if listings is None:
+            groups = []
+            (file_list, pc) = Ulib.list_all_files(ulysses_path + root, "", 1,
+                                                  add_ul_uuid_to_export_filenames, 0, sheet_cache, groups)
+            state.set_listed_groups(root, groups)
+        else:
+            (groups, positions) = listings[root]
+            # Sheets changed since last listing are parsed again, when exported:
+            file_list = "".join(Ulib.get_group_lines(group) for group in groups)
+            only_groups = set(groups[pos]["out_path"].split("/")[0] + "/" for pos in positions)
+            state.set_listed_groups(root, groups, positions)
+
+        metrics.start(ulysses_path, "export")
+        exported_groups = export_files(file_list, export_folder, joined_files, log, export_path, state,
+                                       pool, sheet_cache, only_groups)
+        exported_folders += [os.path.normpath(export_path + group_path) for group_path in exported_groups]
+
+    if pool is not None:
+        pool.shutdown()
+    export_folder.close()
+
+    # Deletes files in export path, if sheet have been deleted in Ulysses.
+    metrics.start(ulysses_path, "delete")
+    if listings is not None:
+        # Only in folders of top level groups exported (all their sheets were exported):
+        for folder in exported_folders:
+            if os.path.isdir(folder):
+                export_folder.delete_orphans(folder)
+        for package_path in removed_sheets:
+            ul_uuid = os.path.basename(package_path)[:-8]
+            if ul_uuid not in state.exported_uuids:
+                state.remove_sheet(ul_uuid)
     # Extra check, just to make sure nothing bad happens:
-    if sync_temp == HOME or sync_temp.endswith(".") \
-            or sync_temp.strip() == "" or sync_temp.strip() == "/":
-        print("*** Warning BAD temp-folder name:", sync_temp)
-        print("*** Program aborted! Fix it in line 261!!")
+    elif sync_path == HOME or sync_path.endswith(".") \
+            or sync_path.strip() == "" or sync_path.strip() == "/":
+        print("*** Warning BAD export-folder name:", sync_path)
+        print("*** Program aborted! No files deleted in export folder!!")
         quit()
     else:
-        shutil.rmtree(sync_temp)
+        export_folder.delete_orphans()
+
+    # Deletes joined files of deleted top level groups.
+    # Make sure md_joined_path is not HOME path!!!
+    # We don't want to delete all users files by mistake!!!
+    if listings is None and md_joined_path != HOME and md_joined_path + "/" != HOME \
+            and "." not in md_joined_path:
+        joined_files.delete_others()
 
     print()
     print("Export Done to: " + sync_path)
+    metrics.start(ulysses_path, "log")
     log.write_log_sheet(False)
 
+    # Sync completed, written after log sheet, which is exported at next sync:
+    if listings is None:
+        state.remove_unexported_sheets()
+    state.set_last_synced(time.time())
+    state.close()
+
+    report = metrics.finish(ulysses_path)
+    report["sync_path"] = sync_path
+    print("Sync metrics:", metrics.get_summary(report))
+    if metrics_json_file != "":
+        metrics.write_json(report, metrics_json_file)
+    if metrics_prometheus_file != "" and not in_worker:
+        metrics.write_prometheus(metrics_prometheus_file)
+
     return log.get_md_log()
 
-#end_def main(ulysses_path, sync_path):
+#end_def main(ulysses_path, sync_path, md_joined_path, changed_files=None, in_worker=False, changed_library=None)
+
+
+def sync_library(library, changed_files=None, in_worker=False, changed_library=None):
+    # Backup and sync of one library, also in a worker process of "sync_libraries" ("in_worker").
+    # Returns log, metrics report, and notifications (sent by "sync_libraries") of the library:
+    (branch, ulysses_path, sync_path, joined_path) = library
+    backup_ulysses(ulysses_path, backup_path, branch)
+    md_log = main(ulysses_path, sync_path, joined_path, changed_files, in_worker, changed_library)
+    return (md_log, Ulib.metrics.reports[ulysses_path], Ulib.notifications.take())
+
+
+def sync_libraries(libraries, changed_files=None):
+    # libraries: List of (branch, ulysses_path, sync_path, md_joined_path).
+    # changed_files: Changed files in Ulysses libraries and export folders (by watch mode).
+    #                Only libraries with changes are synced. None: Syncs all libraries.
+    # Libraries share no files (own export folder, sync state, joined files and backups),
+    # so with "sync_in_parallel" they are synced at the same time, each in its own process.
+    # Logs, metrics and notifications are merged at end.
+    lib_changes = {}  # Branch: (Changed files in export folder, and in Ulysses library)
+    for (branch, ulysses_path, sync_path, joined_path) in libraries:
+        if changed_files is None:
+            lib_changes[branch] = (None, None)
+        else:
+            changes = set(path for path in changed_files
+                          if path.startswith(ulysses_path) or path.startswith(sync_path))
+            if changes:
+                lib_changes[branch] = (set(path for path in changes if path.startswith(sync_path)),
+                                       set(path for path in changes if path.startswith(ulysses_path)))
+    if not lib_changes:
+        return
+    sync_list = [library for library in libraries if library[0] in lib_changes]
+
+    # Never overlap with another sync, e.g. watch mode and a manual run:
+    lock = Ulib.SyncLock(HOME + ".ulysses_sync.lock")
+    lock.acquire()
+    try:
+        # (Not with a single CPU core, where processes would only compete)
+        if sync_in_parallel and len(sync_list) > 1 and (os.cpu_count() or 1) > 1:
+            pool = Ulib.ProcessPoolExecutor(len(sync_list))
+            try:
+                futures = [pool.submit(sync_library, library, lib_changes[library[0]][0], True,
+                                       lib_changes[library[0]][1])
+                           for library in sync_list]
+                results = [future.result() for future in futures]
+            finally:
+                pool.shutdown()
+            # Metrics of worker processes (Prometheus file is written here only, for all libraries):
+            for (library, (md_log, report, messages)) in zip(sync_list, results):
+                Ulib.metrics.reports[library[1]] = report
+            if metrics_prometheus_file != "":
+                Ulib.metrics.write_prometheus(metrics_prometheus_file)
+        else:
+            results = [sync_library(library, lib_changes[library[0]][0], False, lib_changes[library[0]][1])
+                       for library in sync_list]
+    finally:
+        lock.release()
+
+    main_log = ""
+    for ((branch, ulysses_path, sync_path, joined_path), (md_log, report, messages)) \
+            in zip(sync_list, results):
+        if main_log != "":
+            main_log += "\n"
+        main_log += "Synced from: " + sync_path + "\n"
+        main_log += md_log
+
+    # print()
+    print()
+    print("==============================================================================")
+    print(str(main_log.encode("utf-8")).replace("\\n", "\n")[2:-1].replace("\\xe2\\x80\\xa8", "\t"))
+    print("==============================================================================")
+    for ((branch, ulysses_path, sync_path, joined_path), (md_log, report, messages)) \
+            in zip(sync_list, results):
+        print("Sync metrics, " + branch + ":", Ulib.metrics.get_summary(report))
+        Ulib.notifications.messages += messages
+    # One notification for all libraries, sent in a thread:
+    Ulib.notifications.flush()
+    # Ulib.notify("Ulysses sync completed")
+    # print("==============================================================================")
+#end_def sync_libraries(libraries, changed_files=None)
+
+
+def watch_sync(libraries, changed_files=None):
+    # Sync in watch mode: Errors are printed and notified, and watching goes on.
+    # Returns False if sync failed:
+    try:
+        sync_libraries(libraries, changed_files)
+        return True
+    except Exception as error:
+        traceback.print_exc()
+        Ulib.notify("SYNC FAILED: " + str(error))
+        Ulib.notifications.flush()
+        return False
+
+
+def watch_libraries(libraries):
+    # Watch mode: Syncs all libraries once, and then only libraries with changed files,
+    # about "watch_debounce" seconds after last change. Runs until stopped with Ctrl-C.
+    # After a failed sync, next sync is of all libraries (changes may be left unsynced).
+    synced = watch_sync(libraries)
+
+    watch_paths = []
+    for (branch, ulysses_path, sync_path, joined_path) in libraries:
+        watch_paths += [ulysses_path + "Groups-ulgroup/", ulysses_path + "Unfiled-ulgroup/",
+                        sync_path]
+    watcher = Ulib.FolderWatcher(watch_paths, watch_poll_interval)
+    print("Watching for changes (" + watcher.kind + "), stop with Ctrl-C ...")
+    try:
+        while True:
+            # Files written by sync itself are seen as changes too,
+            # but are skipped at next sync, since they are unchanged since export.
+            changed_files = watcher.wait_changes(watch_debounce)
+            synced = watch_sync(libraries, changed_files if synced else None)
+    except KeyboardInterrupt:
+        print("Watch mode stopped")
+    finally:
+        watcher.close()
+#end_def watch_libraries(libraries)
 
 
 # ================
 # = Main Script =
 # ================
 
-main_log = ""
-
 HOME = os.getenv("HOME", "") + "/"
 
 ulysses_path_mac = HOME + "Library/Containers/com.soulmen.ulysses3/Data/"\
@@ -344,22 +709,14 @@ ulysses_path_icloud = HOME + "Library/Mobile Documents/X5AZV975AG~com~soulmen~ul
 ulysses_path_demo = HOME + "Library/Containers/com.soulmen.ulysses3.demo/Data/"\
     + "Documents/Library/"
 
-backup_ulysses(ulysses_path_mac, backup_path, "On My Mac")
-backup_ulysses(ulysses_path_icloud, backup_path, "iCloud")
+# Guarded, since worker processes of "export_files" may import this script:
+if __name__ == "__main__":
+    libraries = [("On My Mac", ulysses_path_mac, sync_path_mac, md_joined_path + "On My Mac/"),
+                 ("iCloud", ulysses_path_icloud, sync_path_icloud, md_joined_path + "iCloud/")]
+    # libraries.append(("Demo", ulysses_path_demo, sync_path_demo, md_joined_path + "Demo/"))
 
-main_log += "Synced from: " + sync_path_mac + "\n"
-main_log += main(ulysses_path_mac, sync_path_mac, md_joined_path + "On My Mac/")
-
-main_log += "\nSynced from: " + sync_path_icloud + "\n"
-main_log += main(ulysses_path_icloud, sync_path_icloud, md_joined_path + "iCloud/")
-
-# main_log += "\nSynced from: " + sync_path_demo + "\n"
-# main_log += main(ulysses_path_demo, sync_path_demo, md_joined_path + "Demo/")
-
-# print()
-print()
-print("==============================================================================")
-print(str(main_log.encode("utf-8")).replace("\\n", "\n")[2:-1].replace("\\xe2\\x80\\xa8", "\t"))
-print("==============================================================================")
-# Ulib.notify("Ulysses sync completed")
-# print("==============================================================================")
+    if watch_mode or "--watch" in sys.argv:
+        watch_libraries(libraries)
+    else:
+        sync_libraries(libraries)
+    Ulib.notifications.wait()
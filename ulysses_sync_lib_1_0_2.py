@@ -16,6 +16,22 @@ import uuid
 import subprocess
 import plistlib
 import shutil
+import stat
+import sqlite3
+import hashlib
+import json
+import fnmatch
+import bisect
+import sys
+import time
+import select
+import struct
+import fcntl
+import ctypes
+import ctypes.util
+import queue
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 # Users home folder:
 HOME = os.getenv("HOME", "") + "/"
@@ -38,6 +54,28 @@ else:
     mark_start = "<span class='mark'>"
     mark_end = "</span>"
 
+use_etree_converter = True  # Converts sheets using ElementTree only. Same output, but faster.
+                            # False: Converts using minidom, as in earlier versions.
+
+use_md_tokenizer = True  # Converts markdown to Ulysses XML on sync, scanning for markup with str.find().
+                         # Same output, but linear time. False: Regular expressions, as in earlier versions.
+
+use_ref_table = True  # Sync resolves footnote, link and image references in one re.sub() pass each,
+                      # from a table of parsed references. False: str.replace() per reference, as before.
+
+sheet_cache_size = 1000  # Max. number of sheets kept parsed, from listing files until export.
+
+io_queue_size = 16  # Max. sheets read ahead (listing), and files waiting to be written (export), in threads,
+                    # so reading and writing (e.g. iCloud, Dropbox) overlaps conversion. 0: No threads.
+
+scan_skip_unchanged_folders = False  # If True: Sync import skips folders with same date as last sync.
+                                     # Faster, but misses md-files edited in place (not saved by rename).
+
+# Notifications are sent as one summary at end of sync run, by "notify_backend":
+# "terminal-notifier" (or "growlnotify" if missing) in a thread, "console": Printed (e.g. headless Linux),
+# or "none".
+notify_backend = "terminal-notifier" if sys.platform == "darwin" else "console"
+
 # Unicode manual line-break used by Ulysses:
 LINE_BREAK = u"\u2028"
 
@@ -56,6 +94,11 @@ def debug(line_num, msg, output=True, stop=True):
 
 
 def notify(message):
+    # Queued, and sent with other notifications of sync run, by "notifications.flush()":
+    notifications.add(message)
+
+
+def send_notification(message):
     title = "Ulysses Markdown Export Sync"
 
     try:
@@ -75,11 +118,59 @@ def notify(message):
                              '-m', message])
         except:
             print('* "growlnotify" is missing!')
-
-    print("* Message:", str(message.encode("utf-8")))
     return
 
 
+class Notifications:
+    # Notifications queued during sync run, sent as one summary by flush() (by "notify_backend"),
+    # so sync never waits for a notification tool. Each message is printed when queued.
+    max_messages = 10  # Messages in summary, the rest are counted
+
+    def __init__(self):
+        self.messages = []
+        self.threads = []
+
+    def add(self, message):
+        self.messages.append(message)
+        print("* Message:", str(message.encode("utf-8")))
+
+    def take(self):
+        # Returns queued messages, and clears queue (e.g. to be sent by another process):
+        (messages, self.messages) = (self.messages, [])
+        return messages
+
+    def get_summary(self, messages):
+        if len(messages) == 1:
+            return messages[0]
+        summary = str(len(messages)) + " notifications:\n" + "\n".join(messages[:self.max_messages])
+        if len(messages) > self.max_messages:
+            summary += "\n... and " + str(len(messages) - self.max_messages) + " more"
+        return summary
+
+    def flush(self):
+        messages = self.take()
+        if not messages or notify_backend == "none":
+            return
+        summary = self.get_summary(messages)
+        if notify_backend == "console":
+            print("* Notification:", str(summary.encode("utf-8"))[2:-1].replace("\\n", "\n"))
+            return
+        self.threads = [thread for thread in self.threads if thread.is_alive()]
+        thread = threading.Thread(target=send_notification, args=(summary,))
+        thread.start()
+        self.threads.append(thread)
+
+    def wait(self):
+        # Waits until notifications are sent:
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+#end_class Notifications
+
+
+notifications = Notifications()
+
+
 def read_file(file_name):
     f = open(file_name, "r", encoding='utf-8')
     file_content = f.read()
@@ -101,8 +192,26 @@ def set_file_date(filename, ts):
     return ts_int
 
 
+def exchange_paths(path1, path2):
+    # Swaps two files or folders in one atomic rename (both must exist, on same file system).
+    # Returns False if not supported by file system (or OS), then nothing is changed:
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        if sys.platform == "darwin":
+            # renamex_np() with RENAME_SWAP (macOS 10.12, APFS and HFS+):
+            return libc.renamex_np(os.fsencode(path1), os.fsencode(path2), 0x2) == 0
+        # renameat2() with RENAME_EXCHANGE (Linux 3.15, glibc 2.28), AT_FDCWD for both paths:
+        return libc.renameat2(-100, os.fsencode(path1), -100, os.fsencode(path2), 0x2) == 0
+    except (OSError, AttributeError, TypeError):
+        return False
+
+
 def write_package(ul_path, ul_package, xml_text, modified):
-    temp_path = HOME + ".ulysses_temp_cache/"
+    # New package is written to a hidden folder next to the package (same file system),
+    # and swapped with the old package in one atomic rename. Then the old package is deleted.
+    # The package is never missing or half written, even if the process is killed.
+    # Replacing the package folder ensures that Ulysses will discover updated packages:
+    # Ulysses is monitoring the package's "Added Date" (OS-X Lion and newer)
 
     # Test XML, and write Ulysses package with XML + text files
     try:
@@ -116,31 +225,36 @@ def write_package(ul_path, ul_package, xml_text, modified):
         # *** Maybe add some more error handling here!
         return
 
-    ul_cache = temp_path + ul_package
-    if not os.path.exists(ul_cache):
-        os.makedirs(ul_cache)
+    ul_path_package = ul_path + ul_package.rstrip("/")
+    temp_package = ul_path + "." + ul_package.rstrip("/") + "_temp"
+    if os.path.exists(temp_package):
+        # Left by a killed sync:
+        shutil.rmtree(temp_package)
+    os.makedirs(temp_package)
 
-    xml_file = ul_cache + "Content.xml"
-    txt_file = ul_cache + "Text.txt"
+    xml_file = temp_package + "/Content.xml"
+    txt_file = temp_package + "/Text.txt"
 
     write_file_modified(xml_file, xml_text, modified)
     write_file_modified(txt_file, md_text, modified)
-
-    ul_path_package = ul_path + ul_package
-
-    # Deleting and copying package from cache,
-    # ensures that Ulysses will discover updated packages:
-    # Ulysses is monitoring the package's "Added Date" (OS-X Lion and newer)
-    if os.path.exists(ul_path_package):
-        shutil.rmtree(ul_path_package)
+    metrics.count("files_written", 2)
+    metrics.count("bytes_written", get_file_size(xml_file) + get_file_size(txt_file))
+
+    if not os.path.exists(ul_path_package):
+        update_info_plist(ul_path_package + "/")
+        os.rename(temp_package, ul_path_package)
+    elif exchange_paths(temp_package, ul_path_package):
+        shutil.rmtree(temp_package)
     else:
-        update_info_plist(ul_path_package)
-
-    shutil.copytree(ul_cache, ul_path_package)
+        # Without atomic swap: Old package is renamed away, and new package renamed into place
+        old_package = ul_path + "." + ul_package.rstrip("/") + "_old"
+        if os.path.exists(old_package):
+            shutil.rmtree(old_package)
+        os.rename(ul_path_package, old_package)
+        os.rename(temp_package, ul_path_package)
+        shutil.rmtree(old_package)
     set_file_date(ul_path_package, modified)
-
-    if os.path.exists(ul_cache):
-        shutil.rmtree(ul_cache)
+    library_writes.add(ul_path_package)
 
 
 def write_file_modified(filename, file_content, modified):
@@ -149,6 +263,469 @@ def write_file_modified(filename, file_content, modified):
     return ts_int
 
 
+def get_text_hash(text):
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+def get_file_hash(filename):
+    # Hash of file content, or "" if file is missing. (Read in blocks, for large media-files)
+    try:
+        f = open(filename, "rb")
+        file_hash = hashlib.sha1()
+        block = f.read(1 << 20)
+        while block:
+            file_hash.update(block)
+            block = f.read(1 << 20)
+        f.close()
+        return file_hash.hexdigest()
+    except OSError:
+        return ""
+
+
+class WriteBehind:
+    # Runs file writes in a thread, in order, so conversion of next sheets can go on meanwhile.
+    # At most "max_pending" writes are waiting, then submit() waits (memory stays bounded).
+    # Errors in thread are raised by next submit() or flush().
+    def __init__(self, max_pending):
+        self.queue = queue.Queue(max_pending)
+        self.error = None
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        while True:
+            task = self.queue.get()
+            try:
+                if task is None:
+                    return
+                if self.error is None:
+                    task()
+            except BaseException as error:
+                self.error = error
+            finally:
+                self.queue.task_done()
+
+    def check(self):
+        if self.error is not None:
+            (error, self.error) = (self.error, None)
+            raise error
+
+    def submit(self, task):
+        self.check()
+        self.queue.put(task)
+
+    def flush(self):
+        # Waits until all files are written:
+        self.queue.join()
+        self.check()
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self.check()
+#end_class WriteBehind
+
+
+class ExportFolder:
+    # Export is written directly to export folder "root" (no temp folder and rsync):
+    # - Files are only written when content has changed, otherwise only file date is set if needed.
+    #   Changed files are written to a hidden temp file, and renamed over old file (as rsync).
+    # - All files written or kept are noted, and files and empty folders not noted at this run
+    #   are deleted by "delete_orphans()", as "rsync --delete" did.
+    # exclude: File name patterns never deleted (fnmatch), e.g. sync state database.
+    # max_pending: Files are written in a thread (WriteBehind), with max. this many waiting. 0: No thread.
+    #   Call flush() before reading files written at this run, and close() when done.
+
+    def __init__(self, root, exclude=(), max_pending=0):
+        self.root = root
+        self.exclude = list(exclude)
+        self.kept = set()
+        self.writer = WriteBehind(max_pending) if max_pending > 0 else None
+        self.write_phase = None  # Metrics phase of write running in writer thread
+
+    def keep(self, filename):
+        # Note file as part of export, without writing it:
+        filename = os.path.normpath(filename)
+        self.kept.add(filename)
+
+    def run(self, write, *args):
+        # Runs "write(*args)" now, or in writer thread.
+        # (Counted in metrics phase of when write was submitted, not when it runs)
+        if self.writer is None:
+            write(*args)
+        else:
+            self.writer.submit(lambda phase=metrics.get_phase(): self.run_in_phase(phase, write, args))
+
+    def run_in_phase(self, phase, write, args):
+        self.write_phase = phase
+        try:
+            write(*args)
+        finally:
+            self.write_phase = None
+
+    def flush(self):
+        if self.writer is not None:
+            self.writer.flush()
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+    def replace_file(self, filename, write_temp):
+        # Lets "write_temp(temp_file)" write new file, then renames it to "filename":
+        (folder, name) = os.path.split(filename)
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        temp_file = os.path.join(folder, "." + name + ".ulysses_temp")
+        write_temp(temp_file)
+        metrics.count("files_written", 1, self.write_phase)
+        metrics.count("bytes_written", os.lstat(temp_file).st_size, self.write_phase)
+        os.replace(temp_file, filename)
+
+    def write_file(self, filename, file_content, modified):
+        # As write_file_modified(), but leaves file untouched if content and date are the same:
+        self.keep(filename)
+        ts_int = int(float(modified))
+        self.run(self.write_file_now, filename, file_content, ts_int)
+        return ts_int
+
+    def write_file_now(self, filename, file_content, ts_int):
+        data = file_content.encode("utf-8")
+        try:
+            file_stat = os.stat(filename)
+            same_content = file_stat.st_size == len(data)
+            if same_content:
+                f = open(filename, "rb")
+                same_content = f.read() == data
+                f.close()
+        except OSError:
+            same_content = False
+
+        if not same_content:
+            self.replace_file(filename, lambda temp_file: write_file(temp_file, file_content))
+            set_file_date(filename, ts_int)
+        elif int(file_stat.st_mtime) != ts_int:
+            set_file_date(filename, ts_int)
+
+    def copy_file(self, from_file, filename):
+        # As shutil.copy2(), but skips files with same size and date (quick check as rsync):
+        self.keep(filename)
+        self.run(self.copy_file_now, from_file, filename)
+
+    def copy_file_now(self, from_file, filename):
+        from_stat = os.stat(from_file)
+        try:
+            file_stat = os.lstat(filename)
+            if file_stat.st_size == from_stat.st_size \
+                    and int(file_stat.st_mtime) == int(from_stat.st_mtime):
+                return
+        except OSError:
+            pass
+        self.replace_file(filename, lambda temp_file: shutil.copy2(from_file, temp_file))
+
+    def link_file(self, from_file, filename, symlink=False):
+        # Hard link (or relative symlink) to file "from_file" already in export folder,
+        # instead of a second copy. Copies file, if links are not supported:
+        self.keep(filename)
+        self.run(self.link_file_now, from_file, filename, symlink)
+
+    def link_file_now(self, from_file, filename, symlink):
+        if os.path.normpath(from_file) == os.path.normpath(filename):
+            return
+        link_to = os.path.relpath(from_file, os.path.dirname(filename))
+        try:
+            if symlink:
+                if os.readlink(filename) == link_to:
+                    return
+            elif not os.path.islink(filename) and os.path.samefile(from_file, filename):
+                return
+        except OSError:
+            pass
+        try:
+            if symlink:
+                self.replace_file(filename, lambda temp_file: os.symlink(link_to, temp_file))
+            else:
+                self.replace_file(filename, lambda temp_file: os.link(from_file, temp_file))
+        except OSError:
+            self.copy_file_now(from_file, filename)
+
+    def is_excluded(self, name):
+        for pattern in self.exclude:
+            if fnmatch.fnmatch(name, pattern):
+                return True
+        return False
+
+    def delete_orphans(self, path=None):
+        # Deletes files not written or kept at this run, and folders left empty.
+        # Returns True if folder "path" is empty:
+        if path is None:
+            self.flush()
+            path = os.path.normpath(self.root)
+        is_empty = True
+        for name in sorted(os.listdir(path)):
+            full_name = os.path.join(path, name)
+            if self.is_excluded(name) or full_name in self.kept:
+                is_empty = False
+            elif os.path.isdir(full_name) and not os.path.islink(full_name):
+                if self.delete_orphans(full_name):
+                    print("Deleting:", full_name.replace(self.root, "") + "/")
+                    os.rmdir(full_name)
+                else:
+                    is_empty = False
+            else:
+                print("Deleting:", full_name.replace(self.root, ""))
+                os.remove(full_name)
+        return is_empty
+#end_class ExportFolder
+
+
+class JoinedFiles:
+    # Joined markdown files, one for each top level group, in folder "path".
+    # Streamed to disk while sheets are exported, but only if group has changed:
+    # Hashes of sheets are compared to hashes from last export (sync state "state"), in order.
+    # Nothing is written until first difference, then sheets so far are read back from export folder.
+    # Unchanged files are left untouched (same content and date).
+    # Sheets reused from last export are added without text (None), and only read back if needed.
+
+    def __init__(self, path, state, export_folder=None):
+        self.path = path
+        self.state = state
+        self.export_folder = export_folder  # Flushed before reading exported files back
+        self.kept = set()
+        self.filename = None
+        self.f = None
+
+    def add_sheet(self, filename, md_text, content_hash, export_file):
+        # Adds sheet to joined file "filename". Sheets are added group by group:
+        if filename != self.filename:
+            self.close_file()
+            self.filename = filename
+            self.kept.add(filename)
+            self.last_hashes = self.state.get_joined_hashes(filename)
+            self.hashes = []
+            self.export_files = []
+
+        pos = len(self.hashes)
+        self.hashes.append(content_hash)
+        self.export_files.append(export_file)
+        if self.f is None:
+            if self.last_hashes is not None and pos < len(self.last_hashes) \
+                    and self.last_hashes[pos] == content_hash:
+                return
+            self.open_file(self.export_files[:-1])
+        if md_text is None:
+            if self.export_folder is not None:
+                self.export_folder.flush()
+            md_text = self.read_export_file(export_file)
+        self.f.write(md_text.rstrip() + "\n\n\n")
+
+    def read_export_file(self, export_file):
+        f = open(export_file, "r", encoding="utf-8", newline="")
+        md_text = f.read()
+        f.close()
+        metrics.count("bytes_read", get_file_size(export_file))
+        return md_text
+
+    def open_file(self, export_files):
+        # Starts writing temp file, with sheets read back from exported files:
+        (folder, name) = os.path.split(self.filename)
+        self.temp_file = os.path.join(folder, "." + name + ".ulysses_temp")
+        self.f = open(self.temp_file, "w", encoding="utf-8")
+        if self.export_folder is not None and export_files:
+            self.export_folder.flush()
+        for export_file in export_files:
+            self.f.write(self.read_export_file(export_file).rstrip() + "\n\n\n")
+
+    def close_file(self):
+        if self.filename is None:
+            return
+        if self.f is None and (self.hashes != self.last_hashes or not os.path.exists(self.filename)):
+            # Sheets removed at end of group, or file deleted:
+            self.open_file(self.export_files)
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+            metrics.count("files_written")
+            metrics.count("bytes_written", get_file_size(self.temp_file))
+            os.replace(self.temp_file, self.filename)
+            self.state.set_joined_hashes(self.filename, self.hashes)
+        self.filename = None
+
+    def delete_others(self):
+        # Deletes joined files not made at this run, i.e. top level group deleted:
+        for name in os.listdir(self.path):
+            filename = os.path.join(self.path, name)
+            if name.endswith(".md") and filename not in self.kept:
+                print("Deleting:", filename)
+                os.remove(filename)
+                self.state.set_joined_hashes(filename, None)
+#end_class JoinedFiles
+
+
+class SyncState:
+    # Sync state for one export folder, saved in SQLite database: One row per sheet UUID,
+    # with package path, exported md-file, mtimes, content hash and last sync time.
+    # content_hash: Hash of exported md-file. package_hash: Hash of sheet's Content.xml at export.
+    def __init__(self, db_file):
+        self.db_file = db_file
+        self.db = sqlite3.connect(db_file)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute("""CREATE TABLE IF NOT EXISTS sheets (
+                               ul_uuid TEXT PRIMARY KEY,
+                               package_path TEXT,
+                               package_mtime TEXT,
+                               export_path TEXT,
+                               exported_mtime INTEGER,
+                               content_hash TEXT,
+                               numbering TEXT,
+                               last_synced REAL,
+                               package_hash TEXT)""")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS media (
+                               export_path TEXT PRIMARY KEY,
+                               source_mtime INTEGER,
+                               source_size INTEGER,
+                               media_hash TEXT)""")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS joined_files (
+                               joined_file TEXT PRIMARY KEY,
+                               sheet_hashes TEXT)""")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS scan_manifest (
+                               path TEXT PRIMARY KEY,
+                               mtime_ns INTEGER,
+                               size INTEGER)""")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS sync_info (
+                               key TEXT PRIMARY KEY,
+                               value TEXT)""")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS listed_groups (
+                               root TEXT,
+                               position INTEGER,
+                               data TEXT,
+                               PRIMARY KEY (root, position))""")
+        self.db.commit()
+        self.exported_uuids = set()
+        self.exported_media = set()
+
+    def get_last_synced(self):
+        # Time of last completed sync, or 0 if never synced:
+        row = self.db.execute("SELECT value FROM sync_info WHERE key = 'last_synced'").fetchone()
+        if row is not None:
+            return float(row["value"])
+
+        # Upgrade from old tab-separated sync log, where file date was time of last sync:
+        old_sync_file = os.path.dirname(self.db_file) + "/.ulysses_sync.log"
+        return get_file_date(old_sync_file)
+
+    def set_last_synced(self, ts):
+        self.db.execute("INSERT OR REPLACE INTO sync_info (key, value) VALUES ('last_synced', ?)",
+                        (str(ts),))
+        self.db.commit()
+
+    def get_sheet(self, ul_uuid):
+        return self.db.execute("SELECT * FROM sheets WHERE ul_uuid = ?", (ul_uuid,)).fetchone()
+
+    def get_numbering(self, row):
+        # Numbering of footnotes, links and images: (at start, at end) of exported sheet.
+        counters = tuple(int(c) for c in row["numbering"].split("\t"))
+        return (counters[:3], counters[3:])
+
+    def set_exported(self, ul_uuid, package_path, package_mtime, export_path, exported_mtime,
+                     content_hash, numbering, synced_ts, package_hash):
+        self.exported_uuids.add(ul_uuid)
+        numbering = "\t".join(str(c) for c in numbering[0] + numbering[1])
+        self.db.execute("INSERT OR REPLACE INTO sheets VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                        (ul_uuid, package_path, package_mtime, export_path, exported_mtime,
+                         content_hash, numbering, synced_ts, package_hash))
+
+    def set_exported_mtime(self, ul_uuid, exported_mtime):
+        # Exported md-file touched, but content unchanged (e.g. by Dropbox or editor):
+        self.db.execute("UPDATE sheets SET exported_mtime = ? WHERE ul_uuid = ?",
+                        (exported_mtime, ul_uuid))
+
+    def get_media(self, export_path):
+        # Media-file in index of exported media, or None:
+        return self.db.execute("SELECT * FROM media WHERE export_path = ?", (export_path,)).fetchone()
+
+    def set_media(self, export_path, source_mtime, source_size, media_hash):
+        self.exported_media.add(export_path)
+        self.db.execute("INSERT OR REPLACE INTO media VALUES (?, ?, ?, ?)",
+                        (export_path, source_mtime, source_size, media_hash))
+
+    def keep_media(self, export_path):
+        # Media-file exported again, unchanged:
+        self.exported_media.add(export_path)
+
+    def get_joined_hashes(self, joined_file):
+        # Hashes of sheets in joined markdown file, at last export, or None:
+        row = self.db.execute("SELECT sheet_hashes FROM joined_files WHERE joined_file = ?",
+                              (joined_file,)).fetchone()
+        if row is None:
+            return None
+        return row["sheet_hashes"].split("\t") if row["sheet_hashes"] else []
+
+    def set_joined_hashes(self, joined_file, sheet_hashes):
+        # sheet_hashes: None if joined file is deleted.
+        if sheet_hashes is None:
+            self.db.execute("DELETE FROM joined_files WHERE joined_file = ?", (joined_file,))
+        else:
+            self.db.execute("INSERT OR REPLACE INTO joined_files VALUES (?, ?)",
+                            (joined_file, "\t".join(sheet_hashes)))
+
+    def get_scan_manifest(self):
+        # Files checked and folders read on last sync import: {path: (mtime_ns, size)}, size -1 for folders.
+        return dict((row["path"], (row["mtime_ns"], row["size"]))
+                    for row in self.db.execute("SELECT * FROM scan_manifest"))
+
+    def update_scan_manifest(self, updates, deleted):
+        self.db.executemany("INSERT OR REPLACE INTO scan_manifest VALUES (?, ?, ?)",
+                            [(path,) + key for (path, key) in updates])
+        self.db.executemany("DELETE FROM scan_manifest WHERE path = ?", [(path,) for path in deleted])
+
+    def remove_sheet(self, ul_uuid):
+        # Sheet deleted in Ulysses, when only changed groups are exported:
+        self.db.execute("DELETE FROM sheets WHERE ul_uuid = ?", (ul_uuid,))
+
+    def get_listed_groups(self, root):
+        # Groups listed at last sync (list_all_files), in order, or None if not listed:
+        rows = self.db.execute("SELECT data FROM listed_groups WHERE root = ? ORDER BY position",
+                               (root,)).fetchall()
+        return [json.loads(row["data"]) for row in rows] or None
+
+    def set_listed_groups(self, root, groups, positions=None):
+        # positions: Only groups listed again (update_groups), or None if all groups were listed.
+        if positions is None:
+            self.db.execute("DELETE FROM listed_groups WHERE root = ?", (root,))
+            positions = range(len(groups))
+        self.db.executemany("INSERT OR REPLACE INTO listed_groups VALUES (?, ?, ?)",
+                            [(root, pos, json.dumps(groups[pos])) for pos in positions])
+
+    def remove_unexported_sheets(self):
+        # Removes sheets deleted in Ulysses since last sync, i.e. not exported in this run:
+        for row in self.db.execute("SELECT ul_uuid FROM sheets").fetchall():
+            if row["ul_uuid"] not in self.exported_uuids:
+                self.db.execute("DELETE FROM sheets WHERE ul_uuid = ?", (row["ul_uuid"],))
+        # And media-files of deleted sheets:
+        for row in self.db.execute("SELECT export_path FROM media").fetchall():
+            if row["export_path"] not in self.exported_media:
+                self.db.execute("DELETE FROM media WHERE export_path = ?", (row["export_path"],))
+        self.db.commit()
+
+    def commit(self):
+        self.db.commit()
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+#end_class SyncState
+
+
+def get_file_size(filename):
+    try:
+        return os.path.getsize(filename)
+    except OSError:
+        return 0
+
+
 def get_file_date(filename):
     try:
         t = os.path.getmtime(filename)
@@ -158,6 +735,43 @@ def get_file_date(filename):
     #return datetime.datetime.fromtimestamp(t)
 
 
+def xml_child_nodes(elem):
+    # Child nodes of ElementTree element, as in DOM: text (str) and elements in document order:
+    nodes = []
+    if elem.text:
+        nodes.append(elem.text)
+    for child in elem:
+        nodes.append(child)
+        if child.tail:
+            nodes.append(child.tail)
+    return nodes
+
+
+def escape_xml_data(data):
+    # Escapes text and attribute values, same as minidom's toxml():
+    return data.replace("&", "&amp;").replace("<", "&lt;").replace("\"", "&quot;").replace(">", "&gt;")
+
+
+def element_to_xml(elem):
+    # ElementTree element (without tail) as XML string, same as minidom's toxml():
+    xml_name = "{http://www.w3.org/XML/1998/namespace}"
+    xml_text = "<" + elem.tag
+    for (name, value) in elem.attrib.items():
+        if name.startswith(xml_name):
+            name = "xml:" + name[len(xml_name):]
+        xml_text += " " + name + '="' + escape_xml_data(value) + '"'
+    nodes = xml_child_nodes(elem)
+    if not nodes:
+        return xml_text + "/>"
+    xml_text += ">"
+    for node in nodes:
+        if isinstance(node, str):
+            xml_text += escape_xml_data(node)
+        else:
+            xml_text += element_to_xml(node)
+    return xml_text + "</" + elem.tag + ">"
+
+
 def clean_file_title(title, ul_file, add_uuid):
     # Clean MD titel to make safe cross-platform filenames:
     title = re.sub(r"[/\\—|.&<>:]", r"-", title)
@@ -179,12 +793,70 @@ def clean_file_title(title, ul_file, add_uuid):
         return title[:64]
 
 
-def list_all_files(path, out_path, path_count, add_ul_uuid, tree_depth=0):
-
-    file_list = ""
-
-    file_count = 1
-    sub_path_count = 1
+class SheetCache:
+    # Sheets parsed when listing files, kept until exported, so each Content.xml is parsed once.
+    # Sheets beyond max_sheets are parsed again on export, to keep memory use bounded.
+    def __init__(self, max_sheets=sheet_cache_size):
+        self.max_sheets = max_sheets
+        self.__sheets = {}
+
+    def add(self, ul_path, xml_doc):
+        if len(self.__sheets) < self.max_sheets:
+            self.__sheets[ul_path] = xml_doc
+
+    def pop(self, ul_path):
+        # Returns parsed sheet (root element) and releases it, or None if not kept:
+        return self.__sheets.pop(ul_path, None)
+#end_class SheetCache
+
+
+class ReadAhead:
+    # Reads files in threads, up to "window" files ahead, while files read so far are parsed.
+    # Files are taken by read_next() in same order as "filenames". Raises OSError if not read.
+    def __init__(self, filenames, window=None):
+        self.filenames = filenames
+        if window is None:
+            window = io_queue_size
+        self.window = window
+        self.futures = []
+        self.next_pos = 0
+        self.pool = ThreadPoolExecutor(min(4, window)) if window > 0 and len(filenames) > 1 else None
+
+    def read_file(self, filename):
+        f = open(filename, "rb")
+        data = f.read()
+        f.close()
+        return data
+
+    def read_next(self):
+        if self.pool is None:
+            self.next_pos += 1
+            return self.read_file(self.filenames[self.next_pos - 1])
+        while self.next_pos < len(self.filenames) and len(self.futures) < self.window:
+            self.futures.append(self.pool.submit(self.read_file, self.filenames[self.next_pos]))
+            self.next_pos += 1
+        return self.futures.pop(0).result()
+
+    def close(self):
+        # Threads are not kept, e.g. for worker processes started later (fork):
+        if self.pool is not None:
+            for future in self.futures:
+                future.cancel()
+            self.pool.shutdown()
+#end_class ReadAhead
+
+
+RE_LOG_TITLE = re.compile(r"Log - 20\d\d-[0-1]\d-[0-3]\d [0-2]\d-[0-5]\d-[0-5]\d")
+
+
+def list_group(path, out_path, path_count, add_ul_uuid, tree_depth=0, sheet_cache=None,
+               last_group=None, changed_sheets=()):
+    # Lists sheets of group "path" (not its sub groups). Returns group (dict, saved as JSON):
+    # Arguments of listing, "out_path" of group in export folder, "subgroups" (folder names),
+    # and "sheets": [package path, modified, title], in order. (Export file names by get_group_lines)
+    # last_group: Same group at last listing, with sheets reused if not in "changed_sheets"
+    #             and Content.xml has the same date. Other sheets are parsed.
+    group = {"path": path, "out_path_in": out_path, "path_count": path_count, "depth": tree_depth}
 
     info_ulgroup = path + "Info.ulgroup"
 
@@ -197,68 +869,169 @@ def list_all_files(path, out_path, path_count, add_ul_uuid, tree_depth=0):
 
         out_path += str(path_count).zfill(2) + " - "\
             + clean_file_title(sub_out_path, "", add_ul_uuid) + "/"
-        path_count += 1
+    group["out_path"] = out_path
 
     nodelist = xml_plist.findall(".//dict/array//string")
+    group["subgroups"] = [item.text for item in nodelist if item.text.endswith("-ulgroup")]
+
+    last_sheets = {}
+    if last_group is not None:
+        for (package_path, modified, title) in last_group["sheets"]:
+            if package_path not in changed_sheets:
+                last_sheets[package_path] = (modified, title)
+
+    sheets = []
     for item in nodelist:
         sub_path = item.text
-        # Sheets:
         if sub_path.endswith(".ulysses"):
             file_name = path + sub_path + "/" + "Content.xml"
-            modified = get_file_date(file_name)
-
-            try:
-                xml_doc = ET.parse(file_name)
-            except:
-                print("*** File Missing or Corrupt XML:", file_name)
-                continue
-
-            p = xml_doc.find(".//p")
-            if p is not None:
-                title = ET.tostring(p, "unicode", "text")
-            else:
-                title = "Untitled"
-
-            title = clean_file_title(title, sub_path, add_ul_uuid)
+            sheets.append((path + sub_path, file_name, str(get_file_date(file_name))))
+    # Sheets are read ahead in threads, while parsed here:
+    read_ahead = ReadAhead([file_name for (package_path, file_name, modified) in sheets
+                            if last_sheets.get(package_path, ("",))[0] != modified])
+    group["sheets"] = []
+    for (package_path, file_name, modified) in sheets:
+        if last_sheets.get(package_path, ("",))[0] == modified:
+            group["sheets"].append([package_path, modified, last_sheets[package_path][1]])
+            continue
+        try:
+            xml_doc = ET.ElementTree(ET.fromstring(read_ahead.read_next()))
+        except:
+            print("*** File Missing or Corrupt XML:", file_name)
+            continue
+        metrics.count("sheets_parsed")
+        metrics.count("bytes_read", get_file_size(file_name))
+        if sheet_cache is not None:
+            sheet_cache.add(package_path, xml_doc.getroot())
+
+        p = xml_doc.find(".//p")
+        if p is not None:
+            title = ET.tostring(p, "unicode", "text")
+        else:
+            title = "Untitled"
+
+        title = clean_file_title(title, os.path.basename(package_path), add_ul_uuid)
+        group["sheets"].append([package_path, modified, title])
+    read_ahead.close()
+    return group
+#end_def list_group
+
+
+def get_group_lines(group):
+    # Lines of file list for sheets of group: Package path, modified, out path and file name (tab separated)
+    file_list = []
+    for (num, (package_path, modified, title)) in enumerate(group["sheets"]):
+        if RE_LOG_TITLE.match(title):
+            # debug(175, title)
+            pass
+        else:
+            title = str(num + 1).zfill(2) + " - " + title
+        file_list.append(package_path + "\t" + modified + "\t" + group["out_path"] + "\t" + title + "\n")
+    return "".join(file_list)
 
-            if re.match(r"Log - 20\d\d-[0-1]\d-[0-3]\d [0-2]\d-[0-5]\d-[0-5]\d", title):
-                # debug(175, title)
-                pass
-            else:
-                title = str(file_count).zfill(2) + " - " + title
 
-            file_count += 1
+def list_all_files(path, out_path, path_count, add_ul_uuid, tree_depth=0, sheet_cache=None, groups=None):
+    # File list of all sheets in group "path" and sub groups (get_group_lines).
+    # groups: Listed groups are added to this list, if given, e.g. for update_groups() at next sync.
+    group = list_group(path, out_path, path_count, add_ul_uuid, tree_depth, sheet_cache)
+    if groups is not None:
+        groups.append(group)
+    file_list = [get_group_lines(group)]
 
-            file_list += path + sub_path + "\t" + str(modified) + "\t"\
-                + out_path + "\t" + title + "\n"
-            path_count = 1
-    for item in nodelist:
-        sub_path = item.text
-        # Groups:
-        if sub_path.endswith("-ulgroup"):
-            fl, pc = list_all_files(path + sub_path + "/", out_path, sub_path_count,
-                                    add_ul_uuid, tree_depth + 1)
-            file_list += fl
-            sub_path_count += pc
-            path_count += 1
+    sub_path_count = 1
+    for sub_path in group["subgroups"]:
+        fl, pc = list_all_files(path + sub_path + "/", group["out_path"], sub_path_count,
+                                add_ul_uuid, tree_depth + 1, sheet_cache, groups)
+        file_list.append(fl)
+        sub_path_count += pc
 
     path_count = 1
-    return (file_list, path_count)
-#end_def list_all_files(path, out_path, path_count, add_ul_uuid, tree_depth=0)
+    return ("".join(file_list), path_count)
+#end_def list_all_files(path, out_path, path_count, add_ul_uuid, tree_depth=0, sheet_cache=None, groups=None)
+
+
+def update_groups(groups, changed_paths, add_ul_uuid, sheet_cache=None):
+    # Lists again only groups with changed plist or sheets (changed_paths from FolderWatcher),
+    # reusing "groups" of last listing (list_all_files) for all others.
+    # Returns (positions of changed groups, removed package paths),
+    # or None if groups changed (new, deleted, moved or renamed): Then all files must be listed.
+    root_path = groups[0]["path"]
+    positions = {group["path"]: pos for (pos, group) in enumerate(groups)}
+    changed_groups = {}  # group path: Changed package paths
+    for path in changed_paths:
+        if not path.startswith(root_path):
+            continue
+        sub_paths = path[len(root_path):].split("/")
+        if sub_paths[-1] == "Info.ulgroup":
+            group_path = path[:-len("Info.ulgroup")]
+            changed_groups.setdefault(group_path, set())
+            continue
+        for (i, sub_path) in enumerate(sub_paths):
+            if sub_path.endswith(".ulysses"):
+                group_path = root_path + "".join(p + "/" for p in sub_paths[:i])
+                changed_groups.setdefault(group_path, set()).add(group_path + sub_path)
+                break
+    changed_positions = []
+    removed_sheets = set()
+    added_sheets = set()
+    for (group_path, changed_sheets) in changed_groups.items():
+        if group_path not in positions:
+            return None
+        pos = positions[group_path]
+        last_group = groups[pos]
+        try:
+            group = list_group(group_path, last_group["out_path_in"], last_group["path_count"],
+                               add_ul_uuid, last_group["depth"], sheet_cache, last_group, changed_sheets)
+        except (OSError, ET.ParseError):
+            return None
+        if group["out_path"] != last_group["out_path"] or group["subgroups"] != last_group["subgroups"]:
+            return None
+        # Sheets changed, but not listed in group plist, are not listed (Ulysses updates plist later):
+        removed_sheets.update(sheet[0] for sheet in last_group["sheets"])
+        added_sheets.update(sheet[0] for sheet in group["sheets"])
+        groups[pos] = group
+        changed_positions.append(pos)
+    return (sorted(changed_positions), removed_sheets - added_sheets)
+#end_def update_groups(groups, changed_paths, add_ul_uuid, sheet_cache=None)
 
 
 class UlyssesToMarkdown:
 
     def __init__(self):
-        self.footnotes = ""
-        self.links = ""
-        self.img_links = ""
+        self.footnotes = []
+        self.links = []
+        self.img_links = []
         self.img_num = 1
         self.fn_num = 1
         self.link_num = 1
+        self.numbered_later = False
+
+    def get_counters(self):
+        # Footnotes, links and images are numbered throughout all exported sheets:
+        return (self.fn_num, self.link_num, self.img_num)
+
+    def set_counters(self, counters):
+        (self.fn_num, self.link_num, self.img_num) = counters
+
+    def format_number(self, kind, num):
+        # Sheets converted in worker processes are numbered later, by "add_numbering".
+        # Using "\x00" as marker, since it is not allowed in XML.
+        if self.numbered_later:
+            return "\x00" + kind + str(num) + "\x00"
+        return str(num)
+
+    def add_numbering(self, md_text, counters):
+        # Numbers footnotes, links and images in md_text, converted with numbered_later,
+        # continuing own numbering. counters: numbering at end of conversion, starting at 1.
+        start = {"fn": self.fn_num, "link": self.link_num, "img": self.img_num}
+        md_text = re.sub(r"\x00(fn|link|img)(\d+)\x00",
+                         lambda m: str(start[m.group(1)] + int(m.group(2)) - 1), md_text)
+        self.set_counters((self.fn_num + counters[0] - 1, self.link_num + counters[1] - 1,
+                           self.img_num + counters[2] - 1))
+        return md_text
 
     def parse_paragraph(self, document):
-        md_line = ""
+        md_line = []
 
         for child in document.childNodes:
             #if child.nodeType == child.TEXT_NODE:
@@ -266,127 +1039,67 @@ class UlyssesToMarkdown:
             if document.tagName == "p":
                 if child.nodeType == child.TEXT_NODE:
                     #print(child.data, end='')
-                    md_line += child.data
+                    md_line.append(child.data)
             elif document.tagName == 'tag':
                 if child.nodeType == child.TEXT_NODE:
                     # All tags, but converts codeblock '' to tab here:
-                    md_line += re.sub(r"^[ \t]*'' ?", r"\t", child.data)
+                    md_line.append(re.sub(r"^[ \t]*'' ?", r"\t", child.data))
             elif document.tagName == 'tags':
                 pass
             elif document.tagName == 'escape':
                 if child.nodeType == child.TEXT_NODE:
-                    md_line += child.data[1:]  # Strips off the escape char: "\""
+                    md_line.append(child.data[1:])  # Strips off the escape char: "\""
             elif document.tagName == 'element':
                 kind = document.attributes["kind"].value
                 startTag = ""
                 if kind == "strong" or kind == "emph" or kind == "code":
                     startTag = document.attributes["startTag"].value
-                    md_line += startTag
+                    md_line.append(startTag)
                     if child.nodeType == child.TEXT_NODE:
-                        md_line += child.data
+                        md_line.append(child.data)
                     if child.nodeType == child.ELEMENT_NODE:
-                        md_line += self.parse_paragraph(child)
-                    md_line += startTag
+                        md_line.append(self.parse_paragraph(child))
+                    md_line.append(startTag)
                     continue
                 elif kind == "inlineNative":
                     if child.nodeType == child.TEXT_NODE:
-                        md_line += child.data
+                        md_line.append(child.data)
                     continue
                 elif kind == "inlineComment":
                     #startTag = document.attributes["startTag"].value
-                    md_line += cmt_start  # startTag
+                    md_line.append(cmt_start)  # startTag
                     if child.nodeType == child.TEXT_NODE:
-                        md_line += child.data
+                        md_line.append(child.data)
                     if child.nodeType == child.ELEMENT_NODE:
-                        md_line += self.parse_paragraph(child)
-                    md_line += cmt_end  # startTag
+                        md_line.append(self.parse_paragraph(child))
+                    md_line.append(cmt_end)  # startTag
                     continue
                 elif kind == "delete":
                     #startTag = document.attributes["startTag"].value
-                    md_line += del_start  # startTag
+                    md_line.append(del_start)  # startTag
                     if child.nodeType == child.TEXT_NODE:
-                        md_line += child.data
+                        md_line.append(child.data)
                     if child.nodeType == child.ELEMENT_NODE:
-                        md_line += self.parse_paragraph(child)
-                    md_line += del_end  # startTag
+                        md_line.append(self.parse_paragraph(child))
+                    md_line.append(del_end)  # startTag
                     continue
                 elif kind == "mark":
                     #startTag = document.attributes["startTag"].value
-                    md_line += mark_start  # startTag
+                    md_line.append(mark_start)  # startTag
                     if child.nodeType == child.TEXT_NODE:
-                        md_line += child.data
+                        md_line.append(child.data)
                     if child.nodeType == child.ELEMENT_NODE:
-                        md_line += self.parse_paragraph(child)
-                    md_line += mark_end  # startTag
+                        md_line.append(self.parse_paragraph(child))
+                    md_line.append(mark_end)  # startTag
                     continue
                 elif kind == "link":
-                    url, title, text = "", "", ""
-                    element_node = ET.fromstring(document.toxml())
-
-                    elem = element_node.find("attribute[@identifier='URL']")
-                    if elem is not None:
-                        if elem.text is not None:
-                            url = elem.text
-                    elem = element_node.find("attribute[@identifier='title']")
-                    if elem is not None:
-                        if elem.text is not None:
-                            title = elem.text
-                    for item in element_node.itertext():
-                        if item is not None:
-                            text = item
-                    if url == "":
-                        md_line += "[" + text + "]()"
-                    else:
-                        md_line += "[" + text + "][" + str(self.link_num) + "]"
-                        self.links += "[" + str(self.link_num) + "]:\t" + url\
-                            + ' "' + title + '"\n'
-                        self.link_num += 1
+                    md_line.append(self.get_link_as_md(ET.fromstring(document.toxml())))
                     break
                 elif kind == "image":
-                    image, title, description, link = "", "", "", ""
-                    element_node = ET.fromstring(document.toxml())
-
-                    elem = element_node.find("attribute[@identifier='URL']")
-                    if elem is not None:
-                        if elem.text is not None:
-                            link = elem.text.replace(" ", "%20")
-                    elem = element_node.find("attribute[@identifier='image']")
-                    if elem is not None:
-                        if elem.text is not None:
-                            if link != "":
-                                image = "<!--Media:" + elem.text + "-->\n"
-                            else:
-                                link = "Media/" + elem.text + ".#fileref"
-                    elem = element_node.find("attribute[@identifier='title']")
-                    if elem is not None:
-                        if elem.text is not None:
-                            title = elem.text
-                    elem = element_node.find("attribute[@identifier='description']")
-                    if elem is not None:
-                        if elem.text is not None:
-                            description = elem.text
-
-                    md_line += "![" + description + "]["+kind+"-" + str(self.img_num) + "]"
-
-                    self.img_links += "["+kind+"-" + str(self.img_num) + "]:\t"\
-                        + link + ' "' + title + '"\n' + image
-                    self.img_num += 1
+                    md_line.append(self.get_image_as_md(ET.fromstring(document.toxml()), kind))
                     break
                 elif kind == "video":
-                    link, image = "", ""
-                    element_node = ET.fromstring(document.toxml())
-                    elem = element_node.find("attribute[@identifier='URL']")
-                    if elem is not None:
-                        if elem.text is not None:
-                            link = elem.text.replace(" ", "%20")
-                    elem = element_node.find("attribute[@identifier='video']")
-                    if elem is not None:
-                        if elem.text is not None:
-                            if link != "":
-                                image = "<!--Media:" + elem.text + "-->"
-                            else:
-                                link = "Media/" + elem.text + ".#fileref"
-                    md_line += '<figure><video src="'+link+'">'+image+'</video></figure>'
+                    md_line.append(self.get_video_as_md(ET.fromstring(document.toxml())))
                     break
                 elif kind == "annotation":
                     anno = document.toxml().replace("\n", "")
@@ -399,47 +1112,210 @@ class UlyssesToMarkdown:
                             note += self.parse_paragraph(child2) + "<br/>"
                     note = note[:-5]  # Strip last <br/>
 
-                    if use_critic_markup:
-                        md_line += "{==" + annotated + "==}{>>" + note + "<<}"
-                    else:
-                        md_line += "<span class='annotation'>" + annotated + "</span>"\
-                                   "<!--" + note + "-->"
+                    md_line.append(self.get_annotation_as_md(annotated, note))
                     break
                 elif kind == "footnote":
-                    md_line += "[^" + str(self.fn_num) + "]"
+                    md_line.append("[^" + self.format_number("fn", self.fn_num) + "]")
 
                     note = ""
                     for child2 in child.getElementsByTagName("p"):
                         if child2.nodeType == child2.ELEMENT_NODE:
                             note += self.parse_paragraph(child2) + "  \n\t"
 
-                    note = note[:-1]
-                    # print (str(note.encode("utf-8")))
-                    # quit()
-
-                    self.footnotes += "[^" + str(self.fn_num) + "]:\t" + note + "\n"
-                    self.fn_num += 1
+                    self.add_footnote(note)
                     break
                 else:
                     if child.nodeType == child.TEXT_NODE:
                         #print("<" + kind + ">", child.data, end="")
-                        md_line += "{>>Unhandled: " + kind + ": " + child.data + "<<}"
+                        md_line.append("{>>Unhandled: " + kind + ": " + child.data + "<<}")
                     else:
-                        md_line += child.toxml()
+                        md_line.append(child.toxml())
             else:
                 #md_line += "---" + child.toxml()
                 pass
             if child.nodeType == minidom.Node.ELEMENT_NODE:
-                md_line += self.parse_paragraph(child)
+                md_line.append(self.parse_paragraph(child))
         #endfor child in document.childNodes
-        return md_line
+        return "".join(md_line)
     #end_def parse_paragraph(self, document)
 
-    def get_attacments_as_md(self, xml_data):
+    def get_link_as_md(self, element_node):
+        url, title, text = "", "", ""
+        elem = element_node.find("attribute[@identifier='URL']")
+        if elem is not None:
+            if elem.text is not None:
+                url = elem.text
+        elem = element_node.find("attribute[@identifier='title']")
+        if elem is not None:
+            if elem.text is not None:
+                title = elem.text
+        for item in element_node.itertext():
+            if item is not None:
+                text = item
+        if url == "":
+            return "[" + text + "]()"
+        md_line = "[" + text + "][" + self.format_number("link", self.link_num) + "]"
+        self.links.append("[" + self.format_number("link", self.link_num) + "]:\t" + url
+                          + ' "' + title + '"\n')
+        self.link_num += 1
+        return md_line
+
+    def get_image_as_md(self, element_node, kind):
+        image, title, description, link = "", "", "", ""
+        elem = element_node.find("attribute[@identifier='URL']")
+        if elem is not None:
+            if elem.text is not None:
+                link = elem.text.replace(" ", "%20")
+        elem = element_node.find("attribute[@identifier='image']")
+        if elem is not None:
+            if elem.text is not None:
+                if link != "":
+                    image = "<!--Media:" + elem.text + "-->\n"
+                else:
+                    link = "Media/" + elem.text + ".#fileref"
+        elem = element_node.find("attribute[@identifier='title']")
+        if elem is not None:
+            if elem.text is not None:
+                title = elem.text
+        elem = element_node.find("attribute[@identifier='description']")
+        if elem is not None:
+            if elem.text is not None:
+                description = elem.text
+
+        md_line = "![" + description + "]["+kind+"-" + self.format_number("img", self.img_num) + "]"
+
+        self.img_links.append("["+kind+"-" + self.format_number("img", self.img_num) + "]:\t"
+                              + link + ' "' + title + '"\n' + image)
+        self.img_num += 1
+        return md_line
+
+    def get_video_as_md(self, element_node):
+        link, image = "", ""
+        elem = element_node.find("attribute[@identifier='URL']")
+        if elem is not None:
+            if elem.text is not None:
+                link = elem.text.replace(" ", "%20")
+        elem = element_node.find("attribute[@identifier='video']")
+        if elem is not None:
+            if elem.text is not None:
+                if link != "":
+                    image = "<!--Media:" + elem.text + "-->"
+                else:
+                    link = "Media/" + elem.text + ".#fileref"
+        return '<figure><video src="'+link+'">'+image+'</video></figure>'
+
+    def get_annotation_as_md(self, annotated, note):
+        if use_critic_markup:
+            return "{==" + annotated + "==}{>>" + note + "<<}"
+        else:
+            return "<span class='annotation'>" + annotated + "</span>"\
+                   "<!--" + note + "-->"
+
+    def add_footnote(self, note):
+        note = note[:-1]
+        self.footnotes.append("[^" + self.format_number("fn", self.fn_num) + "]:\t" + note + "\n")
+        self.fn_num += 1
+
+    def parse_paragraph_etree(self, document):
+        # Same as parse_paragraph, but for ElementTree elements:
+        md_line = []
+        tag = document.tag
+        if tag == "element":
+            nodes = xml_child_nodes(document)
+            if not nodes:
+                return "".join(md_line)
+            kind = document.attrib["kind"]
+            if kind == "strong" or kind == "emph" or kind == "code":
+                start_tag = end_tag = document.attrib["startTag"]
+            elif kind == "inlineComment":
+                (start_tag, end_tag) = (cmt_start, cmt_end)
+            elif kind == "delete":
+                (start_tag, end_tag) = (del_start, del_end)
+            elif kind == "mark":
+                (start_tag, end_tag) = (mark_start, mark_end)
+            elif kind == "inlineNative":
+                for node in nodes:
+                    if isinstance(node, str):
+                        md_line.append(node)
+                return "".join(md_line)
+            elif kind == "link":
+                return self.get_link_as_md(document)
+            elif kind == "image":
+                return self.get_image_as_md(document, kind)
+            elif kind == "video":
+                return self.get_video_as_md(document)
+            elif kind == "annotation":
+                if len(document) == 1 and document.text is None and document[0].tag == "attribute"\
+                        and len(document[0]) and document[0][-1].tag == "string" and not document[0][-1].tail\
+                        and (document[0][-1].text or len(document[0][-1]))\
+                        and len(list(document[0].iter("attribute"))) == 1:
+                    # Usual annotation: Annotated text following the note attribute.
+                    # (Empty note is written as "<string ... />", not matched by regex below)
+                    annotated = escape_xml_data(document[0].tail or "").replace("\n", "")
+                else:
+                    anno = element_to_xml(document).replace("\n", "")
+                    annotated = re.sub(r"(<element.*?</string></attribute>)(.*?)</element>",
+                                       r"\2", anno)
+                note = ""
+                if not isinstance(nodes[0], str):
+                    for child in nodes[0].iter("p"):
+                        if child is not nodes[0]:
+                            note += self.parse_paragraph_etree(child) + "<br/>"
+                note = note[:-5]  # Strip last <br/>
+                return self.get_annotation_as_md(annotated, note)
+            elif kind == "footnote":
+                md_line.append("[^" + self.format_number("fn", self.fn_num) + "]")
+                note = ""
+                if not isinstance(nodes[0], str):
+                    for child in nodes[0].iter("p"):
+                        if child is not nodes[0]:
+                            note += self.parse_paragraph_etree(child) + "  \n\t"
+                self.add_footnote(note)
+                return "".join(md_line)
+            else:
+                for node in nodes:
+                    if isinstance(node, str):
+                        md_line.append("{>>Unhandled: " + kind + ": " + node + "<<}")
+                    else:
+                        md_line.append(element_to_xml(node) + self.parse_paragraph_etree(node))
+                return "".join(md_line)
+            # Each child node is enclosed in start and end tag:
+            for node in nodes:
+                if isinstance(node, str):
+                    md_line.append(start_tag + node + end_tag)
+                else:
+                    md_line.append(start_tag + self.parse_paragraph_etree(node) + end_tag)
+            return "".join(md_line)
+        #endif tag == "element"
+
+        if tag == "p":
+            if document.text:
+                md_line.append(document.text)
+        elif tag == "tag":
+            if document.text:
+                # All tags, but converts codeblock '' to tab here:
+                md_line.append(re.sub(r"^[ \t]*'' ?", r"\t", document.text))
+        elif tag == "escape":
+            if document.text:
+                md_line.append(document.text[1:])  # Strips off the escape char: "\"
+        for child in document:
+            md_line.append(self.parse_paragraph_etree(child))
+            if child.tail:
+                if tag == "p":
+                    md_line.append(child.tail)
+                elif tag == "tag":
+                    md_line.append(re.sub(r"^[ \t]*'' ?", r"\t", child.tail))
+                elif tag == "escape":
+                    md_line.append(child.tail[1:])
+        return "".join(md_line)
+    #end_def parse_paragraph_etree(self, document)
+
+    def get_attacments_as_md(self, xml_data, xml_doc=None):
         # Adding all attachmets to md-output, as commented text using MMD/ CriticMarkup:
         #xml_doc = ET.parse(ulysses_file)
         attachments = ""
-        xml_doc = ET.fromstring(xml_data)
+        if xml_doc is None:
+            xml_doc = ET.fromstring(xml_data)
 
         sheet_version = xml_doc.attrib["version"]
 
@@ -487,79 +1363,167 @@ class UlyssesToMarkdown:
 
             attachments += "-->\n"
         return attachments
-    #end_def get_attacments_as_md(self, xml_data)
+    #end_def get_attacments_as_md(self, xml_data, xml_doc=None)
+
+    def post_process_line(self, line):
+        # if LINE_BREAK in line:
+        # Manual line-break in MD: add two spaces at end of line:
+        line = line.replace(LINE_BREAK, "  \n")
+
+        # Post-processing some beginning-of-line-tags:
+        if line.startswith("%% "):
+            return cmt_start + line[3:] + cmt_end
+        elif line.startswith("%%"):
+            return cmt_start + line[2:] + cmt_end
+        elif line.startswith("~~ "):
+            # Native code (HTML), don't need escaping in MD
+            return line[3:]
+        elif line.startswith("~~"):
+            return line[2:]
+        elif line.startswith("> >"):
+            # Making multiple levels of BlockQuotes as >>>> instead of > > > >:
+            line = line.replace("> ", ">")
+            # Adding one space after sequence of >>>>:
+            return re.sub(r"(^>+)", r"\1 ", line)
+        else:
+            return line
 
-    def xml2markdown(self, ulysses_path):
-        md_text = ""
+    def xml2markdown(self, ulysses_path, xml_doc=None):
+        # xml_doc: Sheet already parsed by ElementTree (root element), or None to read and parse here.
+        md_lines = []
 
         ulysses_file = ulysses_path + "/Content.xml"
 
-        ul_file = open(ulysses_file, "r", encoding='utf-8')
-        xml_data = ul_file.read()
-        ul_file.close()
-
-        xdoc = minidom.parseString(xml_data)
-
-        document = xdoc.documentElement
-        self.footnotes = ""
-        self.links = ""
-        self.img_links = ""
-        document = document.childNodes[3]
-        for child in document.childNodes:
-            if child.nodeType == child.ELEMENT_NODE:
-                if child.tagName == 'p':
-                    if child.childNodes:
+        xml_data = ""
+        if xml_doc is None or not use_etree_converter:
+            ul_file = open(ulysses_file, "r", encoding='utf-8')
+            xml_data = ul_file.read()
+            ul_file.close()
+
+        # Footnotes, links and images of sheet, as lists of lines:
+        self.footnotes = []
+        self.links = []
+        self.img_links = []
+        if use_etree_converter:
+            if xml_doc is None:
+                xml_doc = ET.fromstring(xml_data)
+            document = xml_child_nodes(xml_doc)[3]
+            if isinstance(document, str):
+                document = []
+            for child in document:
+                if child.tag == 'p':
+                    if child.text or len(child):
                         # Here is where most formatting is done:
-                        line = self.parse_paragraph(child)
-
-                        # if LINE_BREAK in line:
-                        # Manual line-break in MD: add two spaces at end of line:
-                        line = line.replace(LINE_BREAK, "  \n")
-
-                        # Post-processing some beginning-of-line-tags:
-                        if line.startswith("%% "):
-                            md_text += cmt_start + line[3:] + cmt_end
-                        elif line.startswith("%%"):
-                            md_text += cmt_start + line[2:] + cmt_end
-                        elif line.startswith("~~ "):
-                            # Native code (HTML), don't need escaping in MD
-                            md_text += line[3:]
-                        elif line.startswith("~~"):
-                            md_text += line[2:]
-                        elif line.startswith("> >"):
-                            # Making multiple levels of BlockQuotes as >>>> instead of > > > >:
-                            line = line.replace("> ", ">")
-                            # Adding one space after sequence of >>>>:
-                            line = re.sub(r"(^>+)", r"\1 ", line)
-                            md_text += line
+                        md_lines.append(self.post_process_line(self.parse_paragraph_etree(child)))
+                    else:
+                        # Empty lines:
+                        md_lines.append("")
+            #endfor child in document
+        else:
+            xml_doc = None
+            xdoc = minidom.parseString(xml_data)
+
+            document = xdoc.documentElement
+            document = document.childNodes[3]
+            for child in document.childNodes:
+                if child.nodeType == child.ELEMENT_NODE:
+                    if child.tagName == 'p':
+                        if child.childNodes:
+                            # Here is where most formatting is done:
+                            md_lines.append(self.post_process_line(self.parse_paragraph(child)))
                         else:
-                            md_text += line
-
-                    # Add line feed, also for empty lines:
-                    md_text += "\n"
-                #endif child.tagName == 'p'
-            #endif child.nodeType == child.ELEMENT_NODE:
-        #endfor child in document.childNodes
-        md_text = md_text[:-1]  # Strip last "\n"
-
-        attachments = self.get_attacments_as_md(xml_data)
-        tail = attachments + self.footnotes + self.links + self.img_links
+                            # Empty lines:
+                            md_lines.append("")
+                    #endif child.tagName == 'p'
+                #endif child.nodeType == child.ELEMENT_NODE:
+            #endfor child in document.childNodes
+        md_text = "\n".join(md_lines)
+
+        attachments = self.get_attacments_as_md(xml_data, xml_doc)
+        tail = attachments + "".join(self.footnotes) + "".join(self.links) + "".join(self.img_links)
         if tail != "":
             return md_text + "\n\n" + tail
         else:
             return md_text
-    #end_def xml2markdown(self, ulysses_path)
+    #end_def xml2markdown(self, ulysses_path, xml_doc=None)
 
 #end_class UlyssesToMarkdown
 
 
+def xml2markdown_numbered_later(ulysses_path):
+    # Runs in worker processes of ParallelConverter:
+    ul2md = UlyssesToMarkdown()
+    ul2md.numbered_later = True
+    md_text = ul2md.xml2markdown(ulysses_path)
+    return (md_text, ul2md.get_counters())
+
+
+class ParallelConverter:
+    # Converts sheets to markdown in worker processes, ahead of export order.
+    # Results are taken in export order, and then numbered like sheets converted one by one.
+    def __init__(self, pool, workers, sheet_paths, convert_paths):
+        self.pool = pool
+        self.sheet_paths = sheet_paths  # All sheets in export order
+        self.convert_paths = convert_paths  # Sheets expected to be converted, not reused
+        self.convert_all = False
+        self.window = workers * 4
+        self.futures = {}
+        self.next_pos = 0
+
+    def submit_ahead(self, pos):
+        while self.next_pos < len(self.sheet_paths) and self.next_pos < pos + self.window:
+            ul_path = self.sheet_paths[self.next_pos]
+            if self.convert_all or ul_path in self.convert_paths:
+                self.futures[self.next_pos] = self.pool.submit(xml2markdown_numbered_later,
+                                                               ul_path)
+            self.next_pos += 1
+
+    def xml2markdown(self, ul2md, pos):
+        if pos not in self.futures:
+            # Sheet expected to be reused, but numbering has changed,
+            # so the rest of the sheets will most likely be converted as well:
+            self.convert_all = True
+            self.futures[pos] = self.pool.submit(xml2markdown_numbered_later,
+                                                 self.sheet_paths[pos])
+        (md_text, counters) = self.futures.pop(pos).result()
+        return ul2md.add_numbering(md_text, counters)
+
+    def discard(self, pos):
+        # Sheet reused from last export after all:
+        if pos in self.futures:
+            self.futures.pop(pos).cancel()
+#end_class ParallelConverter
+
+
+# Media-file references in exported markdown, "Media/<media id>.#fileref":
+RE_MEDIA_FILEREF = re.compile(r"Media/([^/\s()\[\]]+?)\.#fileref")
+
+
+def get_media_map(media_files):
+    # Media-file name (spaces as %20) for each media id, from names "<name>.<media id>.<ext>":
+    media_map = {}
+    for media_file in media_files:
+        parts = media_file.split(".")
+        if len(parts) > 1 and parts[-2] not in media_map:
+            media_map[parts[-2]] = media_file.replace(" ", "%20")
+    return media_map
+
+
+def resolve_media_refs(md_text, media_map):
+    # Replaces all media-file references with file names, in one pass (unknown media ids are kept):
+    if not media_map or ".#fileref" not in md_text:
+        return md_text
+    return RE_MEDIA_FILEREF.sub(lambda match: "Media/" + media_map.get(match.group(1),
+                                match.group(1) + ".#fileref"), md_text)
+
+
 class UlFileList:
     # preprocessing all UL files for dictionary lookup, to match files on sync import:
-    # Also making plaintext filelist with filenames for export
+    # Also making plaintext filelist with filenames for export (as list of lines)
     def __init__(self):
         self.__ul_files = {}
         self.__export_paths = {}
-        self.file_list = ""
+        self.file_list = []
 
     def get_ul_files(self):
         return self.__ul_files
@@ -618,8 +1582,8 @@ class UlFileList:
                 ul_uuid = sub_path[:-8]
                 self.__ul_files[ul_uuid] = path
 
-                self.file_list += path + sub_path + "\t" + str(modified) + "\t"\
-                    + out_path + "\t" + title + "\n"
+                self.file_list.append(path + sub_path + "\t" + str(modified) + "\t"
+                                      + out_path + "\t" + title + "\n")
 
         self.__export_paths[out_path] = path
 
@@ -638,15 +1602,88 @@ class UlFileList:
 #end_class UlFileList
 
 
+class LibraryIndex:
+    # Lightweight lookup of sheets on sync import: UUID of each sheet to path of its group,
+    # from "Info.ulgroup" plists only, without parsing any sheets (as UlFileList does).
+    # Plists are cached with their date and size, and only parsed again when changed,
+    # e.g. between syncs in watch mode. (Use get_library_index() to keep index between syncs)
+    def __init__(self, ulysses_path):
+        self.ulysses_path = ulysses_path
+        self.groups = {}  # Group path: ((plist mtime, size), sheet packages, sub groups)
+        self.ul_paths = {}
+
+    def update(self):
+        # Walks groups as UlFileList.make_file_list(), sheets before sub groups:
+        groups = {}
+        ul_paths = {}
+        self.add_group(self.ulysses_path, groups, ul_paths)
+        self.groups = groups
+        self.ul_paths = ul_paths
+
+    def add_group(self, path, groups, ul_paths):
+        info_ulgroup = path + "Info.ulgroup"
+        plist_stat = os.stat(info_ulgroup)
+        plist_key = (plist_stat.st_mtime_ns, plist_stat.st_size)
+        group = self.groups.get(path)
+        if group is None or group[0] != plist_key:
+            names = [item.text for item in ET.parse(info_ulgroup).findall(".//dict/array//string")]
+            group = (plist_key, [name for name in names if name.endswith(".ulysses")],
+                     [name for name in names if name.endswith("-ulgroup")])
+        groups[path] = group
+        for package in group[1]:
+            ul_paths[package[:-8]] = path
+        for sub_group in group[2]:
+            self.add_group(path + sub_group + "/", groups, ul_paths)
+
+    def get_ul_path(self, ul_uuid):
+        # Path of group with sheet, or "" if sheet is missing:
+        path = self.ul_paths.get(ul_uuid, "")
+        if path != "" and not os.path.exists(path + ul_uuid + ".ulysses/Content.xml"):
+            return ""
+        return path
+#end_class LibraryIndex
+
+
+library_indexes = {}  # Ulysses library path: LibraryIndex, kept between syncs
+
+
+def get_library_index(ulysses_path):
+    # Index of library, updated with plists changed since last sync:
+    if ulysses_path not in library_indexes:
+        library_indexes[ulysses_path] = LibraryIndex(ulysses_path)
+    index = library_indexes[ulysses_path]
+    index.update()
+    return index
+
+
+# References in markdown, resolved by MmdRefClass:
+RE_REF_DEFINITION = re.compile(r"\[(\^?.+)\]:[\t ]*(.*)")
+RE_REF_MEDIA_COMMENT = re.compile(r"&lt;!--Media:(.+?)-->")
+RE_FOOTNOTE_REF = re.compile(r"(\[\^\d+?\])")
+RE_LINK_REF = re.compile(r"(\[.+?\])(\[\d+?\])")
+RE_IMAGE_REF = re.compile(r"!\[(.*?)\]\[(.+?)\]")
+RE_MEDIA_LINK = re.compile(r"^Media/.+?\.([0-9a-f]{32})\..+$")
+
+
 class MmdRefClass:
     # Class making dictionary lookup for all MD links, footnotes, and images.
+    # With "use_ref_table": References are substituted in one pass over the line for each kind,
+    # by callbacks from re.sub(), with footnotes and links parsed once into tables.
+    # (Footnotes are resolved before inline markup, links and images after, see md_line_to_xml)
+    # Lines with brackets inside or right after a link, e.g. "[a][b] [c][1]", are left to the earlier
+    # str.replace(), which replaces other links in the same text first.
     def __init__(self):
         self.__ref = {}
+        self.__footnotes = {}  # Key: Footnote element
+        self.__links = {}  # Key: (URL, title)
+        self.__images = {}  # Key: (URL, image, title)
+        self.__nested = False  # Link found with brackets inside or right after it
         self.md_attachments = ""
 
     def make_ref(self, md_text):
         # Loads all footnotes into dictionary and strips those lines
-        new_md_text = ""
+        new_md_lines = []
+        attachment_lines = []
         key = ""
         value = ""
         entry_found = False
@@ -656,7 +1693,7 @@ class MmdRefClass:
         for line in md_text.split("\n"):  # [:-1]:
         # Skip all lines in exported attachments:
             if in_attachments:
-                self.md_attachments += "\n" + line
+                attachment_lines.append(line)
                 if line.strip().startswith("-->"):
                     in_attachments = False
                     skip_blank_lines = True
@@ -664,10 +1701,10 @@ class MmdRefClass:
             if line.strip().startswith("&lt;!--ul_attachments:"):
                 in_attachments = True
                 # Strip last char: "\n" (extra blank line inserted by export):
-                self.md_attachments = line
+                attachment_lines = [line]
                 continue
 
-            match = re.match("\[(\^?.+)\]:[\t ]*(.*)", line)
+            match = RE_REF_DEFINITION.match(line) if line.startswith("[") else None
             if match:
                 skip_blank_lines = True
                 if entry_found:
@@ -679,7 +1716,7 @@ class MmdRefClass:
             elif entry_found and line.startswith("\t"):
                 value += "\n" + line.strip()
             elif entry_found and "&lt;!--Media:" in line:
-                media = re.sub(r"&lt;!--Media:(.+?)-->", r"\1", line)
+                media = RE_REF_MEDIA_COMMENT.sub(r"\1", line)
                 value += "\t" + media.strip()
             else:
                 if entry_found:
@@ -688,10 +1725,14 @@ class MmdRefClass:
                 elif skip_blank_lines and line.strip() == "":
                     pass
                 else:
-                    new_md_text += line + "\n"
+                    new_md_lines.append(line + "\n")
 
         if entry_found:
             self.__ref[key] = value
+        if attachment_lines:
+            self.md_attachments = "\n".join(attachment_lines)
+
+        new_md_text = "".join(new_md_lines)
 
         if skip_blank_lines:
             return new_md_text[:-2]
@@ -705,7 +1746,91 @@ class MmdRefClass:
     def get_attachments(self):
         return self.md_attachments
 
+    def get_footnote(self, key):
+        if key not in self.__footnotes:
+            value = self.__ref[key]
+            value = value.replace("\n", "</p>\n<p>")
+            self.__footnotes[key] = '<element kind="footnote"><attribute identifier="text">'\
+                '<string xml:space="preserve">\n<p>' + value + '</p>\n'\
+                '</string></attribute></element>'
+        return self.__footnotes[key]
+
+    def get_link(self, key):
+        # (URL, title) of URL link:
+        if key not in self.__links:
+            value = self.__ref[key]
+            pos = value.find(" ")
+            if pos == -1:
+                self.__links[key] = (value, "")
+            else:
+                self.__links[key] = (value[:pos], value.rstrip()[pos+2:-1])
+        return self.__links[key]
+
+    def get_image(self, key):
+        # (URL, image, title) of image link, image is id of media-file:
+        if key not in self.__images:
+            value = self.get_value(key)
+            image = ""
+            if "\t" in value:
+                parts = value.split("\t")
+                value = parts[0]
+                image = parts[1]
+            title = ""
+            url = ""
+            pos = value.find(" ")
+            if pos == -1:
+                link = value
+            else:
+                link = value[:pos]
+                title = value[pos+2:-1]
+            if link.startswith("Media/"):
+                image = RE_MEDIA_LINK.sub(r"\1", link)
+            else:
+                url = link
+            self.__images[key] = (url, image, title)
+        return self.__images[key]
+
+    def sub_link(self, match):
+        text = match.group(1)[1:-1]
+        if "[" in text or "]" in text or match.string.startswith("[", match.end()):
+            self.__nested = True
+            return match.group(0)
+        (url, title) = self.get_link(match.group(2)[1:-1])
+        return '<element kind="link">'\
+               + '<attribute identifier="URL">' + url + '</attribute>'\
+               + '<attribute identifier="title">' + title + '</attribute>'\
+               + text + '</element>'
+
+    def sub_image(self, match):
+        text_key = match.group(1) + match.group(2)
+        if "[" in text_key or "]" in text_key or match.string.startswith("[", match.end()):
+            self.__nested = True
+            return match.group(0)
+        (url, image, title) = self.get_image(match.group(2))
+        return '<element kind="image">'\
+               + '<attribute identifier="URL">' + url + '</attribute>'\
+               + '<attribute identifier="image">' + image + '</attribute>'\
+               + '<attribute identifier="title">' + title + '</attribute>'\
+               + '<attribute identifier="description">' + match.group(1) + '</attribute>'\
+               + '</element>'
+
     def get_footnotes(self, line):
+        if use_ref_table:
+            return RE_FOOTNOTE_REF.sub(lambda match: self.get_footnote(match.group(1)[1:-1]), line)
+        return self.get_footnotes_replace(line)
+
+    def get_links(self, line):
+        if use_ref_table:
+            # URL links first, as they may contain what looks like image links:
+            self.__nested = False
+            new_line = RE_LINK_REF.sub(self.sub_link, line)
+            if not self.__nested:
+                new_line = RE_IMAGE_REF.sub(self.sub_image, new_line)
+            if not self.__nested:
+                return new_line
+        return self.get_links_replace(line)
+
+    def get_footnotes_replace(self, line):
         match = re.findall("(\[\^\d+?\])", line)
         if match:
             for item in match:
@@ -718,7 +1843,7 @@ class MmdRefClass:
                 line = line.replace(item, footnote)
         return line
 
-    def get_links(self, line):
+    def get_links_replace(self, line):
         #URL Links:
         match = re.findall("(\[.+?\])(\[\d+?\])", line)
         if match:
@@ -779,7 +1904,7 @@ class MmdRefClass:
                 line = line.replace(text_key, link)
 
         return line
-    #end_def get_links(self, line)
+    #end_def get_links_replace(self, line)
 #end_class MmdRefClass
 
 
@@ -809,10 +1934,530 @@ def make_xml_comment(comment_txt):
     return comment_xml
 
 
+# Tokenizer engine for markdown_to_ulysses_xml (use_md_tokenizer).
+# Same output as the regex based md_line_to_xml_regex() below, but each inline construct is found
+# with str.find() in one scan per construct (skipped if not in line), so time is linear in line length.
+# Non-greedy regex patterns with unmatched start tags otherwise rescan to end of line for each start tag.
+RE_HEADING = re.compile(r"(#+) *(.*)")
+RE_LIST_INDENT = re.compile(r"(^[\t ]+(\* |\d+\. ))")
+RE_DIVIDER = re.compile(r"^ *- ?- ?(- ?)+[ \t]*|^ *_ ?_ ?(_ ?)+[ \t]*|^ *\* ?\* ?(\* ?)+[ \t]*")
+RE_UNORDERED = re.compile(r"^([ \t]*)([\*-+])[ \t]+(.*)")
+RE_ORDERED = re.compile(r"^([ \t]*)(\d+\.)[ \t]+(.*)")
+RE_BLOCKQUOTE = re.compile(r"^(>+) ?(.*)")
+RE_HTML_COMMENT_LINE = re.compile(r"^&lt;!--(.+)-->$")
+RE_CRITIC_COMMENT_LINE = re.compile(r"^{>>(.*)&lt;&lt;}$")
+RE_UNPAIRED_COMMENT = re.compile(r"(&lt;!--|-->|{>>|&lt;&lt;})")
+RE_MEDIA_ID = re.compile(r"\.([0-9a-f]{32})\.")
+
+
+def sub_between(line, delimiters, min_length, make_xml):
+    # Same as re.sub() with a pattern of the (literal) delimiters, with lazy groups between:
+    # "(.+?)" if min_length is 1, or "(.*?)" if 0. make_xml(*groups) returns the replacement.
+    # If a start delimiter has no match, no later start delimiter before next "\n" has either.
+    start = line.find(delimiters[0])
+    if start == -1:
+        return line
+    xml_parts = []
+    pos = 0
+    line_end = -1
+    while start != -1:
+        if start > line_end:
+            # Groups do not match "\n", as "." in regex:
+            line_end = line.find("\n", start)
+            if line_end == -1:
+                line_end = len(line)
+        end = start + len(delimiters[0])
+        groups = []
+        for delimiter in delimiters[1:]:
+            found = line.find(delimiter, end + min_length, line_end)
+            if found == -1:
+                break
+            groups.append(line[end:found])
+            end = found + len(delimiter)
+        if len(groups) < len(delimiters) - 1:
+            if line_end == len(line):
+                break
+            start = line.find(delimiters[0], line_end + 1)
+            continue
+        xml_parts.append(line[pos:start])
+        xml_parts.append(make_xml(*groups))
+        pos = end
+        start = line.find(delimiters[0], end)
+    xml_parts.append(line[pos:])
+    return "".join(xml_parts)
+#end_def sub_between(line, delimiters, min_length, make_xml)
+
+
+def sub_media_video(line):
+    # Same as re.sub() with pattern:
+    # '&lt;figure>&lt;video src="Media/.+?\.([0-9a-f]{32})\..+?">&lt;/video>&lt;/figure>'
+    video_start = '&lt;figure>&lt;video src="Media/'
+    video_end = '">&lt;/video>&lt;/figure>'
+    start = line.find(video_start)
+    xml_parts = []
+    pos = 0
+    line_end = -1
+    while start != -1:
+        if start > line_end:
+            line_end = line.find("\n", start)
+            if line_end == -1:
+                line_end = len(line)
+        # First media id, then first end tag after it:
+        match = RE_MEDIA_ID.search(line, start + len(video_start) + 1, line_end)
+        end = -1
+        if match:
+            end = line.find(video_end, match.end() + 1, line_end)
+        if end == -1:
+            if line_end == len(line):
+                break
+            start = line.find(video_start, line_end + 1)
+            continue
+        xml_parts.append(line[pos:start])
+        xml_parts.append('<element kind="video"><attribute identifier="video">' + match.group(1)
+                         + '</attribute></element>')
+        pos = end + len(video_end)
+        start = line.find(video_start, pos)
+    xml_parts.append(line[pos:])
+    return "".join(xml_parts)
+#end_def sub_media_video(line)
+
+
+HASH_BASE = 1000003
+HASH_MOD = (1 << 61) - 1
+
+
+class HtmlEndTags:
+    # HTML end tags ("&lt;/name>") in line from "start" to "end" (no "\n"), by length and hash of name.
+    # A name runs to the first ">" after its first char. Names ending at the same ">" are hashed
+    # in one backwards scan, so building is linear, also for end tags inside other end tags.
+    def __init__(self, line, start, end):
+        self.line = line
+        self.count = 0
+        self.__tags = {}
+        by_end = []  # (end of name, [start of names])
+        pos = line.find("&lt;/", start, end)
+        while pos != -1:
+            name_start = pos + 5
+            if by_end and by_end[-1][0] >= name_start + 1:
+                by_end[-1][1].append(name_start)
+            else:
+                name_end = line.find(">", name_start + 1, end)
+                if name_end == -1:
+                    break
+                by_end.append((name_end, [name_start]))
+            pos = line.find("&lt;/", pos + 1, end)
+
+        name_hashes = {}
+        for (name_end, name_starts) in by_end:
+            h = 0
+            power = 1
+            pos = name_end
+            for name_start in reversed(name_starts):
+                while pos > name_start:
+                    pos -= 1
+                    h = (h + ord(line[pos]) * power) % HASH_MOD
+                    power = (power * HASH_BASE) % HASH_MOD
+                name_hashes[name_start] = (name_end - name_start, h)
+        for name_start in sorted(name_hashes):
+            self.__tags.setdefault(name_hashes[name_start], []).append(name_start - 5)
+            self.count += 1
+
+    def find(self, name_start, name_length, name_hash, from_pos):
+        # First end tag at from_pos or later, with name: line[name_start:name_start + name_length]
+        tags = self.__tags.get((name_length, name_hash))
+        if tags:
+            name = self.line[name_start:name_start + name_length]
+            for pos in tags[bisect.bisect_left(tags, from_pos):]:
+                if self.line.startswith(name, pos + 5):
+                    return pos
+        return -1
+#end_class HtmlEndTags
+
+
+def sub_inline_native(line):
+    # Same as re.sub() with pattern: "(&lt;(?P<tag>(.+?))[> ].*?&lt;/(?P=tag)>|&lt;.+?>)"
+    # HTML paired outer tags, or single tags, make sequence inlineNative.
+    # Tag names are tried shortest first, ending before " " or first ">". Shortest name with any
+    # end tag, and then its first end tag is used. Otherwise up to first ">".
+    start = line.find("&lt;")
+    xml_parts = []
+    pos = 0
+    line_end = -1
+    end_tags = None
+    while start != -1:
+        if start > line_end:
+            line_start = line.rfind("\n", 0, start) + 1
+            line_end = line.find("\n", start)
+            if line_end == -1:
+                line_end = len(line)
+            end_tags = None
+        name_start = start + 4
+        first_gt = line.find(">", name_start + 1, line_end)
+        if first_gt == -1:
+            # Neither alternative matches, here or later before "\n":
+            if line_end == len(line):
+                break
+            start = line.find("&lt;", line_end + 1)
+            continue
+        end = first_gt + 1
+        if end_tags is None:
+            end_tags = HtmlEndTags(line, line_start, line_end)
+        h = ord(line[name_start])
+        for name_end in range(name_start + 1, first_gt + 1 if end_tags.count else 0):
+            if line[name_end] == " " or name_end == first_gt:
+                tag_pos = end_tags.find(name_start, name_end - name_start, h, name_end + 1)
+                if tag_pos != -1:
+                    end = tag_pos + 5 + name_end - name_start + 1
+                    break
+            h = (h * HASH_BASE + ord(line[name_end])) % HASH_MOD
+        xml_parts.append(line[pos:start])
+        xml_parts.append('<element kind="inlineNative" startTag="~">' + line[start:end] + '</element>')
+        pos = end
+        start = line.find("&lt;", end)
+    xml_parts.append(line[pos:])
+    return "".join(xml_parts)
+#end_def sub_inline_native(line)
+
+
+def md_line_to_xml(line, ref):
+    # Converts one line of markdown to Ulysses XML paragraph content (tokenizer engine).
+    # Steps, and their order, as in md_line_to_xml_regex(), since later steps work on output of
+    # earlier ones, but each step only if its markup is in line.
+    # Returns (xml_line, codeblock), no further processing of code blocks.
+    tag_done = False
+
+    # All Headings:
+    if line.startswith("#"):
+        match = RE_HEADING.search(line)
+        if match:
+            tag = match.group(1)
+            level = len(tag)
+            text = match.group(2)
+            if level > 6:
+                level = 6
+                tag = "######"
+            line = '<tags><tag kind="heading' + str(level) + '">'\
+                + tag + ' </tag></tags>' + text
+            tag_done = True
+
+    # Codeblock:
+    if line.startswith("\t") or line.startswith("    "):
+        if not RE_LIST_INDENT.match(line):
+            if line.startswith("\t"):
+                line = line[1:]
+            else:
+                line = line[4:]
+            # (Same as regex replacement string, keeping backslashes)
+            return (r'<tags><tag kind="codeblock">\'\' </tag></tags>' + line, True)
+
+    if not tag_done and line.lstrip(" ")[:1] in ("-", "_", "*"):
+        line = RE_DIVIDER.sub(r'<tags><tag kind="divider">---- </tag></tags>', line)
+
+    # Footnotes:
+    if "[^" in line:
+        line = ref.get_footnotes(line)
+
+    # Strong and emph:
+    if "*" in line:
+        line = sub_between(line, ["**", "**"], 1,
+                           lambda text: '<element kind="strong" startTag="2ast">' + text + '</element>')
+    if "_" in line:
+        line = sub_between(line, ["__", "__"], 1,
+                           lambda text: '<element kind="strong" startTag="2und">' + text + '</element>')
+    if "*" in line:
+        line = sub_between(line, ["*", "*"], 1,
+                           lambda text: '<element kind="emph" startTag="ast">' + text + '</element>')
+    if "_" in line:
+        line = sub_between(line, ["_", "_"], 1,
+                           lambda text: '<element kind="emph" startTag="und">' + text + '</element>')
+
+    # Unordered List:
+    if not tag_done:
+        match = RE_UNORDERED.match(line)
+        if match:
+            indent = match.group(1).replace("\t", " " * 4)
+            tabs = "<tag>\t</tag>" * int(len(indent) / 4)  # 4 space = 1 tab
+            line = RE_UNORDERED.sub(r'<tags>' + tabs + r'<tag kind="unorderedList">\2 </tag></tags>\3',
+                                    line)
+            tag_done = True
+
+    # Ordered List:
+    if not tag_done:
+        match = RE_ORDERED.match(line)
+        if match:
+            indent = match.group(1).replace("\t", " " * 4)
+            tabs = "<tag>\t</tag>" * int(len(indent) / 4)  # 4 space = 1 tab
+            line = RE_ORDERED.sub(r'<tags>' + tabs + r'<tag kind="orderedList">\2 </tag></tags>\3',
+                                  line)
+            tag_done = True
+
+    # BlockQuote:
+    if not tag_done and line.startswith(">"):
+        line = line.replace("> ", ">")
+        match = RE_BLOCKQUOTE.search(line)
+        tags = '<tag kind="blockquote">&gt; </tag>' * len(match.group(1))
+        line = RE_BLOCKQUOTE.sub(r'<tags>' + tags + r'</tags>\2', line)
+        tag_done = True
+
+    # Html and CriticsMarkup comment "block", line by line only
+    if not tag_done:
+        if line.startswith("&lt;!--"):
+            line = RE_HTML_COMMENT_LINE.sub(r'<tags><tag kind="comment">%% </tag></tags>\1', line)
+        if line.startswith("{>>"):
+            line = RE_CRITIC_COMMENT_LINE.sub(r'<tags><tag kind="comment">%% </tag></tags>\1', line)
+
+    # **Inline Elements:**
+    # inline code:
+    if "`" in line:
+        line = sub_between(line, ["`", "`"], 1,
+                           lambda text: '<element kind="code" startTag="`">' + text + '</element>')
+
+    # Postprocessing strong and emph:
+    if 'startTag="' in line:
+        line = line.replace('startTag="2ast">', 'startTag="**">')
+        line = line.replace('startTag="2und">', 'startTag="__">')
+        line = line.replace('startTag="ast">', 'startTag="*">')
+        line = line.replace('startTag="und">', 'startTag="_">')
+
+    # Inline html video:
+    if "&lt;video src=" in line:
+        if "&lt;!--Media:" in line:
+            line = sub_between(line, ['&lt;figure>&lt;video src="', '">&lt;!--Media:',
+                                      '-->&lt;/video>&lt;/figure>'], 1,
+                               lambda url, video: '<element kind="video"><attribute identifier="URL">'
+                               + url + '</attribute><attribute identifier="video">' + video
+                               + '</attribute></element>')
+        elif "Media/" in line:
+            line = sub_media_video(line)
+        else:
+            line = sub_between(line, ['&lt;figure>&lt;video src="', '">&lt;/video>&lt;/figure>'], 1,
+                               lambda url: '<element kind="video"><attribute identifier="URL">'
+                               + url + '</attribute></element>')
+
+    if "&lt;" in line or "{" in line:
+        # inline delete:
+        make_delete = lambda text: '<element kind="delete" startTag="||">' + text + '</element>'
+        line = sub_between(line, ["&lt;!--Delete:", "-->"], 1, make_delete)
+        line = sub_between(line, ["{--", "--}"], 1, make_delete)
+
+        # inline mark:
+        make_mark = lambda text: '<element kind="mark" startTag="::">' + text + '</element>'
+        line = sub_between(line, ["&lt;span class='mark'>", "&lt;/span>"], 1, make_mark)
+        line = sub_between(line, ["{++", "++}"], 1, make_mark)
+
+        # Annotations:
+        make_annotation = lambda text, note: '<element kind="annotation"><attribute identifier="text">'\
+            + '<string xml:space="preserve"><p>' + note + '</p>'\
+            + '</string></attribute>' + text + '</element>'
+        line = sub_between(line, ["&lt;span class='annotation'>", "&lt;/span>&lt;!--", "-->"], 0,
+                           make_annotation)
+        line = sub_between(line, ["{==", "==}{>>", "&lt;&lt;}"], 0, make_annotation)
+        if '<element kind="annotation">' in line:
+            line = line.replace("&lt;br/>", "</p><p>")
+
+        # Inline comments:
+        make_comment = lambda text: '<element kind="inlineComment" startTag="++">' + text + '</element>'
+        line = sub_between(line, ["&lt;!--", "-->"], 0, make_comment)
+        line = sub_between(line, ["{>>", "&lt;&lt;}"], 0, make_comment)
+
+    if "&lt;" in line:
+        # Inline Native: HTML paired outer tags, or single tags, make sequence inlineNative:
+        line = sub_inline_native(line)
+
+    # Unpaired HTML- or Critic Markup- comment tags,
+    # and make them inlineNative Roundtrip safe:
+    if "&lt;" in line or "-->" in line or "{>>" in line:
+        line = RE_UNPAIRED_COMMENT.sub(r'<element kind="inlineNative" startTag="~">\1</element>', line)
+
+    #Get any fn, img, or links:
+    if "[" in line:
+        line = ref.get_links(line)
+
+    #Escaping remaining start tags:
+    line = line.replace("\\", "<escape>\\\\</escape>")
+    line = line.replace("{", "<escape>\{</escape>")
+    line = line.replace("[", "<escape>\[</escape>")
+
+    #Just in case someone have entered these in markdown file :)
+    if "(" in line:
+        line = line.replace("(fn)", "<escape>\(</escape>fn)")
+        line = line.replace("(img)", "<escape>\(</escape>img)")
+        line = line.replace("(vid)", "<escape>\(</escape>vid)")
+    return (line, False)
+#end_def md_line_to_xml(line, ref)
+
+
+def md_line_to_xml_regex(line, ref):
+    # Converts one line of markdown to Ulysses XML paragraph content, using regular expressions.
+    # Returns (xml_line, codeblock), no further processing of code blocks.
+    tag_done = False
+
+    # StartOfLine tags:
+    # All Headings:
+    if line.startswith("#"):
+        match = re.search(r"(#+) *(.*)", line)
+        if match:
+            tag = match.group(1)
+            level = len(tag)
+            text = match.group(2)
+            if level > 6:
+                level = 6
+                tag = "######"
+            line = '<tags><tag kind="heading' + str(level) + '">'\
+                + tag + ' </tag></tags>' + text
+            tag_done = True
+
+    # Codeblock, Should be first, to avoid further processing:
+    # if re.match(r"^\t(?![\t ]*(\* |\d+\. ))", line):  # Neg. lookahed assertion not working??
+    # So workaround here:
+    if re.match(r"(^\t|^    )", line) and not re.match(r"(^[\t ]+(\* |\d+\. ))", line):
+        line = re.sub(r"(^\t|^    )(.*)",
+                      r'<tags><tag kind="codeblock">\'\' </tag></tags>\2', line)
+        # Continnue to next line, no inline processing of codeblocks:
+        return (line, True)
+
+    if not tag_done:
+        line = re.sub(r"^ *- ?- ?(- ?)+[ \t]*|^ *_ ?_ ?(_ ?)+[ \t]*|^ *\* ?\* ?(\* ?)+[ \t]*",
+                      r'<tags><tag kind="divider">---- </tag></tags>', line)
+
+    # Footnotes:
+    line = ref.get_footnotes(line)
+
+    # Strong and emph:
+    line = re.sub(r"\*\*(.+?)\*\*", r'<element kind="strong" startTag="2ast">\1</element>',
+                  line)
+    line = re.sub(r"__(.+?)__", r'<element kind="strong" startTag="2und">\1</element>', line)
+    line = re.sub(r"\*(.+?)\*", r'<element kind="emph" startTag="ast">\1</element>', line)
+    line = re.sub(r"_(.+?)_", r'<element kind="emph" startTag="und">\1</element>', line)
+
+    # Unordered List:
+    if not tag_done:
+        # tabs, spaces, mix or none for indented sublevels.
+        match = re.search(r"^([ \t]*)([\*-+])[ \t]+(.*)", line)
+        if match:
+            indent = match.group(1).replace("\t", " " * 4)
+            tabs = "<tag>\t</tag>" * int(len(indent) / 4)  # 4 space = 1 tab
+            line = re.sub(r"^[ \t]*([\*-+])[ \t]+(.*)",
+                          r'<tags>' + tabs +
+                          r'<tag kind="unorderedList">\1 </tag></tags>\2', line)
+            tag_done = True
+
+    # Ordered List:
+    if not tag_done:
+        # tabs, spaces, mix or none for indented sublevels.
+        match = re.search(r"^([ \t]*)(\d+\.)[ \t]+(.*)", line)
+        if match:
+            indent = match.group(1).replace("\t", " " * 4)
+            tabs = "<tag>\t</tag>" * int(len(indent) / 4)  # 4 space = 1 tab
+            line = re.sub(r"^[ \t]*(\d+\.)[ \t]+(.*)", r'<tags>' + tabs +
+                          r'<tag kind="orderedList">\1 </tag></tags>\2', line)
+            tag_done = True
+
+    # BlockQuote:
+    if not tag_done:
+        match = re.search(r"^(>+) ?(.*)", line)
+        if match:
+            line = line.replace("> ", ">")
+            match = re.search(r"^(>+) ?(.*)", line)
+            tags = '<tag kind="blockquote">&gt; </tag>' * len(match.group(1))
+            line = re.sub(r"^(>)+ ?(.*)", r'<tags>' + tags + r'</tags>\2', line)
+            tag_done = True
+
+    # Html and CriticsMarkup comment "block", line by line only
+    if not tag_done:
+        line = re.sub(r"^&lt;!--(.+)-->$", r'<tags><tag kind="comment">%% </tag></tags>\1',
+                      line)
+        line = re.sub(r"^{>>(.*)&lt;&lt;}$", r'<tags><tag kind="comment">%% </tag></tags>\1',
+                      line)
+
+    # **Inline Elements:**
+    # inline code:
+    line = re.sub(r"`(.+?)`", r'<element kind="code" startTag="`">\1</element>', line)
+
+    # Postprocessing strong and emph:
+    line = line.replace('startTag="2ast">', 'startTag="**">')
+    line = line.replace('startTag="2und">', 'startTag="__">')
+    line = line.replace('startTag="ast">', 'startTag="*">')
+    line = line.replace('startTag="und">', 'startTag="_">')
+
+    # Inline html video:
+    if "&lt;video src=" in line:
+        if "&lt;!--Media:" in line:
+            line = re.sub(r'&lt;figure>&lt;video src="(.+?)">&lt;!--Media:(.+?)-->&lt;/video>&lt;/figure>',
+                          r'<element kind="video"><attribute identifier="URL">\1</attribute>'
+                          + r'<attribute identifier="video">\2</attribute></element>',
+                          line)
+        elif "Media/" in line:
+            line = re.sub(r'&lt;figure>&lt;video src="Media/.+?\.([0-9a-f]{32})\..+?">&lt;/video>&lt;/figure>',
+                          r'<element kind="video"><attribute identifier="video">\1</attribute></element>',
+                          line)
+        else:
+            line = re.sub(r'&lt;figure>&lt;video src="(.+?)">&lt;/video>&lt;/figure>',
+                          r'<element kind="video"><attribute identifier="URL">\1</attribute></element>',
+                          line)
+
+    # inline delete:
+    re_repl = r'<element kind="delete" startTag="||">\1</element>'
+    line = re.sub(r"&lt;!--Delete:(.+?)-->", re_repl, line)
+    line = re.sub(r"{--(.+?)--}", re_repl, line)
+
+    # inline mark:
+    re_repl = r'<element kind="mark" startTag="::">\1</element>'
+    line = re.sub(r"&lt;span class='mark'>(.+?)&lt;/span>", re_repl, line)
+    line = re.sub(r"{\+\+(.+?)\+\+}", re_repl, line)
+
+    # Annotations:
+    re_repl = r'<element kind="annotation"><attribute identifier="text">'\
+              + r'<string xml:space="preserve"><p>\2</p>'\
+              + r'</string></attribute>\1</element>'
+    line = re.sub(r"&lt;span class='annotation'>(.*?)&lt;/span>&lt;!--(.*?)-->", re_repl, line)
+    line = re.sub(r"{==(.*?)==}{>>(.*?)&lt;&lt;}", re_repl, line)
+    if '<element kind="annotation">' in line:
+        line = line.replace("&lt;br/>", "</p><p>")
+        # Note "reverse order" of p-tags when replacing </br>!
+        # This is also ok even if </br> should appear somewhere else in line,
+        # since line is wrapped by p-tags in calling function: '<p>'+line+'</p>'
+
+    # debug(935, line, 'kind="annotation"' in line)
+
+    # Inline comments:
+    re_repl = r'<element kind="inlineComment" startTag="++">\1</element>'
+    line = re.sub(r"&lt;!--(.*?)-->", re_repl, line)
+    line = re.sub(r"{>>(.*?)&lt;&lt;}", re_repl, line)
+
+    # Inline Native:
+    re_repl = r'<element kind="inlineNative" startTag="~">\1</element>'
+
+    # HTML paired outer tags, or single tags, make sequence inlineNative:
+    line = re.sub(r"(&lt;(?P<tag>(.+?))[> ].*?&lt;/(?P=tag)>|&lt;.+?>)", re_repl, line)
+    # debug(968, line, "&lt;!--" in line, False)
+
+    # Unpaired HTML- or Critic Markup- comment tags,
+    # and make them inlineNative Roundtrip safe:
+    line = re.sub(r"(&lt;!--|-->|{>>|&lt;&lt;})", re_repl, line)
+    # debug(972, line, "&lt;!--" in line)
+
+    #Get any fn, img, or links:
+    line = ref.get_links(line)
+
+    #Escaping remaining start tags:
+    line = line.replace("\\", "<escape>\\\\</escape>")
+    line = line.replace("{", "<escape>\{</escape>")
+    line = line.replace("[", "<escape>\[</escape>")
+
+    #Just in case someone have entered these in markdown file :)
+    line = line.replace("(fn)", "<escape>\(</escape>fn)")
+    line = line.replace("(img)", "<escape>\(</escape>img)")
+    line = line.replace("(vid)", "<escape>\(</escape>vid)")
+
+    return (line, False)
+#end_def md_line_to_xml_regex(line, ref)
+
+
 def markdown_to_ulysses_xml(md_text, ul_path, comment_txt, keep_attachments):
     # Main function for converting MultiMarkdown exported from Ulysses,
     # back to Ulysses XML format, on sync/import.
-    xml_body = ""
+    xml_body = []
     line_num = 1
     xml_head = """
 <markup version="1" identifier="markdownxl" displayName="Markdown XL">
@@ -869,185 +2514,32 @@ def markdown_to_ulysses_xml(md_text, ul_path, comment_txt, keep_attachments):
 
     md_lines = md_text.split("\n")  # [:-1]
     for line in md_lines:
-
-        tag_done = False
-
-        # StartOfLine tags:
-        # All Headings:
-        if line.startswith("#"):
-            match = re.search(r"(#+) *(.*)", line)
-            if match:
-                tag = match.group(1)
-                level = len(tag)
-                text = match.group(2)
-                if level > 6:
-                    level = 6
-                    tag = "######"
-                line = '<tags><tag kind="heading' + str(level) + '">'\
-                    + tag + ' </tag></tags>' + text
-                tag_done = True
-
-        # Codeblock, Should be first, to avoid further processing:
-        # if re.match(r"^\t(?![\t ]*(\* |\d+\. ))", line):  # Neg. lookahed assertion not working??
-        # So workaround here:
-        if re.match(r"(^\t|^    )", line) and not re.match(r"(^[\t ]+(\* |\d+\. ))", line):
-            line = re.sub(r"(^\t|^    )(.*)",
-                          r'<tags><tag kind="codeblock">\'\' </tag></tags>\2', line)
-            # Continnue to next line, no inline processing of codeblocks:
-            xml_body += "<p>" + line + "</p>\n"
+        if use_md_tokenizer:
+            (line, codeblock) = md_line_to_xml(line, ref)
+        else:
+            (line, codeblock) = md_line_to_xml_regex(line, ref)
+        if codeblock:
             # Skip to next line, no further processing of code blocks:
+            xml_body.append("<p>" + line + "</p>\n")
             continue
 
-        if not tag_done:
-            line = re.sub(r"^ *- ?- ?(- ?)+[ \t]*|^ *_ ?_ ?(_ ?)+[ \t]*|^ *\* ?\* ?(\* ?)+[ \t]*",
-                          r'<tags><tag kind="divider">---- </tag></tags>', line)
-
-        # Footnotes:
-        line = ref.get_footnotes(line)
-
-        # Strong and emph:
-        line = re.sub(r"\*\*(.+?)\*\*", r'<element kind="strong" startTag="2ast">\1</element>',
-                      line)
-        line = re.sub(r"__(.+?)__", r'<element kind="strong" startTag="2und">\1</element>', line)
-        line = re.sub(r"\*(.+?)\*", r'<element kind="emph" startTag="ast">\1</element>', line)
-        line = re.sub(r"_(.+?)_", r'<element kind="emph" startTag="und">\1</element>', line)
-
-        # Unordered List:
-        if not tag_done:
-            # tabs, spaces, mix or none for indented sublevels.
-            match = re.search(r"^([ \t]*)([\*-+])[ \t]+(.*)", line)
-            if match:
-                indent = match.group(1).replace("\t", " " * 4)
-                tabs = "<tag>\t</tag>" * int(len(indent) / 4)  # 4 space = 1 tab
-                line = re.sub(r"^[ \t]*([\*-+])[ \t]+(.*)",
-                              r'<tags>' + tabs +
-                              r'<tag kind="unorderedList">\1 </tag></tags>\2', line)
-                tag_done = True
-
-        # Ordered List:
-        if not tag_done:
-            # tabs, spaces, mix or none for indented sublevels.
-            match = re.search(r"^([ \t]*)(\d+\.)[ \t]+(.*)", line)
-            if match:
-                indent = match.group(1).replace("\t", " " * 4)
-                tabs = "<tag>\t</tag>" * int(len(indent) / 4)  # 4 space = 1 tab
-                line = re.sub(r"^[ \t]*(\d+\.)[ \t]+(.*)", r'<tags>' + tabs +
-                              r'<tag kind="orderedList">\1 </tag></tags>\2', line)
-                tag_done = True
-
-        # BlockQuote:
-        if not tag_done:
-            match = re.search(r"^(>+) ?(.*)", line)
-            if match:
-                line = line.replace("> ", ">")
-                match = re.search(r"^(>+) ?(.*)", line)
-                tags = '<tag kind="blockquote">&gt; </tag>' * len(match.group(1))
-                line = re.sub(r"^(>)+ ?(.*)", r'<tags>' + tags + r'</tags>\2', line)
-                tag_done = True
-
-        # Html and CriticsMarkup comment "block", line by line only
-        if not tag_done:
-            line = re.sub(r"^&lt;!--(.+)-->$", r'<tags><tag kind="comment">%% </tag></tags>\1',
-                          line)
-            line = re.sub(r"^{>>(.*)&lt;&lt;}$", r'<tags><tag kind="comment">%% </tag></tags>\1',
-                          line)
-
-        # **Inline Elements:**
-        # inline code:
-        line = re.sub(r"`(.+?)`", r'<element kind="code" startTag="`">\1</element>', line)
-
-        # Postprocessing strong and emph:
-        line = line.replace('startTag="2ast">', 'startTag="**">')
-        line = line.replace('startTag="2und">', 'startTag="__">')
-        line = line.replace('startTag="ast">', 'startTag="*">')
-        line = line.replace('startTag="und">', 'startTag="_">')
-
-        # Inline html video:
-        if "&lt;video src=" in line:
-            if "&lt;!--Media:" in line:
-                line = re.sub(r'&lt;figure>&lt;video src="(.+?)">&lt;!--Media:(.+?)-->&lt;/video>&lt;/figure>',
-                              r'<element kind="video"><attribute identifier="URL">\1</attribute>'
-                              + r'<attribute identifier="video">\2</attribute></element>',
-                              line)
-            elif "Media/" in line:
-                line = re.sub(r'&lt;figure>&lt;video src="Media/.+?\.([0-9a-f]{32})\..+?">&lt;/video>&lt;/figure>',
-                              r'<element kind="video"><attribute identifier="video">\1</attribute></element>',
-                              line)
-            else:
-                line = re.sub(r'&lt;figure>&lt;video src="(.+?)">&lt;/video>&lt;/figure>',
-                              r'<element kind="video"><attribute identifier="URL">\1</attribute></element>',
-                              line)
-
-        # inline delete:
-        re_repl = r'<element kind="delete" startTag="||">\1</element>'
-        line = re.sub(r"&lt;!--Delete:(.+?)-->", re_repl, line)
-        line = re.sub(r"{--(.+?)--}", re_repl, line)
-
-        # inline mark:
-        re_repl = r'<element kind="mark" startTag="::">\1</element>'
-        line = re.sub(r"&lt;span class='mark'>(.+?)&lt;/span>", re_repl, line)
-        line = re.sub(r"{\+\+(.+?)\+\+}", re_repl, line)
-
-        # Annotations:
-        re_repl = r'<element kind="annotation"><attribute identifier="text">'\
-                  + r'<string xml:space="preserve"><p>\2</p>'\
-                  + r'</string></attribute>\1</element>'
-        line = re.sub(r"&lt;span class='annotation'>(.*?)&lt;/span>&lt;!--(.*?)-->", re_repl, line)
-        line = re.sub(r"{==(.*?)==}{>>(.*?)&lt;&lt;}", re_repl, line)
-        if '<element kind="annotation">' in line:
-            line = line.replace("&lt;br/>", "</p><p>")
-            # Note "reverse order" of p-tags when replacing </br>!
-            # This is also ok even if </br> should appear somewhere else in line,
-            # since line is wrapped by p-tags in calling function: '<p>'+line+'</p>'
-
-        # debug(935, line, 'kind="annotation"' in line)
-
-        # Inline comments:
-        re_repl = r'<element kind="inlineComment" startTag="++">\1</element>'
-        line = re.sub(r"&lt;!--(.*?)-->", re_repl, line)
-        line = re.sub(r"{>>(.*?)&lt;&lt;}", re_repl, line)
-
-        # Inline Native:
-        re_repl = r'<element kind="inlineNative" startTag="~">\1</element>'
-
-        # HTML paired outer tags, or single tags, make sequence inlineNative:
-        line = re.sub(r"(&lt;(?P<tag>(.+?))[> ].*?&lt;/(?P=tag)>|&lt;.+?>)", re_repl, line)
-        # debug(968, line, "&lt;!--" in line, False)
-
-        # Unpaired HTML- or Critic Markup- comment tags,
-        # and make them inlineNative Roundtrip safe:
-        line = re.sub(r"(&lt;!--|-->|{>>|&lt;&lt;})", re_repl, line)
-        # debug(972, line, "&lt;!--" in line)
-
-        #Get any fn, img, or links:
-        line = ref.get_links(line)
-
-        #Escaping remaining start tags:
-        line = line.replace("\\", "<escape>\\\\</escape>")
-        line = line.replace("{", "<escape>\{</escape>")
-        line = line.replace("[", "<escape>\[</escape>")
-
-        #Just in case someone have entered these in markdown file :)
-        line = line.replace("(fn)", "<escape>\(</escape>fn)")
-        line = line.replace("(img)", "<escape>\(</escape>img)")
-        line = line.replace("(vid)", "<escape>\(</escape>vid)")
-
-        xml_body += "<p>" + line + "</p>\n"
+        xml_body.append("<p>" + line + "</p>\n")
         if line_num == 1 and comment_txt != "":
             #  Add comment below title/ first line:
-            xml_body += make_xml_comment(comment_txt)
+            xml_body.append(make_xml_comment(comment_txt))
         line_num += 1
 
     #endfor line in md_text.split("\n")
-    xml_body += "</string>\n"
-    ul_xml_text = xml_sheet + xml_head + xml_body + xml_attachments + "</sheet>"
+    xml_body.append("</string>\n")
+    ul_xml_text = xml_sheet + xml_head + "".join(xml_body) + xml_attachments + "</sheet>"
     #*** Maybe move file handling from "sync_files" and "LogFileSheet.write_log_sheet" to here
     return ul_xml_text
 #end_def markdown_to_ulysses_xml(md_text, ul_path, comment_txt, keep_attachments)
 
 
-def check_files(sync_file, from_file, to_file):
-    synced_ts = get_file_date(sync_file)
+def check_files(synced_ts, from_file, to_file, synced_hash=None):
+    # synced_hash: Hash of "to_file" at last sync, if known.
+    # Then "to_file" is only changed if content is changed, not only file date.
     #from_ts = get_file_date(from_file)
     to_ts = 0
     if os.path.exists(to_file):
@@ -1057,48 +2549,88 @@ def check_files(sync_file, from_file, to_file):
         return False
 
     if to_ts > synced_ts:
+        if synced_hash and get_file_hash(to_file) == synced_hash:
+            return True
         print("Target file changed:", datetime.datetime.fromtimestamp(to_ts), to_file)
         return False
     else:
         return True
 
 
-def update_info_plist(ul_path, append_sheet=True):
-    pos = ul_path.rfind("/", 0, -2)
-    path = ul_path[:pos+1]
-    new_ul_filename = ul_path[pos+1: -1]
-    info_file = path + "Info.ulgroup"
+def read_plist(plist_file):
+    # plistlib.readPlist() is removed in python 3.9, plistlib.load() is new in python 3.4:
+    if not hasattr(plistlib, "load"):
+        return plistlib.readPlist(plist_file)
+    f = open(plist_file, "rb")
+    pl = plistlib.load(f)
+    f.close()
+    return pl
 
-    pl = plistlib.readPlist(info_file)
 
-    try:
-        if append_sheet:
-            pl["sheetClusters"].append([new_ul_filename])
-        else:
-            pl["sheetClusters"].insert(0, [new_ul_filename])
-    except:
-        pl["sheetClusters"] = []
-        pl["sheetClusters"].append([new_ul_filename])
+def write_plist(pl, plist_file):
+    if not hasattr(plistlib, "dump"):
+        plistlib.writePlist(pl, plist_file)
+        return
+    f = open(plist_file, "wb")
+    plistlib.dump(pl, f)
+    f.close()
 
-    plistlib.writePlist(pl, info_file)
 
+class PlistUpdates:
+    # Changes to groups' "Info.ulgroup" plists, collected while syncing, and written by flush():
+    # Each plist is read and written once, to a temp file renamed over the plist (atomic),
+    # e.g. when sync import makes many new sheets in inbox. (Ulysses is watching these files)
+    def __init__(self):
+        self.changes = {}  # Plist file: [(key, item, append)]
 
-def add_group_plist(ul_path):
+    def add(self, info_file, key, item, append=True):
+        self.changes.setdefault(info_file, []).append((key, item, append))
+
+    def flush(self):
+        for (info_file, changes) in self.changes.items():
+            pl = read_plist(info_file)
+            for (key, item, append) in changes:
+                try:
+                    if append:
+                        pl[key].append(item)
+                    else:
+                        pl[key].insert(0, item)
+                except:
+                    pl[key] = []
+                    pl[key].append(item)
+            (folder, name) = os.path.split(info_file)
+            temp_file = os.path.join(folder, "." + name + ".ulysses_temp")
+            write_plist(pl, temp_file)
+            os.replace(temp_file, info_file)
+            library_writes.add(info_file)
+        self.changes = {}
+#end_class PlistUpdates
+
+
+# Plist changes not yet written, flushed at end of sync import, and when log sheet is written:
+plist_updates = PlistUpdates()
+
+# Packages and group plists written to Ulysses libraries by sync (import and log sheet)
+# since last listing, listed again when only changed sheets are exported (update_groups):
+library_writes = set()
+
+
+def get_info_plist(ul_path):
+    # Plist of group with sheet or group "ul_path" (ending with "/"), and name of sheet or group:
     pos = ul_path.rfind("/", 0, -2)
-    path = ul_path[:pos+1]
-    new_ul_filename = ul_path[pos+1: -1]
-    info_file = path + "Info.ulgroup"
-    # debug(1024, info_file, new_ul_filename)
-    pl = plistlib.readPlist(info_file)
+    return (ul_path[:pos+1] + "Info.ulgroup", ul_path[pos+1: -1])
 
-    try:
-        # pl["sheetClusters"].insert(0, [new_ul_filename])
-        pl["childOrder"].append(new_ul_filename)
-    except:
-        pl["childOrder"] = []
-        pl["childOrder"].append(new_ul_filename)
 
-    plistlib.writePlist(pl, info_file)
+def update_info_plist(ul_path, append_sheet=True):
+    # Adds new sheet "ul_path" to its group (written by plist_updates.flush()):
+    (info_file, new_ul_filename) = get_info_plist(ul_path)
+    plist_updates.add(info_file, "sheetClusters", [new_ul_filename], append_sheet)
+
+
+def add_group_plist(ul_path):
+    # Adds new group "ul_path" to its parent group (written by plist_updates.flush()):
+    (info_file, new_ul_filename) = get_info_plist(ul_path)
+    plist_updates.add(info_file, "childOrder", new_ul_filename)
 
 
 class LogFileSheet:
@@ -1134,6 +2666,7 @@ class LogFileSheet:
             write_file(info_file, self.empty_group_plist)
             # debug(1069, synclog_path)
             add_group_plist(synclog_path)
+            plist_updates.flush()
         return synclog_path
 
     def add_entry(self, text):
@@ -1182,120 +2715,676 @@ class LogFileSheet:
 
         write_file(xml_file, log_sheet_xml)
         write_file(txt_file, self.log_sheet_md)
+        metrics.count("files_written", 2)
+        metrics.count("bytes_written", get_file_size(xml_file) + get_file_size(txt_file))
         ts = get_file_date(xml_file)
         set_file_date(ul_path, ts)
+        plist_updates.flush()
         #set_file_date(self.inbox_path + "Info.ulgroup", ts)
 
 #end_class LogFileSheet
 
 
-def sync_files(sync_path, ulysses_path, log):
+class ListDirEntry:
+    # As os.DirEntry, for Python versions without os.scandir() (before 3.5):
+    def __init__(self, path, name):
+        self.name = name
+        self.path = os.path.join(path, name)
+
+    def is_dir(self):
+        return os.path.isdir(self.path)
+
+    def is_symlink(self):
+        return os.path.islink(self.path)
+
+    def stat(self):
+        return os.stat(self.path)
+#end_class ListDirEntry
+
+
+def scandir(path):
+    if hasattr(os, "scandir"):
+        return list(os.scandir(path))
+    return [ListDirEntry(path, name) for name in os.listdir(path)]
+
+
+class ExportScan:
+    # Finds md-files in export folder "sync_path" changed since last sync import, for sync_files():
+    # Folders are read by os.scandir(), and files are compared by date and size to a manifest
+    # of files checked at last import (in sync state). Only new and changed files are yielded,
+    # lazily, by changed_files(), and noted by set_checked() when checked. save() saves manifest.
+    # With "scan_skip_unchanged_folders", folders with same date as last import are not read,
+    # but only their sub folders (folder dates only change when files are added, deleted or renamed).
+    # changed_files: Only these files are checked, if given (e.g. by FolderWatcher).
+    def __init__(self, sync_path, state, changed_files=None):
+        self.root = sync_path.rstrip("/")
+        self.state = state
+        self.changed = changed_files
+        self.manifest = state.get_scan_manifest()
+        self.updates = {}
+        self.seen = set()
+        self.skipped = set()  # Folders not read, files kept in manifest
+        self.sub_folders = {}  # Folder: Sub folders, in manifest
+        if scan_skip_unchanged_folders:
+            for (path, (mtime_ns, size)) in self.manifest.items():
+                if size == -1:
+                    self.sub_folders.setdefault(path[:path.rfind("/")], []).append(path)
+
+    def changed_files(self):
+        # Yields (full_name, stat) of md-files changed since last import (in same order as os.walk):
+        if self.changed is not None:
+            names = [os.path.split(full_name) for full_name in self.changed
+                     if full_name.startswith(self.root + "/") and full_name.endswith(".md")]
+            for (dirpath, fname) in sorted(names):
+                try:
+                    file_stat = os.stat(dirpath + "/" + fname)
+                except OSError:
+                    continue
+                if stat.S_ISREG(file_stat.st_mode):
+                    yield (dirpath + "/" + fname, file_stat)
+            return
+        try:
+            root_stat = os.stat(self.root)
+        except OSError:
+            return
+        yield from self.scan_folder(self.root, root_stat)
+
+    def scan_folder(self, dirpath, folder_stat):
+        self.seen.add(dirpath)
+        folder_key = (folder_stat.st_mtime_ns, -1)
+        if scan_skip_unchanged_folders and self.manifest.get(dirpath) == folder_key:
+            self.skipped.add(dirpath)
+            sub_folders = []
+            for sub_folder in self.sub_folders.get(dirpath, []):
+                try:
+                    sub_folders.append((sub_folder, os.stat(sub_folder)))
+                except OSError:
+                    pass
+        else:
+            if self.manifest.get(dirpath) != folder_key:
+                self.updates[dirpath] = folder_key
+            try:
+                entries = scandir(dirpath)
+            except OSError:
+                return
+            sub_folders = []
+            for entry in entries:
+                full_name = dirpath + "/" + entry.name
+                if entry.is_dir():
+                    # Symlinked folders are not followed, as os.walk():
+                    if not entry.is_symlink():
+                        sub_folders.append((full_name, entry.stat()))
+                elif entry.name.endswith(".md"):
+                    try:
+                        file_stat = entry.stat()
+                    except OSError:
+                        continue
+                    self.seen.add(full_name)
+                    if self.manifest.get(full_name) != (file_stat.st_mtime_ns, file_stat.st_size):
+                        yield (full_name, file_stat)
+        for (sub_folder, sub_stat) in sub_folders:
+            yield from self.scan_folder(sub_folder, sub_stat)
+
+    def set_checked(self, full_name, file_stat):
+        # File checked, and imported if changed:
+        self.updates[full_name] = (file_stat.st_mtime_ns, file_stat.st_size)
+
+    def save(self):
+        # Saves manifest to sync state. Files and folders no longer found are removed from it
+        # (but files in folders not read are kept):
+        deleted = []
+        if self.changed is None:
+            deleted = [path for path in self.manifest if path not in self.seen
+                       and path[:path.rfind("/")] not in self.skipped]
+        self.state.update_scan_manifest(self.updates.items(), deleted)
+#end_class ExportScan
+
+
+def sync_files(sync_path, ulysses_path, log, state, changed_files=None):
+    # changed_files: Only these files in export folder are checked, if given. Otherwise all files.
     # if not os.path.exists(changed_files_path):
     #     os.makedirs(changed_files_path)
-    sync_file = sync_path + ".ulysses_sync.log"
     inbox_path = ulysses_path + "Unfiled-ulgroup/"
 
     synced_date = ""
 
-    if os.path.exists(sync_file):
-        last_synced = get_file_date(sync_file)
+    last_synced = state.get_last_synced()
+    if last_synced > 0:
         synced_date = str(datetime.datetime.fromtimestamp(last_synced))
         print("Last synced:", synced_date)
     else:
-        notify("* SYNC FILE MISSING: " + sync_file)
+        notify("* SYNC STATE MISSING: " + state.db_file)
         return
 
-    ul_list = UlFileList()
-    ul_list.make_file_list(ulysses_path, sync_path, 1)
-
-    for (dirpath, dirnames, filenames) in walk(sync_path):
-        if filenames:
-            for fname in filenames:
-                if fname.endswith(".md"):
-                    full_name = dirpath + "/" + fname
-
-                    # Check if exported file has changed since last export/sync
-                    ts = get_file_date(full_name)
-                    if ts > last_synced:
-                        # print("Sync import: " + str(full_name.encode("utf-8")))
-                        md_text = read_file(full_name)
-                        modified = get_file_date(full_name)
-                        path = os.path.dirname(full_name)
-                        keep_attachments = False
-
-                        file_date_time_0 = str(datetime.datetime.fromtimestamp(modified))
-                        file_date_time = file_date_time_0
-                        file_date_time = file_date_time.replace(":", "-")
-                        file_date_time = file_date_time.replace(" ", "<escape>\_</escape>")
-
-                        source_group = path.replace(sync_path, "") + "/"
-                        # source_group = re.sub(r"/\d+ - ", r"/", source_group)
-
-                        # file_title = re.sub(r"^(\d+ - )?(.+) - [0-9a-f]{32}\.md$", r"\2", fname)
-                        file_title = re.sub(r" - [0-9a-f]{32}\.md$", r"", fname)
-                        file_title = source_group + file_title
-
-                        msg = ""
-                        comment = ""
-                        ul_package = ""
-                        match = re.search(r"^(.+? - )?([0-9a-f]{32})\.md$", fname)
-                        if match:
-                            ul_uuid = match.group(2)
-                            ul_match = ul_list.get_ul_path(ul_uuid)
-                            #print(ul_match)
-                            if ul_match == "":
-                            # Sheet deleted in Ulysses, make new sheet in inbox
-                                msg = "Sheet deleted in Ulysses? In group: " + source_group
-
-                                comment = msg + "\nExternal edit at: " + file_date_time
-                                ul_path = inbox_path  # + uuid.uuid4().hex + ".ulysses/"
-                                ul_package = uuid.uuid4().hex + ".ulysses/"
-                                notify("New sheet in inbox, " + msg + " " + file_title)
-                                log.add_line("New sheet from: ", file_date_time_0, file_title)
-
-                            else:
-                                ul_path = ul_match  # + ul_uuid + ".ulysses/"
-                                ul_package = ul_uuid + ".ulysses/"
-                                if check_files(sync_file, full_name, ul_path + ul_package + "Content.xml"):
-                                # Updating existing sheet:
-                                    msg = "External edit: "
-                                    keep_attachments = True
-                                    # comment = msg + file_date_time
-                                    log.add_line("Sheet updated from: ", file_date_time_0, file_title)
-
-                                else:
-                                # Sync conflict!
-                                    # Both Sheet and exported file updated since last sync,
-                                    # make new sheet in inbox:
-                                    msg = "Sync conflict with sheet in group: " + source_group
-                                    comment = msg + "\nExternal edit at: " + file_date_time\
-                                        + "\nNOTE! Attachments only as plaintext, at end of sheet"
-                                    ul_path = inbox_path  # + uuid.uuid4().hex + ".ulysses/"
-                                    ul_package = uuid.uuid4().hex + ".ulysses/"
-                                    notify("SYNC CONFLICT! See Inbox: " + file_title)
-                                    log.add_line("SYNC CONFLICT! with: ", file_date_time_0,
-                                                 file_title)
+    # Sheets are found by UUID, from group plists only (when first changed file is imported):
+    ul_list = None
 
-                        else:
-                            # New files without Ulysses uuid, make new sheet in inbox:
-                            msg = 'New sheet from export folder: ' + source_group
-                            comment = msg + "\nExternal edit at: " + file_date_time
-
-                            ul_path = inbox_path  # + uuid.uuid4().hex + ".ulysses/"
-                            ul_package = uuid.uuid4().hex + ".ulysses/"
-                            notify("New sheet in inbox: " + file_title)
-                            log.add_line("New sheet from: ", file_date_time_0, file_title)
-
-                        # Markdown to Ulysses Xml converions is done here:
-                        xml_text = markdown_to_ulysses_xml(md_text, ul_path + ul_package, comment,
-                                                           keep_attachments)
-
-                        # Test XML, and write Ulysses package with XML-file + text-file
-                        write_package(ul_path, ul_package, xml_text, modified)
-
-                    #endif ts > last_synced
-                #endif fname.endswith(".md")
-            #endfor fname in filenames
-        #endif filenames
+    scan = ExportScan(sync_path, state, changed_files)
+    for (full_name, file_stat) in scan.changed_files():
+        fname = os.path.basename(full_name)
+
+        # Check if exported file has changed since last export/sync:
+        # Per sheet if exported before, otherwise since last sync.
+        ts = file_stat.st_mtime
+        match = re.search(r"^(.+? - )?([0-9a-f]{32})\.md$", fname)
+        sheet = None
+        if match:
+            sheet = state.get_sheet(match.group(2))
+        if sheet is not None:
+            file_changed = int(ts) != sheet["exported_mtime"]
+            if file_changed and sheet["content_hash"] \
+                    and get_text_hash(read_file(full_name)) == sheet["content_hash"]:
+                # Only file date changed (touched, or rewritten by Dropbox or editor):
+                file_changed = False
+                state.set_exported_mtime(sheet["ul_uuid"], int(ts))
+        else:
+            file_changed = ts > last_synced
+
+        if file_changed:
+            # print("Sync import: " + str(full_name.encode("utf-8")))
+            md_text = read_file(full_name)
+            metrics.count("bytes_read", file_stat.st_size)
+            modified = ts
+            path = os.path.dirname(full_name)
+            keep_attachments = False
+
+            file_date_time_0 = str(datetime.datetime.fromtimestamp(modified))
+            file_date_time = file_date_time_0
+            file_date_time = file_date_time.replace(":", "-")
+            file_date_time = file_date_time.replace(" ", "<escape>\_</escape>")
+
+            source_group = path.replace(sync_path, "") + "/"
+            # source_group = re.sub(r"/\d+ - ", r"/", source_group)
+
+            # file_title = re.sub(r"^(\d+ - )?(.+) - [0-9a-f]{32}\.md$", r"\2", fname)
+            file_title = re.sub(r" - [0-9a-f]{32}\.md$", r"", fname)
+            file_title = source_group + file_title
+
+            msg = ""
+            comment = ""
+            ul_package = ""
+            if match:
+                ul_uuid = match.group(2)
+                if ul_list is None:
+                    ul_list = get_library_index(ulysses_path)
+                ul_match = ul_list.get_ul_path(ul_uuid)
+                #print(ul_match)
+                if ul_match == "":
+                # Sheet deleted in Ulysses, make new sheet in inbox
+                    msg = "Sheet deleted in Ulysses? In group: " + source_group
+
+                    comment = msg + "\nExternal edit at: " + file_date_time
+                    ul_path = inbox_path  # + uuid.uuid4().hex + ".ulysses/"
+                    ul_package = uuid.uuid4().hex + ".ulysses/"
+                    notify("New sheet in inbox, " + msg + " " + file_title)
+                    log.add_line("New sheet from: ", file_date_time_0, file_title)
+                    metrics.count("sheets_imported")
+
+                else:
+                    ul_path = ul_match  # + ul_uuid + ".ulysses/"
+                    ul_package = ul_uuid + ".ulysses/"
+                    synced_hash = None
+                    if sheet is not None:
+                        synced_ts = float(sheet["package_mtime"])
+                        synced_hash = sheet["package_hash"]
+                    else:
+                        synced_ts = last_synced
+                    # Sync conflict only if sheet's content also changed since last sync:
+                    if check_files(synced_ts, full_name, ul_path + ul_package + "Content.xml",
+                                   synced_hash):
+                    # Updating existing sheet:
+                        msg = "External edit: "
+                        keep_attachments = True
+                        # comment = msg + file_date_time
+                        log.add_line("Sheet updated from: ", file_date_time_0, file_title)
+                        metrics.count("sheets_imported")
+
+                    else:
+                    # Sync conflict!
+                        # Both Sheet and exported file updated since last sync,
+                        # make new sheet in inbox:
+                        msg = "Sync conflict with sheet in group: " + source_group
+                        comment = msg + "\nExternal edit at: " + file_date_time\
+                            + "\nNOTE! Attachments only as plaintext, at end of sheet"
+                        ul_path = inbox_path  # + uuid.uuid4().hex + ".ulysses/"
+                        ul_package = uuid.uuid4().hex + ".ulysses/"
+                        notify("SYNC CONFLICT! See Inbox: " + file_title)
+                        log.add_line("SYNC CONFLICT! with: ", file_date_time_0,
+                                     file_title)
+                        metrics.count("sheets_conflicted")
+
+            else:
+                # New files without Ulysses uuid, make new sheet in inbox:
+                msg = 'New sheet from export folder: ' + source_group
+                comment = msg + "\nExternal edit at: " + file_date_time
+
+                ul_path = inbox_path  # + uuid.uuid4().hex + ".ulysses/"
+                ul_package = uuid.uuid4().hex + ".ulysses/"
+                notify("New sheet in inbox: " + file_title)
+                log.add_line("New sheet from: ", file_date_time_0, file_title)
+                metrics.count("sheets_imported")
+
+            # Markdown to Ulysses Xml converions is done here:
+            xml_text = markdown_to_ulysses_xml(md_text, ul_path + ul_package, comment,
+                                               keep_attachments)
+
+            # Test XML, and write Ulysses package with XML-file + text-file
+            write_package(ul_path, ul_package, xml_text, modified)
+
+        #endif file_changed
+        scan.set_checked(full_name, file_stat)
+    #endfor full_name in changed files
+    scan.save()
+    # New sheets added to group plists, once per group:
+    plist_updates.flush()
+    state.commit()
     return
-#enddef sync_files(sync_path, ulysses_path, log)
+#enddef sync_files(sync_path, ulysses_path, log, state, changed_files=None)
+
+
+class SyncLock:
+    # Lock file, so syncs never overlap, e.g. watch mode and a manual run.
+    # (flock, released by OS if process is killed)
+    def __init__(self, lock_file):
+        self.lock_file = lock_file
+        self.f = None
+
+    def acquire(self):
+        self.f = open(self.lock_file, "w")
+        try:
+            fcntl.flock(self.f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            print("* Waiting for other sync to finish:", self.lock_file)
+            fcntl.flock(self.f, fcntl.LOCK_EX)
+
+    def release(self):
+        fcntl.flock(self.f, fcntl.LOCK_UN)
+        self.f.close()
+        self.f = None
+#end_class SyncLock
+
+
+class InotifyWatcher:
+    # Watches folder trees with Linux inotify (via ctypes), one watch per folder.
+    # Raises OSError if inotify is not available, or max. number of watches is reached.
+    IN_MODIFY = 0x2
+    IN_ATTRIB = 0x4
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_Q_OVERFLOW = 0x4000
+    IN_ISDIR = 0x40000000
+    IN_CLOEXEC = 0o2000000
+    WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO \
+        | IN_CREATE | IN_DELETE
+    EVENT_HEADER = struct.Struct("iIII")  # wd, mask, cookie, len
+
+    def __init__(self, paths):
+        libc_name = ctypes.util.find_library("c")
+        if libc_name is None:
+            raise OSError("inotify: libc not found")
+        self.libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(self.libc, "inotify_init1"):
+            raise OSError("inotify: not available")
+        self.fd = self.libc.inotify_init1(self.IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1")
+        self.watches = {}  # wd: Folder path
+        for path in paths:
+            if os.path.isdir(path):
+                self.add_tree(path)
+
+    def add_tree(self, path):
+        # Adds watches for folder and all sub folders. Returns files found (created before watched):
+        files = []
+        for (dirpath, dirnames, filenames) in walk(path):
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(dirpath), self.WATCH_MASK)
+            if wd < 0:
+                errno = ctypes.get_errno()
+                if errno == 28:  # ENOSPC: Max. number of watches reached
+                    os.close(self.fd)
+                    raise OSError(errno, "inotify_add_watch: Max. number of watches reached")
+                continue  # Folder deleted since walk
+            self.watches[wd] = dirpath
+            files += [os.path.join(dirpath, fname) for fname in filenames]
+        return files
+
+    def read_changes(self, timeout):
+        # Changed paths (set) within "timeout" seconds (None: wait), or None if events were lost:
+        (readable, w, x) = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return set()
+        data = os.read(self.fd, 65536)
+        changed = set()
+        pos = 0
+        while pos < len(data):
+            (wd, mask, cookie, length) = self.EVENT_HEADER.unpack_from(data, pos)
+            pos += self.EVENT_HEADER.size
+            name = data[pos: pos + length].rstrip(b"\0")
+            pos += length
+            if mask & self.IN_Q_OVERFLOW:
+                return None
+            if wd not in self.watches:
+                continue
+            path = os.path.join(self.watches[wd], os.fsdecode(name))
+            changed.add(path)
+            if mask & self.IN_ISDIR and mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                changed.update(self.add_tree(path))
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+#end_class InotifyWatcher
+
+
+class PollingWatcher:
+    # Watches folder trees by comparing file dates and sizes, every "poll_interval" seconds.
+    def __init__(self, paths, poll_interval):
+        self.paths = paths
+        self.poll_interval = poll_interval
+        self.files = self.scan()
+
+    def scan(self):
+        files = {}
+        for path in self.paths:
+            for (dirpath, dirnames, filenames) in walk(path):
+                for fname in filenames:
+                    full_name = os.path.join(dirpath, fname)
+                    try:
+                        file_stat = os.stat(full_name)
+                        files[full_name] = (file_stat.st_mtime, file_stat.st_size)
+                    except OSError:
+                        pass
+        return files
+
+    def read_changes(self, timeout):
+        # Changed paths (set) at next scan. (Scans at least "poll_interval" apart)
+        time.sleep(self.poll_interval if timeout is None else max(timeout, self.poll_interval))
+        files = self.scan()
+        changed = set(name for name in files if self.files.get(name) != files[name])
+        changed.update(name for name in self.files if name not in files)
+        self.files = files
+        return changed
+
+    def close(self):
+        return
+#end_class PollingWatcher
+
+
+class FolderWatcher:
+    # Watches folder trees for changed files: inotify if available, otherwise polling.
+    # Hidden files are ignored (e.g. sync state database and temp files).
+    def __init__(self, paths, poll_interval=2.0):
+        try:
+            self.watcher = InotifyWatcher(paths)
+            self.kind = "inotify"
+        except OSError as inst:
+            print("* inotify not used:", inst)
+            self.watcher = PollingWatcher(paths, poll_interval)
+            self.kind = "polling"
+
+    def wait_changes(self, debounce, max_delay=30.0):
+        # Waits for changes, and then until no more changes for "debounce" seconds,
+        # so bursts of changes are returned together (but after "max_delay" seconds at most).
+        # Returns changed paths (set), or None if changes are unknown (then sync everything).
+        changed = set()
+        while not changed:
+            changed = self.read_changes(None)
+            if changed is None:
+                return None
+        started = time.time()
+        while time.time() - started < max_delay:
+            more_changes = self.read_changes(debounce)
+            if more_changes is None:
+                return None
+            if not more_changes:
+                break
+            changed.update(more_changes)
+        return changed
+
+    def read_changes(self, timeout):
+        changed = self.watcher.read_changes(timeout)
+        if changed is None:
+            return None
+        return set(path for path in changed if not os.path.basename(path).startswith("."))
+
+    def close(self):
+        self.watcher.close()
+#end_class FolderWatcher
+
+
+def clone_file(from_file, to_file):
+    # Copy-on-write clone of file (reflink), sharing data blocks until changed.
+    # Returns False if not supported by file system (or OS), then nothing is written:
+    try:
+        if sys.platform == "darwin":
+            # APFS: clonefile() keeps file dates
+            libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+            return libc.clonefile(os.fsencode(from_file), os.fsencode(to_file), 0) == 0
+        from_f = open(from_file, "rb")
+        to_f = open(to_file, "wb")
+        try:
+            fcntl.ioctl(to_f.fileno(), 0x40049409, from_f.fileno())  # FICLONE (Linux: Btrfs, XFS)
+        finally:
+            from_f.close()
+            to_f.close()
+        shutil.copystat(from_file, to_file)
+        return True
+    except (OSError, AttributeError):
+        if os.path.exists(to_file):
+            os.remove(to_file)
+        return False
+
+
+class SnapshotBackup:
+    # Snapshot backups of a folder: "backup_path" + "prefix" + date and time.
+    # Each snapshot is a complete copy, but files unchanged since last snapshot (same size, and date
+    # in nanoseconds, as kept by copy2) are hard links to the same file in last snapshot.
+    # So each snapshot only costs what changed.
+    # use_reflink: Files are cloned (reflink) from source instead, if supported by file system.
+    SNAPSHOT_DATE = "%Y-%m-%d_%H-%M-%S"
+
+    def __init__(self, backup_path, prefix, use_reflink=False):
+        self.backup_path = backup_path
+        self.prefix = prefix
+        self.use_reflink = use_reflink
+        self.linked = 0
+        self.cloned = 0
+        self.copied = 0
+        self.copied_bytes = 0
+
+    def list_snapshots(self):
+        # Complete snapshots: [(datetime, path)], oldest first:
+        snapshots = []
+        if os.path.exists(self.backup_path):
+            for name in os.listdir(self.backup_path):
+                if name.startswith(self.prefix):
+                    try:
+                        date_time = datetime.datetime.strptime(name[len(self.prefix):],
+                                                               self.SNAPSHOT_DATE)
+                    except ValueError:
+                        continue  # Not a snapshot, e.g. older full backup or unfinished snapshot
+                    snapshots.append((date_time, self.backup_path + name + "/"))
+        return sorted(snapshots)
+
+    def make_snapshot(self, from_path, min_interval=0):
+        # Makes new snapshot of "from_path", unless last one is less than "min_interval" seconds old.
+        # Written to ".partial" folder first, and renamed when complete.
+        # (Backup folder may be made at the same time by a backup of another library)
+        os.makedirs(self.backup_path, exist_ok=True)
+        snapshots = self.list_snapshots()
+        now = datetime.datetime.now()
+        if snapshots and (now - snapshots[-1][0]).total_seconds() < max(min_interval, 1):
+            return None
+        last_snapshot = snapshots[-1][1] if snapshots else None
+
+        # Unfinished snapshots, e.g. if sync was stopped:
+        for name in os.listdir(self.backup_path):
+            if name.startswith(self.prefix) and name.endswith(".partial"):
+                shutil.rmtree(self.backup_path + name)
+
+        snapshot_path = self.backup_path + self.prefix + now.strftime(self.SNAPSHOT_DATE) + "/"
+        partial_path = snapshot_path[:-1] + ".partial/"
+        self.snapshot_tree(from_path, partial_path, last_snapshot)
+        os.rename(partial_path, snapshot_path)
+        return snapshot_path
+
+    def snapshot_tree(self, from_path, to_path, last_path):
+        os.makedirs(to_path)
+        for name in os.listdir(from_path):
+            from_file = os.path.join(from_path, name)
+            to_file = os.path.join(to_path, name)
+            last_file = os.path.join(last_path, name) if last_path else None
+            if os.path.islink(from_file):
+                os.symlink(os.readlink(from_file), to_file)
+            elif os.path.isdir(from_file):
+                self.snapshot_tree(from_file, to_file, last_file)
+            else:
+                self.snapshot_file(from_file, to_file, last_file)
+        shutil.copystat(from_path, to_path)
+
+    def snapshot_file(self, from_file, to_file, last_file):
+        if self.use_reflink:
+            if clone_file(from_file, to_file):
+                self.cloned += 1
+                return
+            self.use_reflink = False  # Not supported, hard links used instead
+        from_stat = os.stat(from_file)
+        try:
+            last_stat = os.lstat(last_file)
+            if last_stat.st_size == from_stat.st_size \
+                    and last_stat.st_mtime_ns == from_stat.st_mtime_ns:
+                os.link(last_file, to_file)
+                self.linked += 1
+                return
+        except (OSError, TypeError):
+            pass  # No file in last snapshot, or too many links to it
+        shutil.copy2(from_file, to_file)
+        self.copied += 1
+        self.copied_bytes += from_stat.st_size
+
+    def prune_snapshots(self, keep):
+        # Retention: Deletes snapshots not kept by "keep", e.g. {"hourly": 24, "daily": 7, "weekly": 8}:
+        # The newest snapshot in each of the last n hours, days, weeks, months. Newest is always kept.
+        period_keys = {"hourly": "%Y-%m-%d %H", "daily": "%Y-%m-%d", "weekly": "%Y-%W", "monthly": "%Y-%m"}
+        snapshots = self.list_snapshots()
+        kept = set(snapshots[-1:])
+        for (period, count) in keep.items():
+            periods = set()
+            for snapshot in reversed(snapshots):
+                period_key = snapshot[0].strftime(period_keys[period])
+                if period_key not in periods and len(periods) < count:
+                    periods.add(period_key)
+                    kept.add(snapshot)
+        deleted = []
+        for snapshot in snapshots:
+            if snapshot not in kept:
+                shutil.rmtree(snapshot[1])
+                deleted.append(snapshot[1])
+        return deleted
+#end_class SnapshotBackup
+
+
+class SyncMetrics:
+    # Metrics of sync runs, per library and phase (backup, import, list, export, delete, log):
+    # Wall time, and counts of sheets and files, and bytes read and written.
+    # Phases are timed by start() and stop(), and counts are added to current phase by count().
+    # finish() ends the run of a library, and returns its report, e.g. written by write_json().
+    counter_names = ["sheets_parsed", "sheets_converted", "sheets_skipped", "sheets_imported",
+                     "sheets_conflicted", "files_written", "bytes_read", "bytes_written"]
+
+    def __init__(self):
+        self.running = {}  # Library: Report of current run
+        self.reports = {}  # Library: Report of last finished run
+        self.phase = None
+        self.phase_start = 0
+        self.lock = threading.Lock()  # Counts are also added by writer thread of ExportFolder
+
+    def start(self, library, phase):
+        # Starts timing "phase" of "library" (and stops last phase). New run if library finished:
+        self.stop()
+        if library not in self.running:
+            self.running[library] = {"library": library, "started": time.time(), "seconds": 0,
+                                     "phases": {}}
+        phases = self.running[library]["phases"]
+        if phase not in phases:
+            phases[phase] = dict([("seconds", 0)] + [(name, 0) for name in self.counter_names])
+        self.phase = phases[phase]
+        self.phase_start = time.time()
+
+    def stop(self):
+        if self.phase is not None:
+            self.phase["seconds"] += time.time() - self.phase_start
+            self.phase = None
+
+    def get_phase(self):
+        # Counters of current phase, for counts made later, e.g. in a thread:
+        return self.phase
+
+    def count(self, name, n=1, phase=None):
+        # Adds to counter of current phase, or of "phase" (from get_phase()).
+        # Not counted outside phases, e.g. in worker processes.
+        # (Current phase is read once, as it may change meanwhile in main thread)
+        if phase is None:
+            phase = self.phase
+        if phase is not None:
+            with self.lock:
+                phase[name] += n
+
+    def finish(self, library):
+        # Ends run of "library", returns report with time and counts per phase, and totals:
+        self.stop()
+        report = self.running.pop(library)
+        report["seconds"] = time.time() - report["started"]
+        report["totals"] = dict((name, sum(phase[name] for phase in report["phases"].values()))
+                                for name in self.counter_names)
+        self.reports[library] = report
+        return report
+
+    def get_summary(self, report):
+        summary = "%.2f s" % report["seconds"]
+        for (phase, values) in report["phases"].items():
+            summary += ", %s %.2f s" % (phase, values["seconds"])
+        totals = report["totals"]
+        return summary + " - Sheets converted: %d, skipped: %d, imported: %d, conflicts: %d" % (
+            totals["sheets_converted"], totals["sheets_skipped"], totals["sheets_imported"],
+            totals["sheets_conflicted"])
+
+    def write_json(self, report, json_file):
+        # Appends report as one JSON line, so file keeps history of sync runs:
+        f = open(json_file, "a", encoding="utf-8")
+        f.write(json.dumps(report, sort_keys=True) + "\n")
+        f.close()
+
+    def write_prometheus(self, prom_file):
+        # Last report of each library in Prometheus text format (e.g. for node_exporter textfile
+        # collector). Written to temp file and renamed, so file is never read half written:
+        def label(value):
+            return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+        lines = ["# HELP ulysses_sync_seconds Wall time of last sync run.",
+                 "# TYPE ulysses_sync_seconds gauge"]
+        for (library, report) in sorted(self.reports.items()):
+            lines.append('ulysses_sync_seconds{library="%s"} %.3f' % (label(library), report["seconds"]))
+        lines += ["# HELP ulysses_sync_last_run_timestamp_seconds Start of last sync run.",
+                  "# TYPE ulysses_sync_last_run_timestamp_seconds gauge"]
+        for (library, report) in sorted(self.reports.items()):
+            lines.append('ulysses_sync_last_run_timestamp_seconds{library="%s"} %.0f' % (
+                label(library), report["started"]))
+        for name in ["seconds"] + self.counter_names:
+            lines += ["# HELP ulysses_sync_phase_%s Sync phase %s, at last sync run." % (
+                name, name.replace("_", " ")), "# TYPE ulysses_sync_phase_%s gauge" % name]
+            for (library, report) in sorted(self.reports.items()):
+                for (phase, values) in sorted(report["phases"].items()):
+                    lines.append('ulysses_sync_phase_%s{library="%s",phase="%s"} %s' % (
+                        name, label(library), phase, round(values[name], 3)))
+        temp_file = prom_file + ".ulysses_temp"
+        write_file(temp_file, "\n".join(lines) + "\n")
+        os.replace(temp_file, prom_file)
+#end_class SyncMetrics
+
+
+# Metrics of sync runs, counted by functions above while a phase is timed:
+metrics = SyncMetrics()